@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import load_balancer
+import http_transport
+from standin_server import StandIn, point_balancer_at
+from latency_sketch import DurationSketch
+
+# Benchmark configuration
+FLEET_SIZES = [3, 10, 100, 1000, 10000]
+CYCLES_PER_SIZE = 3
+RESULTS_DIR = "benchmark_results"
+SERVICE_NAME = "bench-service"
+PHASES = ("discover_instances", "collect_metrics", "update_history", "calculate_weights",
+          "update_consul_weights", "export_results")
+
+# Collection modes: which balancer switches are set for the run
+MODES = {
+    "batched": {"INCREMENTAL_FETCH": False, "BATCH_QUERIES": True},
+    "per_instance": {"INCREMENTAL_FETCH": False, "BATCH_QUERIES": False},
+    "incremental": {"INCREMENTAL_FETCH": True, "BATCH_QUERIES": True}
+}
+
+# How the synthetic catalog's instances take weight writes: agent registration (like the captured
+# sdn-news catalog, EnableTagOverride false) or catalog CAS transactions (EnableTagOverride true)
+CATALOG_MODES = {"agent": False, "txn": True}
+
+# Metric distributions for synthetic fleets: (mean, spread) per metric, plus the share of hot backends
+DISTRIBUTIONS = {
+    "uniform": {"cpu": (35, 25), "ram": (45, 20), "duration_ms": (150, 100), "error_ratio": (0.01, 0.01), "hot": 0.0},
+    "skewed": {"cpu": (20, 10), "ram": (35, 10), "duration_ms": (120, 40), "error_ratio": (0.005, 0.005), "hot": 0.1},
+    "saturated": {"cpu": (80, 15), "ram": (75, 15), "duration_ms": (600, 300), "error_ratio": (0.05, 0.03), "hot": 0.3}
+}
+
+
+class SyntheticFleet:
+    """Deterministic fleet of backends and the Elasticsearch aggregation answers describing them"""
+
+    def __init__(self, size, distribution="uniform", seed=0, window_seconds=600, tag_override=False):
+        self.size = size
+        self.window_seconds = window_seconds
+        self.tag_override = tag_override
+        spec = DISTRIBUTIONS[distribution]
+        rng = random.Random(seed)
+
+        def draw(name, low=0.0, high=None):
+            mean, spread = spec[name]
+            value = rng.gauss(mean, spread)
+            return max(low, value if high is None else min(high, value))
+
+        self.hosts = {}
+        for i in range(size):
+            ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            hot = rng.random() < spec["hot"]
+            cpu = draw("cpu", 1, 100)
+            self.hosts[ip] = {
+                "cpu": min(100.0, cpu * 2.5) if hot else cpu,
+                "ram": draw("ram", 1, 100),
+                "trend": rng.uniform(-0.2, 0.2),
+                "duration_ms": draw("duration_ms", 1) * (3 if hot else 1),
+                "error_ratio": draw("error_ratio", 0, 1),
+                "connections": rng.randint(50, 5000),
+                "bytes_in": rng.randint(10_000, 500_000_000),
+                "bytes_out": rng.randint(10_000, 500_000_000)
+            }
+
+    def catalog(self, service_name=SERVICE_NAME):
+        return [
+            {
+                "Node": f"node-{i}", "Address": ip, "ServiceID": f"{service_name}-{ip}", "ServiceName": service_name,
+                "ServiceTags": ["urlprefix-/api weight=50"], "ServiceAddress": ip, "ServicePort": 9901,
+                "ServiceMeta": {}, "ServiceEnableTagOverride": self.tag_override, "CreateIndex": 10, "ModifyIndex": 10
+            }
+            for i, ip in enumerate(self.hosts)
+        ]
+
+    def respond(self, index, query):
+        """Search responder for the stand-in: answers the fleet and Zeek aggregations, nothing else"""
+        aggs = query.get("aggs", {})
+        if "hosts" in aggs:
+            ips = aggs["hosts"]["terms"].get("include") or []
+            bucket = self.counter_bucket if "interfaces" in aggs["hosts"]["aggs"] else self.host_bucket
+            return self.search_result({"hosts": {"buckets": [bucket(ip) for ip in ips if ip in self.hosts]}})
+        if "incoming" in aggs:
+            ips = aggs["incoming"]["aggs"]["keys"]["terms"].get("include") or []
+            return self.search_result({
+                direction: {"doc_count": 0, "keys": {"buckets": [self.conn_bucket(ip, share) for ip in ips if ip in self.hosts]}}
+                for direction, share in (("incoming", 0.8), ("outgoing", 0.2))
+            })
+        return None
+
+    def search_result(self, aggregations):
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": 0, "relation": "eq"}, "hits": []},
+                "aggregations": aggregations}
+
+    def host_bucket(self, ip):
+        host = self.hosts[ip]
+        buckets = []
+        for metricset, name, value in (("cpu", "cpu", host["cpu"]), ("memory", "ram", host["ram"])):
+            average = value / 100
+            early = average / (1 + host["trend"] / 2)
+            late = early * (1 + host["trend"])
+            buckets.append({
+                "key": metricset, "doc_count": 60,
+                f"{name}_avg": {"value": average}, f"{name}_max": {"value": min(1.0, average * 1.3)},
+                "halves": {"buckets": [
+                    {"key": "early", "doc_count": 30, f"{name}_avg": {"value": early}},
+                    {"key": "late", "doc_count": 30, f"{name}_avg": {"value": late}}
+                ]}
+            })
+        buckets.append({
+            "key": "network", "doc_count": 60,
+            "interfaces": {"buckets": [{
+                "key": "eth0", "doc_count": 60,
+                "in_min": {"value": 1_000_000}, "in_max": {"value": 1_000_000 + host["bytes_in"]},
+                "out_min": {"value": 2_000_000}, "out_max": {"value": 2_000_000 + host["bytes_out"]}
+            }]}
+        })
+        return {"key": ip, "doc_count": 180, "metricsets": {"buckets": buckets}}
+
+    def counter_bucket(self, ip, buckets=20, interval_ms=30_000):
+        """Bucketed eth0 counters (or server-side rates) for the network rate queries, traffic spread evenly"""
+        host = self.hosts[ip]
+        start = 1_700_000_000_000
+        seconds = interval_ms / 1000
+        in_step = host["bytes_in"] / (buckets - 1)
+        out_step = host["bytes_out"] / (buckets - 1)
+        time_buckets = []
+        for i in range(buckets):
+            bucket = {"key": start + i * interval_ms, "doc_count": 1,
+                      "in_bytes": {"value": 1_000_000 + in_step * i}, "out_bytes": {"value": 2_000_000 + out_step * i}}
+            if i:
+                for name, step in (("in_bytes", in_step), ("out_bytes", out_step),
+                                   ("in_packets", in_step / 1000), ("out_packets", out_step / 1000)):
+                    bucket[f"{name}_rate"] = {"value": step, "normalized_value": step / seconds}
+            time_buckets.append(bucket)
+        return {"key": ip, "doc_count": buckets, "interfaces": {"buckets": [{
+            "key": "eth0", "doc_count": buckets, "buckets": {"buckets": time_buckets}, "rates": {"buckets": time_buckets}
+        }]}}
+
+    def conn_bucket(self, ip, share):
+        host = self.hosts[ip]
+        count = max(1, int(host["connections"] * share))
+        duration = host["duration_ms"] / 1000
+        # A right-skewed spread around the mean, returned as latency sketch bins
+        sketch = DurationSketch()
+        for scale, share in ((0.5, 0.6), (1.0, 0.3), (2.5, 0.08), (4.0, 0.02)):
+            sketch.add(duration * scale, max(1, round(count * share)))
+        bins = [{"key": float(key), "doc_count": value} for key, value in sorted(sketch.state["bins"].items(), key=lambda item: int(item[0]))]
+        return {
+            "key": ip, "doc_count": count,
+            "duration": {"count": count, "min": duration / 4, "max": duration * 4, "avg": duration, "sum": duration * count},
+            "duration_bins": {"doc_count": count, "bins": {"buckets": bins}},
+            "orig_bytes": {"value": count * 800}, "resp_bytes": {"value": count * 12_000},
+            "errors": {"doc_count": int(count * host["error_ratio"])}
+        }
+
+
+def time_phases(balancer, timings):
+    """Wrap the balancer's phase methods so each call adds its wall time to timings[phase]"""
+    for phase in PHASES:
+        method = getattr(balancer, phase)
+
+        def timed(*args, _method=method, _phase=phase, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                timings[_phase] = timings.get(_phase, 0) + time.perf_counter() - started
+
+        setattr(balancer, phase, timed)
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far (KB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_size(size, mode, distribution, cycles, latency_ms, workdir, catalog="agent"):
+    """Benchmark cycles for one fleet size; returns one result row per cycle"""
+    for name, value in MODES[mode].items():
+        setattr(load_balancer, name, value)
+    load_balancer.SERVICE_NAME = SERVICE_NAME
+    load_balancer.HISTORY_DIR = os.path.join(workdir, f"history_{size}")
+    load_balancer.COLLECTOR_STATE_FILE = os.path.join(workdir, f"collector_{size}.json")
+
+    fleet = SyntheticFleet(size, distribution, tag_override=CATALOG_MODES[catalog])
+    standin = StandIn("replay", os.path.join(workdir, "no-fixtures.jsonl.gz"), latency_ms=latency_ms,
+                      search_responder=fleet.respond)
+    standin.consul.seed(SERVICE_NAME, fleet.catalog())
+    point_balancer_at(load_balancer, *standin.start())
+    http_transport.close_sessions()
+
+    balancer = load_balancer.DynamicLoadBalancer()
+    rows = []
+    try:
+        for cycle in range(cycles):
+            timings = {}
+            time_phases(balancer, timings)
+            stats_before = dict(standin.stats)
+
+            started = time.perf_counter()
+            balancer.run_cycle()
+            wall = time.perf_counter() - started
+
+            # Export runs off the critical path; time how long it takes to drain separately
+            flush_started = time.perf_counter()
+            if balancer.exporter is not None:
+                balancer.exporter.flush(300)
+            export_drain = time.perf_counter() - flush_started
+
+            stats = {key: standin.stats[key] - stats_before.get(key, 0) for key in standin.stats}
+            rows.append({
+                "fleet_size": size,
+                "mode": mode,
+                "catalog": catalog,
+                "distribution": distribution,
+                "cycle": cycle,
+                "wall_seconds": round(wall, 4),
+                "phases": {phase: round(seconds, 4) for phase, seconds in timings.items()},
+                "export_drain_seconds": round(export_drain, 4),
+                "requests": stats["requests"],
+                "elastic_requests": stats["elastic_requests"],
+                "consul_requests": stats["consul_requests"],
+                "bytes_to_backend": stats["bytes_received"],
+                "bytes_from_backend": stats["bytes_sent"],
+                "weights": len(balancer.weights),
+                "peak_rss_kb": peak_rss_kb()
+            })
+            # Undo the wrappers so the next cycle wraps fresh methods
+            for phase in PHASES:
+                balancer.__dict__.pop(phase, None)
+    finally:
+        if balancer.watcher is not None:
+            balancer.watcher.stop()
+        if balancer.exporter is not None:
+            balancer.exporter.close(60)
+        standin.stop()
+    return rows
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_rows(rows):
+    print(f"{'backends':>8} {'mode':>12} {'catalog':>7} {'cycle':>5} {'wall s':>8} {'collect s':>9} {'score s':>8} "
+          f"{'consul s':>8} {'reqs':>6} {'consul':>6} {'KB out':>9} {'KB in':>9} {'RSS MB':>7}")
+    for row in rows:
+        phases = row["phases"]
+        print(f"{row['fleet_size']:>8} {row['mode']:>12} {row['catalog']:>7} {row['cycle']:>5} {row['wall_seconds']:>8.3f} "
+              f"{phases.get('collect_metrics', 0):>9.3f} {phases.get('calculate_weights', 0):>8.3f} "
+              f"{phases.get('update_consul_weights', 0):>8.3f} {row['requests']:>6} {row['consul_requests']:>6} "
+              f"{row['bytes_to_backend'] / 1024:>9.1f} {row['bytes_from_backend'] / 1024:>9.1f} "
+              f"{row['peak_rss_kb'] / 1024:>7.1f}")
+
+
+def compare(baseline_file, candidate_file):
+    """Print the candidate/baseline ratio of mean cycle wall time per fleet size, mode and catalog"""
+    def means(path):
+        with open(path) as f:
+            rows = json.load(f)["results"]
+        grouped = {}
+        for row in rows:
+            # Results from before the catalog option all ran the txn path
+            key = (row["fleet_size"], row["mode"], row.get("catalog", "txn"))
+            grouped.setdefault(key, []).append(row["wall_seconds"])
+        return {key: sum(values) / len(values) for key, values in grouped.items()}
+
+    baseline, candidate = means(baseline_file), means(candidate_file)
+    print(f"{'backends':>8} {'mode':>12} {'catalog':>7} {'baseline s':>10} {'candidate s':>11} {'ratio':>6}")
+    for key in sorted(set(baseline) & set(candidate)):
+        ratio = candidate[key] / baseline[key] if baseline[key] else float("inf")
+        print(f"{key[0]:>8} {key[1]:>12} {key[2]:>7} {baseline[key]:>10.3f} {candidate[key]:>11.3f} {ratio:>6.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DynamicLoadBalancer cycles against a synthetic fleet")
+    parser.add_argument("--sizes", type=int, nargs="+", default=FLEET_SIZES)
+    parser.add_argument("--cycles", type=int, default=CYCLES_PER_SIZE)
+    parser.add_argument("--mode", choices=sorted(MODES), default="batched")
+    parser.add_argument("--catalog", choices=sorted(CATALOG_MODES), default="agent",
+                        help="weight write path of the synthetic instances")
+    parser.add_argument("--distribution", choices=sorted(DISTRIBUTIONS), default="uniform")
+    parser.add_argument("--latency-ms", type=float, default=0, help="injected backend latency per request")
+    parser.add_argument("--output", help="results file (default: benchmark_results/<timestamp>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    # Keep the balancer's per-cycle logging out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sorted(args.sizes):
+            results.extend(run_size(size, args.mode, args.distribution, args.cycles, args.latency_ms, workdir,
+                                    args.catalog))
+            print_rows([row for row in results if row["fleet_size"] == size])
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"Saved {len(results)} results to {output}")
@@ -1,10 +1,11 @@
+import http_transport
+
 class ConsulClient:
     def __init__(self, consul_url):
         self.consul_url = consul_url
 
     def fetch_services(self, service_name):
-        import requests
-        response = requests.get(f"{self.consul_url}/v1/catalog/service/{service_name}")
+        response = http_transport.get(f"{self.consul_url}/v1/catalog/service/{service_name}")
         if response.status_code == 200:
             return response.json()
         else:
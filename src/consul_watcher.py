@@ -0,0 +1,130 @@
+import logging
+import random
+import threading
+import http_transport
+from query_consul import extract_instance_data
+
+# Watcher configuration
+WATCH_WAIT_SECONDS = 300  # Longest Consul may hold a blocking query open
+ERROR_BACKOFF_SECONDS = 5  # First retry delay after a failed query (doubles up to the max)
+MAX_BACKOFF_SECONDS = 60
+
+
+class ServiceWatcher(threading.Thread):
+    """Keeps the instance table of one Consul service current using blocking queries.
+
+    Each request carries ?index=<last X-Consul-Index>, so Consul only answers
+    when the catalog changes (or the wait expires); in steady state there is
+    one idle long-poll and no repeated catalog reads. When membership changes,
+    the `changed` event is set and the added/removed instances are queued for
+    the balancer to pick up.
+    """
+
+    def __init__(self, consul_url, service_name, wait_seconds=WATCH_WAIT_SECONDS):
+        super().__init__(name=f"consul-watch-{service_name}", daemon=True)
+        self.consul_url = consul_url.rstrip("/")
+        self.service_name = service_name
+        self.wait_seconds = wait_seconds
+        self.index = 0
+        self.instances = []
+        self.catalog = []
+        self.changed = threading.Event()
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.pending_added = {}
+        self.pending_removed = {}
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def get_instances(self):
+        """Current instance rows (a copy, safe to use while the watcher updates)"""
+        with self.lock:
+            return list(self.instances)
+
+    def get_catalog(self):
+        """Raw catalog entries from the last read (carry ModifyIndex for CAS writes)"""
+        with self.lock:
+            return list(self.catalog)
+
+    def take_changes(self):
+        """Return and clear (added, removed) instance rows since the last call"""
+        with self.lock:
+            added = list(self.pending_added.values())
+            removed = list(self.pending_removed.values())
+            self.pending_added = {}
+            self.pending_removed = {}
+            self.changed.clear()
+        return added, removed
+
+    def run(self):
+        backoff = ERROR_BACKOFF_SECONDS
+        while not self.stopping.is_set():
+            try:
+                self.poll_once()
+                backoff = ERROR_BACKOFF_SECONDS
+            except Exception as e:
+                logging.error("Consul watch for %s failed: %s (retrying in %ss)", self.service_name, e, backoff)
+                # Blocking queries restart from scratch after an error
+                self.index = 0
+                self.stopping.wait(backoff * (0.5 + random.random()))
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+
+    def poll_once(self):
+        """Issue one blocking query and apply the result if the index moved"""
+        url = f"{self.consul_url}/v1/catalog/service/{self.service_name}"
+        params = {"index": self.index, "wait": f"{self.wait_seconds}s"} if self.index else None
+        # Consul adds up to wait/16 of jitter, so the read timeout must outlast it
+        read_timeout = self.wait_seconds * 1.1 + 10
+
+        response = http_transport.get(
+            url,
+            params=params,
+            timeout=(http_transport.CONNECT_TIMEOUT, read_timeout),
+            verify=False
+        )
+        response.raise_for_status()
+
+        new_index = int(response.headers.get("X-Consul-Index", 0))
+        # An index that goes backwards (e.g. after a snapshot restore) means start over
+        if new_index < self.index or new_index <= 0:
+            new_index = 0
+        elif new_index == self.index:
+            return False
+        self.index = new_index
+
+        services = response.json()
+        self.apply(extract_instance_data(services), services)
+        return True
+
+    def apply(self, instances, catalog=None):
+        """Swap in a new instance table and record membership changes"""
+        with self.lock:
+            self.catalog = catalog or []
+            old = {instance['Service ID']: instance for instance in self.instances}
+            new = {instance['Service ID']: instance for instance in instances}
+            added = [new[key] for key in new if key not in old or old[key]['IP Address'] != new[key]['IP Address']]
+            removed = [old[key] for key in old if key not in new or old[key]['IP Address'] != new[key]['IP Address']]
+            self.instances = instances
+
+            first_load = not self.ready.is_set()
+            if not first_load and (added or removed):
+                for instance in added:
+                    self.pending_removed.pop(instance['Service ID'], None)
+                    self.pending_added[instance['Service ID']] = instance
+                for instance in removed:
+                    if instance['Service ID'] not in new:
+                        self.pending_added.pop(instance['Service ID'], None)
+                    self.pending_removed[instance['Service ID']] = instance
+                self.changed.set()
+
+        self.ready.set()
+        if added or removed:
+            logging.info("Consul watch for %s: %d instance(s), +%d/-%d (index %d)",
+                         self.service_name, len(instances), len(added), len(removed), self.index)
+
+    def wait_ready(self, timeout=None):
+        """Block until the first catalog read has completed"""
+        return self.ready.wait(timeout)
+
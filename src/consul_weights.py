@@ -0,0 +1,208 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import http_transport
+
+# Weight writer configuration
+WEIGHT_TAG_PREFIX = "urlprefix-/api weight="
+TXN_MAX_OPS = 64  # Consul rejects transactions with more operations than this
+CAS_RETRIES = 2  # Re-read and retry instances whose ModifyIndex moved under us
+REGISTER_WORKERS = 8  # Agent re-registrations sent in parallel over the pooled session
+
+# Per-instance write results
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+CONFLICT = "conflict"
+MISSING = "missing"
+FAILED = "failed"
+
+
+def set_weight_tag(tags, weight):
+    """Return a copy of tags with the weight tag set to weight (added if absent)"""
+    new_tags = []
+    weight_updated = False
+    for tag in tags or []:
+        if WEIGHT_TAG_PREFIX in tag:
+            new_tags.append(f"{tag.split('weight=')[0]}weight={weight}")
+            weight_updated = True
+        else:
+            new_tags.append(tag)
+    if not weight_updated:
+        new_tags.append(f"{WEIGHT_TAG_PREFIX}{weight}")
+    return new_tags
+
+
+class ConsulWeightWriter:
+    """Writes weight tags for many instances of one service.
+
+    Services the agent owns are re-registered through
+    /v1/agent/service/register: a catalog-only edit of their tags would be
+    undone by the agent's anti-entropy sync. The registration is built from
+    the catalog entry, so this path costs one PUT per changed instance (sent
+    REGISTER_WORKERS at a time), plus one catalog read when no catalog is
+    passed in. Only entries with EnableTagOverride set are written through
+    /v1/txn, as catalog "cas" operations carrying the ModifyIndex they were
+    read at, so a registration edited since then is not overwritten: one
+    request per TXN_MAX_OPS changed instances, plus a catalog re-read and a
+    retry for each round of conflicts. Instances whose weight tag is already
+    current are skipped.
+    """
+
+    def __init__(self, consul_url, service_name):
+        self.consul_url = consul_url.rstrip("/")
+        self.service_name = service_name
+
+    def fetch_catalog(self):
+        """Read the raw catalog entries of the service"""
+        response = http_transport.get(f"{self.consul_url}/v1/catalog/service/{self.service_name}", verify=False)
+        response.raise_for_status()
+        return response.json()
+
+    def write(self, weights, catalog=None):
+        """Set weights ({service_id: weight}) and return {service_id: result}.
+
+        catalog is the raw /v1/catalog/service response to take tags,
+        EnableTagOverride and ModifyIndex values from; it is fetched when not given.
+        """
+        results = {}
+        if not weights:
+            return results
+
+        entries = catalog if catalog is not None else self.fetch_catalog()
+        by_id = {entry.get('ServiceID'): entry for entry in entries}
+        catalog_writes = {}
+        agent_writes = {}
+        for service_id, weight in weights.items():
+            entry = by_id.get(service_id)
+            if entry is None:
+                results[service_id] = MISSING
+            elif set_weight_tag(entry.get('ServiceTags'), weight) == (entry.get('ServiceTags') or []):
+                results[service_id] = UNCHANGED
+            elif entry.get('ServiceEnableTagOverride'):
+                catalog_writes[service_id] = weight
+            else:
+                agent_writes[service_id] = weight
+
+        if catalog_writes:
+            results.update(self.write_catalog(catalog_writes, entries))
+        if agent_writes:
+            results.update(self.register_all(agent_writes, by_id))
+        return results
+
+    def write_catalog(self, weights, entries):
+        """CAS-write tags of EnableTagOverride entries, re-reading and retrying on conflicts"""
+        results = {}
+        pending = dict(weights)
+        for attempt in range(CAS_RETRIES + 1):
+            by_id = {entry.get('ServiceID'): entry for entry in entries}
+            operations = []
+            for service_id, weight in pending.items():
+                entry = by_id.get(service_id)
+                if entry is None:
+                    results[service_id] = MISSING
+                    continue
+                tags = set_weight_tag(entry.get('ServiceTags'), weight)
+                operations.append((service_id, self.build_cas_operation(entry, tags)))
+
+            conflicts = {}
+            for start in range(0, len(operations), TXN_MAX_OPS):
+                chunk_results = self.submit(operations[start:start + TXN_MAX_OPS])
+                for service_id, result in chunk_results.items():
+                    if result == CONFLICT:
+                        conflicts[service_id] = pending[service_id]
+                    results[service_id] = result
+
+            if not conflicts or attempt == CAS_RETRIES:
+                break
+            logging.info("Retrying %d weight write(s) after CAS conflicts", len(conflicts))
+            pending = conflicts
+            entries = self.fetch_catalog()
+
+        return results
+
+    def register_all(self, weights, by_id):
+        """Re-register agent-owned instances in parallel; registration is synchronous, so its status is the result"""
+        with ThreadPoolExecutor(max_workers=min(REGISTER_WORKERS, len(weights)),
+                                thread_name_prefix="consul-register") as executor:
+            futures = {service_id: executor.submit(self.register, by_id[service_id], weight)
+                       for service_id, weight in weights.items()}
+        return {service_id: future.result() for service_id, future in futures.items()}
+
+    def register(self, entry, weight):
+        """Re-register an agent-owned catalog entry with the new weight tag"""
+        service_id = entry.get('ServiceID')
+        registration = {
+            "ID": service_id,
+            "Name": entry.get('ServiceName'),
+            "Tags": set_weight_tag(entry.get('ServiceTags'), weight),
+            "Address": entry.get('ServiceAddress'),
+            "Port": entry.get('ServicePort', 0),
+            "EnableTagOverride": entry.get('ServiceEnableTagOverride', False)
+        }
+        if entry.get('ServiceMeta'):
+            registration["Meta"] = entry['ServiceMeta']
+        try:
+            response = http_transport.put(f"{self.consul_url}/v1/agent/service/register",
+                                          json=registration, verify=False)
+        except Exception as e:
+            logging.error("Registering %s failed: %s", service_id, e)
+            return FAILED
+        if response.status_code != 200:
+            logging.error("Registering %s failed: %s %s", service_id, response.status_code, response.text)
+            return FAILED
+        return UPDATED
+
+    def build_cas_operation(self, entry, tags):
+        """Catalog cas operation that re-registers the entry with new tags"""
+        service = {
+            "ID": entry.get('ServiceID'),
+            "Service": entry.get('ServiceName'),
+            "Tags": tags,
+            "Address": entry.get('ServiceAddress') or entry.get('Address'),
+            "Port": entry.get('ServicePort', 0),
+            "EnableTagOverride": entry.get('ServiceEnableTagOverride', False),
+            "ModifyIndex": entry.get('ModifyIndex', 0)
+        }
+        if entry.get('ServiceMeta'):
+            service["Meta"] = entry['ServiceMeta']
+        return {"Service": {"Verb": "cas", "Node": entry.get('Node'), "Service": service}}
+
+    def submit(self, operations):
+        """Submit one transaction, splitting it until every operation has an outcome.
+
+        A transaction is all-or-nothing: when some operations fail, the failed
+        ones are marked and the rest are resubmitted on their own.
+        """
+        results = {}
+        while operations:
+            try:
+                response = http_transport.put(
+                    f"{self.consul_url}/v1/txn",
+                    json=[operation for _, operation in operations],
+                    verify=False
+                )
+            except Exception as e:
+                logging.error("Consul transaction failed: %s", e)
+                results.update((service_id, FAILED) for service_id, _ in operations)
+                break
+
+            if response.status_code == 200:
+                results.update((service_id, UPDATED) for service_id, _ in operations)
+                break
+
+            if response.status_code != 409:
+                logging.error("Consul transaction failed: %s %s", response.status_code, response.text)
+                results.update((service_id, FAILED) for service_id, _ in operations)
+                break
+
+            errors = response.json().get('Errors') or []
+            failed = {error.get('OpIndex') for error in errors}
+            if not failed:
+                results.update((service_id, FAILED) for service_id, _ in operations)
+                break
+            for error in errors:
+                service_id = operations[error.get('OpIndex')][0]
+                what = error.get('What', '')
+                logging.warning("Weight write for %s rejected: %s", service_id, what)
+                results[service_id] = CONFLICT if "index" in what.lower() else FAILED
+            operations = [operation for index, operation in enumerate(operations) if index not in failed]
+        return results
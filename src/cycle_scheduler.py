@@ -0,0 +1,114 @@
+import time
+import random
+import logging
+import instrumentation
+
+# Scheduling configuration
+MIN_INTERVAL = 60  # Seconds between cycles while weights are moving fast
+MAX_INTERVAL = 600  # Seconds between cycles while the fleet is stable
+STABLE_CHANGE = 1.0  # Mean score change (points of 100) at or below which the fleet counts as stable
+VOLATILE_CHANGE = 10.0  # Mean score change at or above which cycles run at MIN_INTERVAL
+VOLATILITY_SMOOTHING = 0.5  # EWMA factor applied to each cycle's change (1 = no smoothing)
+BACKOFF_BASE = 5  # Seconds before the first retry of a failed cycle
+BACKOFF_MAX = 300  # Longest wait after repeated failures
+PHASE_RETRIES = 2  # Extra attempts a retryable phase gets before the cycle fails
+PHASE_RETRY_DELAY = 1  # Seconds before the first phase retry (doubled per attempt)
+RETRY_PHASES = ("discover", "collect", "consul_update", "export")  # Phases safe to repeat in place
+RESUME_MAX_AGE = 120  # Seconds collected metrics stay fresh enough to resume a failed cycle
+
+INTERVAL_SECONDS = instrumentation.REGISTRY.gauge("lb_cycle_interval_seconds", "Interval chosen for the next cycle")
+VOLATILITY = instrumentation.REGISTRY.gauge("lb_fleet_volatility", "Smoothed mean score change between cycles")
+PHASE_RETRIES_TOTAL = instrumentation.REGISTRY.counter("lb_phase_retries_total", "Phase attempts repeated after an error",
+                                                       ("phase",))
+CONSECUTIVE_FAILURES = instrumentation.REGISTRY.gauge("lb_cycle_consecutive_failures", "Cycles failed since the last success")
+
+
+def score_change(previous, weights):
+    """Mean absolute change of weighted and per-metric scores for instances present in both cycles"""
+    weight_changes = []
+    metric_changes = []
+    for ip_address, weight_data in weights.items():
+        before = previous.get(ip_address)
+        if before is None:
+            continue
+        weight_changes.append(abs(weight_data['weighted_score'] - before['weighted_score']))
+        for metric, score in weight_data['scores'].items():
+            if metric in before['scores']:
+                metric_changes.append(abs(score - before['scores'][metric]))
+    if not weight_changes:
+        return None
+    change = sum(weight_changes) / len(weight_changes)
+    if metric_changes:
+        change = max(change, sum(metric_changes) / len(metric_changes))
+    return change
+
+
+def jittered(delay, rng=random):
+    """Equal jitter: half the delay fixed, the other half random, so retries do not synchronize"""
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+class AdaptiveScheduler:
+    """Chooses the wait before the next cycle and retries failing phases.
+
+    After a successful cycle the interval slides between MAX_INTERVAL (stable
+    fleet) and MIN_INTERVAL (volatile fleet) on the smoothed score change.
+    After a failed cycle it waits a jittered exponential backoff starting at
+    BACKOFF_BASE instead of a full interval.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, rng=None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.rng = rng or random.Random()
+        self.volatility = None
+        self.interval = self.max_interval
+        self.failures = 0
+
+    def interval_for(self, volatility):
+        if volatility is None:
+            return self.max_interval
+        position = (volatility - STABLE_CHANGE) / (VOLATILE_CHANGE - STABLE_CHANGE)
+        position = min(1.0, max(0.0, position))
+        return self.max_interval - position * (self.max_interval - self.min_interval)
+
+    def cycle_succeeded(self, previous_weights, weights):
+        """Record a successful cycle and return the interval until the next one"""
+        self.failures = 0
+        change = score_change(previous_weights, weights)
+        if change is not None:
+            if self.volatility is None:
+                self.volatility = change
+            else:
+                self.volatility += VOLATILITY_SMOOTHING * (change - self.volatility)
+            VOLATILITY.set(self.volatility)
+        self.interval = self.interval_for(self.volatility)
+        CONSECUTIVE_FAILURES.set(0)
+        INTERVAL_SECONDS.set(self.interval)
+        if change is not None:
+            logging.info(f"Score change {change:.2f} (smoothed {self.volatility:.2f}), "
+                         f"next interval {self.interval:.0f}s")
+        return self.interval
+
+    def cycle_failed(self):
+        """Record a failed cycle and return the backoff before retrying"""
+        self.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+        delay = min(jittered(delay, self.rng), self.interval)
+        CONSECUTIVE_FAILURES.set(self.failures)
+        INTERVAL_SECONDS.set(delay)
+        return delay
+
+    def run_phase(self, name, func, *args, **kwargs):
+        """Call one phase, retrying it in place with jittered backoff if it is in RETRY_PHASES"""
+        attempts = 1 + (PHASE_RETRIES if name in RETRY_PHASES else 0)
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt + 1 >= attempts:
+                    raise
+                delay = jittered(PHASE_RETRY_DELAY * 2 ** attempt, self.rng)
+                PHASE_RETRIES_TOTAL.inc(phase=name)
+                logging.warning(f"Phase {name} failed ({e}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+                time.sleep(delay)
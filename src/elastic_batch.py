@@ -0,0 +1,95 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import http_transport
+import query_costs
+
+# Batching configuration
+MSEARCH_BATCH_SIZE = 100  # Searches per _msearch request
+MSEARCH_WORKERS = 4  # _msearch requests allowed in flight at once
+
+
+def msearch(elastic_url, searches, auth, timeout=None, max_workers=MSEARCH_WORKERS, templates=None):
+    """Run (index, body) searches through _msearch and return one response per search, in order.
+
+    Searches are split into chunks of MSEARCH_BATCH_SIZE so a large fleet
+    costs a few round trips instead of one per instance. A failed item comes
+    back as {"error": ...} in its slot; a failed request raises. Each item's
+    took/shards/hits are recorded under its entry in templates.
+    """
+    if not searches:
+        return []
+
+    templates = list(templates or [None] * len(searches))
+    items = [(index, body, template or query_costs.template_of(body))
+             for (index, body), template in zip(searches, templates)]
+    chunks = [items[i:i + MSEARCH_BATCH_SIZE] for i in range(0, len(items), MSEARCH_BATCH_SIZE)]
+
+    def run_chunk(chunk):
+        lines = []
+        for index, body, template in chunk:
+            lines.append(json.dumps({"index": index} if index else {}, separators=(",", ":")))
+            lines.append(json.dumps(query_costs.prepare(template, body), separators=(",", ":")))
+        payload = "\n".join(lines) + "\n"
+
+        response = http_transport.post(
+            f"{elastic_url}/_msearch",
+            data=payload,
+            compress=True,
+            headers={"Content-Type": "application/x-ndjson"},
+            auth=auth,
+            timeout=timeout,
+            verify=False
+        )
+        try:
+            response.raise_for_status()
+        except Exception as err:
+            logging.error("Error in _msearch: %s", err)
+            logging.error("Response content: %s", response.text)
+            raise
+
+        responses = response.json().get("responses", [])
+        if len(responses) != len(chunk):
+            raise ValueError(f"_msearch returned {len(responses)} responses for {len(chunk)} searches")
+        for (_, _, template), item in zip(chunk, responses):
+            query_costs.record(template, item)
+        return responses
+
+    if len(chunks) == 1 or max_workers <= 1:
+        results = [run_chunk(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix="msearch") as pool:
+            results = list(pool.map(run_chunk, chunks))
+
+    return [item for chunk_result in results for item in chunk_result]
+
+
+class SearchBatch:
+    """Collects keyed searches for a cycle and executes them as _msearch round trips"""
+
+    def __init__(self, elastic_url, auth, timeout=None):
+        self.elastic_url = elastic_url
+        self.auth = auth
+        self.timeout = timeout
+        self.keys = []
+        self.searches = []
+        self.templates = []
+
+    def add(self, key, body, index=None, template=None):
+        self.keys.append(key)
+        self.searches.append((index, body))
+        self.templates.append(template)
+
+    def __len__(self):
+        return len(self.searches)
+
+    def execute(self):
+        """Send every queued search and return {key: response}"""
+        responses = msearch(self.elastic_url, self.searches, self.auth, timeout=self.timeout, templates=self.templates)
+        logging.debug("Executed %d searches in %d _msearch request(s)",
+                      len(self.searches), -(-len(self.searches) // MSEARCH_BATCH_SIZE))
+        results = dict(zip(self.keys, responses))
+        self.keys = []
+        self.searches = []
+        self.templates = []
+        return results
@@ -1,5 +1,9 @@
 import requests
+import http_transport
 import logging
+import query_costs
+from elastic_batch import SearchBatch
+from trend_estimator import trend_of
 
 class ElasticClient:
     def __init__(self, elastic_url, username, password):
@@ -8,8 +12,8 @@ class ElasticClient:
         self.username = username
         self.password = password
 
-    def fetch_metricbeat_logs(self, field, host_ip, start_time, end_time):
-        query = {
+    def build_metricbeat_query(self, host_ip, start_time, end_time):
+        return {
             "query": {
                 "bool": {
                     "must": [
@@ -19,10 +23,14 @@ class ElasticClient:
                 }
             }
         }
+
+    def fetch_metricbeat_logs(self, field, host_ip, start_time, end_time):
+        query = self.build_metricbeat_query(host_ip, start_time, end_time)
         logging.debug("Elastic Query for metricbeat logs: %s", query)
-        response = requests.post(
+        response = http_transport.post(
             f"{self.elastic_url}/_search",
-            json=query,
+            json=query_costs.prepare("metricbeat_by_host", query),
+            compress=True,
             auth=(self.username, self.password),
             verify=False
         )
@@ -34,6 +42,7 @@ class ElasticClient:
             logging.error("Response content: %s", response.text)
             raise
         result = response.json()
+        query_costs.record("metricbeat_by_host", result, response.elapsed.total_seconds())
         #logging.debug("Elastic response data (metricbeat): %s", result)
         return result
 
@@ -41,17 +50,15 @@ class ElasticClient:
         return sum(values) / len(values) if values else 0
 
     def calculate_trend(self, usage_data):
-        if len(usage_data) < 2:
-            return 0
-        start_value = usage_data[0]
-        end_value = usage_data[-1]
-        if start_value == 0:
-            return 0
-        raw_trend = (end_value - start_value) / start_value
-        return max(-1, min(1, raw_trend))
+        # Fitted over every sample, so one noisy endpoint cannot flip the trend
+        trend, _ = trend_of(usage_data)
+        return trend
 
     def get_cpu_ram_metrics(self, host_ip, start_time, end_time):
         logs = self.fetch_metricbeat_logs("cpu", host_ip, start_time, end_time)
+        return self.parse_cpu_ram_metrics(logs)
+
+    def parse_cpu_ram_metrics(self, logs):
         hits = logs.get('hits', {}).get('hits', [])
         logging.debug("Number of Metricbeat hits returned: %d", len(hits))
         cpu_values = []
@@ -83,8 +90,8 @@ class ElasticClient:
             "ram_trend": self.calculate_trend(ram_values)
         }
     
-    def get_zeek_avg_conn_duration(self, lb_ip, service_ip, start_time, end_time):
-        query = {
+    def build_zeek_conn_query(self, lb_ip, service_ip, start_time, end_time):
+        return {
             "query": {
                 "bool": {
                     "must": [
@@ -114,10 +121,14 @@ class ElasticClient:
                 }
             }
         }
+
+    def get_zeek_avg_conn_duration(self, lb_ip, service_ip, start_time, end_time):
+        query = self.build_zeek_conn_query(lb_ip, service_ip, start_time, end_time)
         logging.debug("Elastic Query for Zeek logs: %s", query)
-        response = requests.post(
+        response = http_transport.post(
             f"{self.elastic_url}/_search",
-            json=query,
+            json=query_costs.prepare("zeek_conn_by_host", query),
+            compress=True,
             auth=(self.username, self.password),
             verify=False
         )
@@ -128,7 +139,11 @@ class ElasticClient:
             logging.error("Error in get_zeek_avg_conn_duration: %s", err)
             logging.error("Response content (Zeek): %s", response.text)
             raise
-        logs = response.json()
+        result = response.json()
+        query_costs.record("zeek_conn_by_host", result, response.elapsed.total_seconds())
+        return self.parse_zeek_avg_conn_duration(result)
+
+    def parse_zeek_avg_conn_duration(self, logs):
         # Log the number of Zeek hits
         zeek_hits = logs.get('hits', {}).get('hits', [])
         logging.debug("Number of Zeek hits returned: %d", len(zeek_hits))
@@ -138,4 +153,25 @@ class ElasticClient:
             duration = hit['_source'].get("conn", {}).get("duration")
             if duration is not None:
                 durations.append(duration)
-        return sum(durations) / len(durations) if durations else 0
\ No newline at end of file
+        return sum(durations) / len(durations) if durations else 0
+
+    def get_metrics_batch(self, lb_ip, service_ips, start_time, end_time):
+        """Fetch CPU/RAM and Zeek duration metrics for every service IP in one _msearch pass"""
+        batch = SearchBatch(self.elastic_url, (self.username, self.password))
+        for service_ip in service_ips:
+            batch.add((service_ip, "metricbeat"), self.build_metricbeat_query(service_ip, start_time, end_time),
+                      template="metricbeat_by_host")
+            batch.add((service_ip, "zeek"), self.build_zeek_conn_query(lb_ip, service_ip, start_time, end_time),
+                      template="zeek_conn_by_host")
+        responses = batch.execute()
+
+        metrics = {}
+        for service_ip in service_ips:
+            metricbeat_logs = responses[(service_ip, "metricbeat")]
+            zeek_logs = responses[(service_ip, "zeek")]
+            for source, logs in (("metricbeat", metricbeat_logs), ("zeek", zeek_logs)):
+                if "error" in logs:
+                    logging.error("Error in %s search for %s: %s", source, service_ip, logs["error"])
+            metrics[service_ip] = self.parse_cpu_ram_metrics(metricbeat_logs)
+            metrics[service_ip]["avg_connection_duration"] = self.parse_zeek_avg_conn_duration(zeek_logs)
+        return metrics
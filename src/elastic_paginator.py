@@ -0,0 +1,116 @@
+import json
+import logging
+import http_transport
+import query_costs
+
+# Pagination configuration
+PAGE_SIZE = 1000  # Hits fetched per round trip
+PIT_KEEP_ALIVE = "2m"  # How long Elasticsearch keeps the point-in-time open between pages
+DEFAULT_INDEX = "*"  # Index pattern the point-in-time is opened on
+DEFAULT_SORT = [{"@timestamp": {"order": "asc"}}]
+
+
+def open_point_in_time(elastic_url, auth, index=DEFAULT_INDEX, keep_alive=PIT_KEEP_ALIVE):
+    """Open a point-in-time and return its id"""
+    response = http_transport.post(
+        f"{elastic_url}/{index}/_pit",
+        params={"keep_alive": keep_alive},
+        auth=auth,
+        verify=False
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def close_point_in_time(elastic_url, auth, pit_id):
+    """Release a point-in-time; failures are logged, never raised"""
+    try:
+        http_transport.delete(f"{elastic_url}/_pit", json={"id": pit_id}, auth=auth, verify=False)
+    except Exception as err:
+        logging.warning("Could not close point-in-time: %s", err)
+
+
+def iter_pages(elastic_url, query, auth, index=DEFAULT_INDEX, page_size=PAGE_SIZE, sort=None, max_hits=None,
+               template=None):
+    """Yield pages (lists of hits) for a query using point-in-time + search_after.
+
+    Only one page is held in memory at a time. Any size/sort in the query is
+    replaced: sort comes from the sort argument, the query's own sort, or
+    @timestamp ascending, with _shard_doc appended as the tiebreaker. Each
+    page's cost is recorded under template.
+    """
+    body = {key: value for key, value in query.items() if key not in ("size", "sort", "from")}
+    sort = list(sort or query.get("sort") or DEFAULT_SORT) + [{"_shard_doc": "asc"}]
+    template = template or query_costs.template_of(body)
+
+    pit_id = open_point_in_time(elastic_url, auth, index)
+    fetched = 0
+    search_after = None
+    try:
+        while True:
+            size = page_size if max_hits is None else min(page_size, max_hits - fetched)
+            if size <= 0:
+                return
+
+            page_body = dict(body, size=size, sort=sort, track_total_hits=False,
+                             pit={"id": pit_id, "keep_alive": PIT_KEEP_ALIVE})
+            if search_after is not None:
+                page_body["search_after"] = search_after
+
+            response = http_transport.post(
+                f"{elastic_url}/_search",
+                json=query_costs.prepare(template, page_body),
+                compress=True,
+                auth=auth,
+                verify=False
+            )
+            response.raise_for_status()
+            result = response.json()
+            query_costs.record(template, result, response.elapsed.total_seconds())
+
+            # Elasticsearch may hand back a refreshed PIT id with each page
+            pit_id = result.get("pit_id", pit_id)
+            hits = result.get("hits", {}).get("hits", [])
+            if not hits:
+                return
+
+            fetched += len(hits)
+            yield hits
+
+            if len(hits) < size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        close_point_in_time(elastic_url, auth, pit_id)
+
+
+def iter_hits(elastic_url, query, auth, **kwargs):
+    """Yield hits one at a time across all pages"""
+    for page in iter_pages(elastic_url, query, auth, **kwargs):
+        yield from page
+
+
+class HitsJsonWriter:
+    """Streams hits into a search-response shaped JSON file without holding them in memory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "w")
+        self._file.write('{\n    "hits": {\n        "hits": [')
+        return self
+
+    def write(self, hit):
+        self._file.write(",\n" if self.count else "\n")
+        self._file.write(json.dumps(hit))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.write('\n        ],\n        "total": ')
+        self._file.write(json.dumps({"value": self.count, "relation": "eq"}))
+        self._file.write('\n    }\n}\n')
+        self._file.close()
+        return False
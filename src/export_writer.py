@@ -0,0 +1,155 @@
+import copy
+import time
+import logging
+import threading
+from collections import deque
+
+# Export writer configuration
+EXPORT_QUEUE_SIZE = 4  # Pending batches before the overflow policy kicks in
+MAX_MERGED_CYCLES = 32  # Cycles a merged batch may hold before its oldest are dropped
+OVERFLOW_POLICY = "merge"  # "merge", "drop_oldest" or "drop_newest"
+
+# submit() outcomes
+QUEUED = "queued"
+MERGED = "merged"
+DROPPED = "dropped"
+
+
+class CycleSnapshot:
+    """Immutable copy of one cycle's results, safe to persist while the next cycle runs"""
+
+    __slots__ = ("timestamp", "service_name", "weights", "instance_metrics")
+
+    def __init__(self, service_name, weights, instance_metrics, timestamp=None):
+        object.__setattr__(self, "timestamp", timestamp or time.time())
+        object.__setattr__(self, "service_name", service_name)
+        object.__setattr__(self, "weights", copy.deepcopy(weights))
+        object.__setattr__(self, "instance_metrics", copy.deepcopy(instance_metrics))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CycleSnapshot is immutable")
+
+
+class ExportWriter(threading.Thread):
+    """Persists cycle snapshots on a background thread.
+
+    submit() never blocks the control loop. Snapshots wait in a bounded queue
+    of batches; when it is full the overflow policy decides what gives:
+    "merge" folds the snapshot into the newest batch (written in one go,
+    capped at MAX_MERGED_CYCLES), "drop_oldest" discards the oldest batch and
+    "drop_newest" discards the new snapshot. While a backlog exists the
+    optional per-cycle artifacts (export_artifacts) are skipped so the writer
+    catches up on the history store first.
+    """
+
+    def __init__(self, history, export_artifacts=None, queue_size=EXPORT_QUEUE_SIZE, policy=OVERFLOW_POLICY):
+        super().__init__(name="export-writer", daemon=True)
+        if policy not in ("merge", "drop_oldest", "drop_newest"):
+            raise ValueError(f"unknown overflow policy: {policy}")
+        self.history = history
+        self.export_artifacts = export_artifacts
+        self.queue_size = queue_size
+        self.policy = policy
+        self.batches = deque()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.stopping = False
+        self.stats = {"written": 0, "merged": 0, "dropped": 0, "failed": 0, "skipped_artifacts": 0}
+
+    def submit(self, snapshot):
+        """Queue a snapshot without blocking; returns QUEUED, MERGED or DROPPED"""
+        with self.condition:
+            outcome = QUEUED
+            if len(self.batches) < self.queue_size:
+                self.batches.append([snapshot])
+            elif self.policy == "merge":
+                newest = self.batches[-1]
+                newest.append(snapshot)
+                outcome = MERGED
+                self.stats["merged"] += 1
+                if len(newest) > MAX_MERGED_CYCLES:
+                    del newest[0]
+                    self.stats["dropped"] += 1
+            elif self.policy == "drop_oldest":
+                dropped = self.batches.popleft()
+                self.batches.append([snapshot])
+                self.stats["dropped"] += len(dropped)
+            else:
+                outcome = DROPPED
+                self.stats["dropped"] += 1
+            self.condition.notify()
+
+        if outcome != QUEUED:
+            logging.warning("Export backlog full (%d batches), snapshot %s", self.queue_size, outcome)
+        return outcome
+
+    def backlog(self):
+        """Snapshots waiting to be written"""
+        with self.condition:
+            return sum(len(batch) for batch in self.batches)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batches and not self.stopping:
+                    self.condition.wait()
+                if not self.batches:
+                    return
+                batch = self.batches.popleft()
+                backlogged = bool(self.batches)
+                self.busy = True
+
+            try:
+                self.write_batch(batch, backlogged)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def write_batch(self, batch, backlogged):
+        started = time.time()
+        for snapshot in batch:
+            try:
+                self.history.record_cycle(snapshot.service_name, snapshot.weights,
+                                          snapshot.instance_metrics, snapshot.timestamp)
+                self.stats["written"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logging.error("Could not record cycle %s in history: %s", snapshot.timestamp, e)
+
+        try:
+            removed, compacted = self.history.apply_retention()
+            if removed or compacted:
+                logging.info("History retention: removed %d, compacted %d partitions", removed, compacted)
+        except Exception as e:
+            logging.error("History retention failed: %s", e)
+
+        if self.export_artifacts is not None:
+            if backlogged or len(batch) > 1:
+                self.stats["skipped_artifacts"] += len(batch)
+            else:
+                try:
+                    self.export_artifacts(batch[-1])
+                except Exception as e:
+                    logging.error("Could not export cycle artifacts: %s", e)
+
+        logging.info("Recorded %d cycle(s) in history store in %.2fs", len(batch), time.time() - started)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is written; returns False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.batches or self.busy:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Write what is queued, then stop the thread"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(timeout)
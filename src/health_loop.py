@@ -0,0 +1,168 @@
+import time
+import logging
+import datetime
+import threading
+import http_transport
+import query_costs
+import instrumentation
+from query_zeek_logs import build_conn_aggregation_query, parse_conn_aggregation
+
+# Fast loop configuration
+HEALTH_INTERVAL = 5  # Seconds between fast health checks
+HEALTH_WINDOW = 60  # Seconds of Zeek conn logs aggregated per check
+MIN_CONNECTIONS = 20  # Connections needed in the window before error/latency signals count
+ERROR_RATIO_LIMIT = 0.1  # Error ratio tolerated before the weight is cut
+ERROR_RATIO_DRAIN = 0.5  # Error ratio at which the weight is cut to the minimum
+LATENCY_RATIO_LIMIT = 2.0  # Window latency tolerated as a multiple of the slow loop's average
+WARNING_FACTOR = 0.5  # Weight kept by instances with a Consul check in warning
+RECOVERY_STEP = 0.25  # Largest rise of an instance's health factor per check (cuts apply at once)
+
+HEALTH_FACTOR = instrumentation.REGISTRY.gauge("lb_health_factor", "Share of the scored weight the fast loop allows",
+                                               ("instance",))
+HEALTH_CHECK_SECONDS = instrumentation.REGISTRY.histogram("lb_health_check_duration_seconds",
+                                                          "Wall time of fast health checks")
+
+
+def consul_statuses(checks):
+    """Collapse /v1/health/checks entries into {service_id: worst status}"""
+    rank = {"passing": 0, "warning": 1, "critical": 2}
+    statuses = {}
+    for check in checks:
+        service_id = check.get("ServiceID")
+        status = check.get("Status", "passing")
+        if service_id and rank.get(status, 0) >= rank.get(statuses.get(service_id), -1):
+            statuses[service_id] = status
+    return statuses
+
+
+def target_factor(signal, baseline_latency_ms):
+    """Share (0-1) of the scored weight an instance may keep given its fast signals"""
+    factor = 1.0
+    status = signal.get("consul_status")
+    if status == "critical":
+        return 0.0
+    if status == "warning":
+        factor = WARNING_FACTOR
+
+    if signal.get("connections", 0) >= MIN_CONNECTIONS:
+        error_ratio = signal.get("error_ratio", 0)
+        if error_ratio > ERROR_RATIO_LIMIT:
+            cut = (error_ratio - ERROR_RATIO_LIMIT) / (ERROR_RATIO_DRAIN - ERROR_RATIO_LIMIT)
+            factor = min(factor, max(0.0, 1 - cut))
+
+        latency_ms = signal.get("latency_ms")
+        if latency_ms and baseline_latency_ms:
+            ratio = latency_ms / baseline_latency_ms
+            if ratio > LATENCY_RATIO_LIMIT:
+                factor = min(factor, LATENCY_RATIO_LIMIT / ratio)
+    return factor
+
+
+class HealthMonitor:
+    """Reads cheap per-instance signals and keeps a health factor per instance.
+
+    The factor multiplies the slow loop's scored weight, so the fast loop can
+    only lower weights. Cuts take effect on the next check; recovery is
+    limited to RECOVERY_STEP per check so a flapping backend is not handed
+    its full weight back at once.
+    """
+
+    def __init__(self, elastic_url, auth, consul_url, service_name):
+        self.elastic_url = elastic_url
+        self.auth = auth
+        self.consul_url = consul_url.rstrip("/")
+        self.service_name = service_name
+        self.factors = {}
+
+    def read_zeek(self, ip_addresses):
+        """Error ratio and mean duration per IP over the last HEALTH_WINDOW seconds"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        start = now - datetime.timedelta(seconds=HEALTH_WINDOW)
+        # Only the mean latency is compared here, so skip the per-document sketch bins script
+        query = build_conn_aggregation_query(ip_addresses, start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                             now.strftime('%Y-%m-%dT%H:%M:%S.000Z'), duration_bins=False)
+        response = http_transport.post(
+            f"{self.elastic_url}/_search",
+            json=query_costs.prepare("zeek_health", query),
+            compress=True,
+            auth=self.auth,
+            timeout=(http_transport.CONNECT_TIMEOUT, HEALTH_INTERVAL),
+            verify=False
+        )
+        response.raise_for_status()
+        result = response.json()
+        query_costs.record("zeek_health", result, response.elapsed.total_seconds())
+        return parse_conn_aggregation(result)
+
+    def read_consul(self):
+        """Worst check status per service ID"""
+        response = http_transport.get(f"{self.consul_url}/v1/health/checks/{self.service_name}",
+                                      timeout=(http_transport.CONNECT_TIMEOUT, HEALTH_INTERVAL), verify=False)
+        response.raise_for_status()
+        return consul_statuses(response.json())
+
+    def read_signals(self, instances):
+        """{ip: signal} for instances given as {ip: service_id}; a failed source is left out"""
+        signals = {ip_address: {} for ip_address in instances}
+        try:
+            for ip_address, aggregate in self.read_zeek(list(instances)).items():
+                if ip_address not in signals:
+                    continue
+                signals[ip_address]["connections"] = aggregate['count']
+                signals[ip_address]["error_ratio"] = aggregate['error_ratio']
+                if aggregate['duration_count'] > 0:
+                    signals[ip_address]["latency_ms"] = aggregate['avg_duration'] * 1000
+        except Exception as e:
+            logging.warning(f"Health check could not read Zeek signals: {e}")
+        try:
+            statuses = self.read_consul()
+            for ip_address, service_id in instances.items():
+                if service_id in statuses:
+                    signals[ip_address]["consul_status"] = statuses[service_id]
+        except Exception as e:
+            logging.warning(f"Health check could not read Consul checks: {e}")
+        return signals
+
+    def update(self, signals, baselines):
+        """Move each factor toward its target; returns the IPs whose factor changed"""
+        changed = []
+        for ip_address, signal in signals.items():
+            target = target_factor(signal, baselines.get(ip_address))
+            current = self.factors.get(ip_address, 1.0)
+            factor = target if target < current else min(target, current + RECOVERY_STEP)
+            if factor != current:
+                changed.append(ip_address)
+                if factor < current:
+                    logging.warning(f"Health factor for {ip_address} cut to {factor:.2f} ({signal})")
+            self.factors[ip_address] = factor
+            HEALTH_FACTOR.set(factor, instance=ip_address)
+        for ip_address in [ip for ip in self.factors if ip not in signals]:
+            del self.factors[ip_address]
+        HEALTH_FACTOR.retain("instance", set(self.factors))
+        return changed
+
+    def factor(self, ip_address):
+        return self.factors.get(ip_address, 1.0)
+
+
+class HealthLoop(threading.Thread):
+    """Calls check() every HEALTH_INTERVAL seconds until stopped"""
+
+    def __init__(self, check, interval=HEALTH_INTERVAL):
+        super().__init__(name="health-loop", daemon=True)
+        self.check = check
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            try:
+                with HEALTH_CHECK_SECONDS.time():
+                    self.check()
+            except Exception as e:
+                logging.error(f"Error in health check: {e}")
+            self.stopping.wait(max(0, self.interval - (time.monotonic() - started)))
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import sqlite3
+import datetime
+import numbers
+from contextlib import closing
+import pandas as pd
+
+# History store configuration
+HISTORY_DIR = "history"  # One SQLite partition per UTC day lives here
+RETENTION_DAYS = 30  # Partitions older than this are deleted
+COMPACT_AFTER_DAYS = 7  # Partitions older than this are downsampled to hourly rows
+COMPACT_BUCKET_SECONDS = 3600
+EXPORT_DAYS = 7  # History included by the command-line Excel export
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS weights (
+    ts REAL NOT NULL,
+    service TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    node_name TEXT,
+    service_id TEXT,
+    weighted_score REAL,
+    final_weight INTEGER
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    ts REAL NOT NULL,
+    service TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS weights_ip_ts ON weights (ip, ts);
+CREATE INDEX IF NOT EXISTS metrics_ip_ts ON metrics (ip, ts);
+CREATE INDEX IF NOT EXISTS metrics_ts ON metrics (ts);
+"""
+
+
+def _day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+
+
+def _timestamp(value):
+    """Accept epoch seconds, datetimes or None"""
+    if value is None or isinstance(value, numbers.Number):
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+class HistoryStore:
+    """Append-only history of per-cycle metrics, scores and weights.
+
+    Rows go into one SQLite file per UTC day, so range reads only open the
+    days they cover and retention is a file delete. Metrics and scores are
+    stored narrow (one row per instance, kind and name) so profiles can add
+    metrics without schema changes; reads pivot them back into columns.
+    """
+
+    def __init__(self, directory=HISTORY_DIR, retention_days=RETENTION_DAYS, compact_after_days=COMPACT_AFTER_DAYS):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.compact_after_days = compact_after_days
+        os.makedirs(directory, exist_ok=True)
+
+    def partition_path(self, day):
+        return os.path.join(self.directory, f"{day.isoformat()}.sqlite")
+
+    def partitions(self, start=None, end=None):
+        """(day, path) of every partition overlapping [start, end], oldest first"""
+        first = _day(start) if start is not None else None
+        last = _day(end) if end is not None else None
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".sqlite"):
+                continue
+            try:
+                day = datetime.date.fromisoformat(name[:-len(".sqlite")])
+            except ValueError:
+                continue
+            if (first is None or day >= first) and (last is None or day <= last):
+                result.append((day, os.path.join(self.directory, name)))
+        return result
+
+    def connect(self, path):
+        connection = sqlite3.connect(path)
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def record_cycle(self, service_name, weights, instance_metrics, timestamp=None):
+        """Append one cycle: weights per instance plus every numeric raw metric and score"""
+        timestamp = timestamp or time.time()
+        weight_rows = []
+        metric_rows = []
+        for ip_address, weight_data in weights.items():
+            weight_rows.append((
+                timestamp, service_name, ip_address,
+                weight_data.get('node_name'), weight_data.get('service_id'),
+                weight_data.get('weighted_score'), weight_data.get('final_weight')
+            ))
+            for name, score in weight_data.get('scores', {}).items():
+                metric_rows.append((timestamp, service_name, ip_address, "score", name, score))
+            for name, value in instance_metrics.get(ip_address, {}).items():
+                if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                    metric_rows.append((timestamp, service_name, ip_address, "raw", name, value))
+
+        with closing(self.connect(self.partition_path(_day(timestamp)))) as connection, connection:
+            connection.executemany("INSERT INTO weights VALUES (?, ?, ?, ?, ?, ?, ?)", weight_rows)
+            connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?)", metric_rows)
+        return len(weight_rows)
+
+    def _read(self, table, start, end, ip_address, service_name, extra=None, extra_params=()):
+        start, end = _timestamp(start), _timestamp(end)
+        clauses, params = [], []
+        for clause, value in (("ts >= ?", start), ("ts <= ?", end), ("ip = ?", ip_address), ("service = ?", service_name)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if extra:
+            clauses.append(extra)
+            params.extend(extra_params)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        frames = []
+        for _, path in self.partitions(start, end):
+            with closing(sqlite3.connect(path)) as connection:
+                frames.append(pd.read_sql_query(f"SELECT * FROM {table}{where} ORDER BY ts", connection, params=params))
+        if not frames:
+            return pd.DataFrame()
+        frame = pd.concat(frames, ignore_index=True)
+        frame['timestamp'] = pd.to_datetime(frame['ts'], unit='s', utc=True)
+        return frame
+
+    def weights_history(self, start=None, end=None, ip_address=None, service_name=None):
+        """Final and weighted scores per instance and cycle in [start, end]"""
+        return self._read("weights", start, end, ip_address, service_name)
+
+    def metrics_history(self, start=None, end=None, ip_address=None, service_name=None, kind=None, names=None):
+        """Long-format metric rows (kind 'raw' or 'score'), optionally limited to some names"""
+        extra, extra_params = [], []
+        if kind is not None:
+            extra.append("kind = ?")
+            extra_params.append(kind)
+        if names:
+            extra.append(f"name IN ({', '.join('?' * len(names))})")
+            extra_params.extend(names)
+        return self._read("metrics", start, end, ip_address, service_name, " AND ".join(extra) or None, extra_params)
+
+    def cycle_table(self, start=None, end=None, ip_address=None, service_name=None):
+        """One row per instance and cycle with weights, '<metric> Score' and '<metric> Raw' columns"""
+        weights = self.weights_history(start, end, ip_address, service_name)
+        if weights.empty:
+            return weights
+        metrics = self.metrics_history(start, end, ip_address, service_name)
+        table = weights.rename(columns={
+            'ip': 'IP Address', 'node_name': 'Node Name', 'service_id': 'Service ID',
+            'final_weight': 'Final Weight', 'weighted_score': 'Weighted Score'
+        })
+        if not metrics.empty:
+            metrics['column'] = metrics['name'] + metrics['kind'].map({"score": " Score", "raw": " Raw"})
+            wide = metrics.pivot_table(index=['ts', 'ip'], columns='column', values='value', aggfunc='last')
+            wide.columns.name = None
+            table = table.merge(wide, left_on=['ts', 'IP Address'], right_index=True, how='left')
+        table['timestamp'] = table['timestamp'].dt.tz_localize(None)
+        return table.drop(columns=['ts']).rename(columns={'timestamp': 'Timestamp', 'service': 'Service'})
+
+    def export_excel(self, excel_file, start=None, end=None, ip_address=None, service_name=None):
+        """Render stored cycles to an Excel workbook on demand; returns the number of rows written"""
+        table = self.cycle_table(start, end, ip_address, service_name)
+        if table.empty:
+            return 0
+
+        writer = pd.ExcelWriter(excel_file, engine='openpyxl')
+        table.to_excel(writer, index=False, sheet_name='Weights')
+        for column in table:
+            column_length = max(table[column].astype(str).map(len).max(), len(column))
+            col_idx = table.columns.get_loc(column)
+            letter = writer.sheets['Weights'].cell(row=1, column=col_idx + 1).column_letter
+            writer.sheets['Weights'].column_dimensions[letter].width = column_length + 2
+        writer.close()
+        return len(table)
+
+    def apply_retention(self, now=None):
+        """Delete partitions past retention and downsample those past the compaction age"""
+        today = _day(now or time.time())
+        removed = compacted = 0
+        for day, path in self.partitions():
+            age = (today - day).days
+            if age > self.retention_days:
+                os.remove(path)
+                removed += 1
+            elif age > self.compact_after_days and self.compact(path):
+                compacted += 1
+        return removed, compacted
+
+    def compact(self, path):
+        """Replace a partition's rows by hourly averages (once); returns True if it compacted"""
+        bucket = COMPACT_BUCKET_SECONDS
+        with closing(self.connect(path)) as connection:
+            if connection.execute("SELECT value FROM meta WHERE key = 'compacted'").fetchone():
+                return False
+            with connection:
+                connection.execute("""
+                    CREATE TEMP TABLE compact_weights AS
+                    SELECT CAST(ts / ? AS INTEGER) * ? AS ts, service, ip, MAX(node_name), MAX(service_id),
+                           AVG(weighted_score), CAST(ROUND(AVG(final_weight)) AS INTEGER)
+                    FROM weights GROUP BY 1, service, ip
+                """, (bucket, bucket))
+                connection.execute("""
+                    CREATE TEMP TABLE compact_metrics AS
+                    SELECT CAST(ts / ? AS INTEGER) * ? AS ts, service, ip, kind, name, AVG(value)
+                    FROM metrics GROUP BY 1, service, ip, kind, name
+                """, (bucket, bucket))
+                connection.execute("DELETE FROM weights")
+                connection.execute("DELETE FROM metrics")
+                connection.execute("INSERT INTO weights SELECT * FROM compact_weights")
+                connection.execute("INSERT INTO metrics SELECT * FROM compact_metrics")
+                connection.execute("INSERT INTO meta VALUES ('compacted', ?)", (str(bucket),))
+            connection.execute("VACUUM")
+        return True
+
+
+if __name__ == "__main__":
+    # python history_store.py [ip_address] -- export the last EXPORT_DAYS of history to Excel
+    ip_address = sys.argv[1] if len(sys.argv) > 1 else None
+    store = HistoryStore()
+    since = time.time() - EXPORT_DAYS * 86400
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    suffix = f"_{ip_address.replace('.', '_')}" if ip_address else ""
+    excel_file = f"load_balancing_history{suffix}_{timestamp}.xlsx"
+    rows = store.export_excel(excel_file, start=since, ip_address=ip_address)
+    print(f"Exported {rows} rows to {excel_file}" if rows else "No history to export")
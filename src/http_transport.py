@@ -0,0 +1,144 @@
+import gzip
+import json
+import time
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import InsecureRequestWarning
+import instrumentation
+requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+
+# Transport configuration
+CONNECT_TIMEOUT = 3.05  # Seconds allowed for the TCP/TLS handshake
+READ_TIMEOUT = 30  # Seconds allowed between bytes of the response
+CONNECT_RETRIES = 2  # Retries on connection errors only (never on reads)
+DEFAULT_POOL_SIZE = 10  # Keep-alive connections kept open per host
+HOST_POOL_SIZES = {}  # Per-host overrides, e.g. {"10.100.0.7:9200": 32}
+COMPRESS_MIN_BYTES = 1024  # Request bodies smaller than this are sent uncompressed
+HOST_LABELS = {}  # Backend names used in metrics, e.g. {"10.100.0.7:9200": "elasticsearch"}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _host_key(url):
+    """Return the scheme://host:port prefix that identifies a connection pool"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url):
+    """Return the shared keep-alive session for the host of the given URL"""
+    key = _host_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = HOST_POOL_SIZES.get(urlsplit(url).netloc, DEFAULT_POOL_SIZE)
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                max_retries=Retry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0,
+                                  status=0, other=0, backoff_factor=0.1),
+                pool_block=False
+            )
+            session = requests.Session()
+            session.mount(key, adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    """Close every pooled session; the next request to a host opens a fresh one"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def request(method, url, json=None, compress=False, timeout=None, verify=False, headers=None, **kwargs):
+    """Send a request over the pooled session for the URL's host.
+
+    JSON bodies are gzip-compressed when compress=True and the body is large
+    enough to be worth it (Elasticsearch accepts Content-Encoding: gzip, the
+    Consul agent does not). Responses are decompressed transparently.
+    """
+    request_headers = dict(headers or {})
+    data = kwargs.pop("data", None)
+
+    if json is not None:
+        data = _json_dumps(json)
+        request_headers.setdefault("Content-Type", "application/json")
+
+    if compress and data is not None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if len(data) >= COMPRESS_MIN_BYTES:
+            data = gzip.compress(data, compresslevel=5)
+            request_headers["Content-Encoding"] = "gzip"
+
+    netloc = urlsplit(url).netloc
+    backend = HOST_LABELS.get(netloc, netloc)
+    started = time.perf_counter()
+    try:
+        response = get_session(url).request(
+            method,
+            url,
+            data=data,
+            headers=request_headers,
+            timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT),
+            verify=verify,
+            **kwargs
+        )
+    except requests.RequestException as e:
+        instrumentation.HTTP_REQUESTS.inc(backend=backend, method=method, status="error")
+        instrumentation.HTTP_ERRORS.inc(backend=backend, kind=type(e).__name__)
+        raise
+    finally:
+        instrumentation.HTTP_SECONDS.observe(time.perf_counter() - started, backend=backend)
+
+    _record_exchange(backend, method, data, response)
+    return response
+
+
+def _record_exchange(backend, method, data, response):
+    instrumentation.HTTP_REQUESTS.inc(backend=backend, method=method, status=response.status_code)
+    if data is not None:
+        instrumentation.HTTP_BYTES_SENT.inc(len(data), backend=backend)
+    received = response.headers.get("Content-Length")
+    instrumentation.HTTP_BYTES_RECEIVED.inc(int(received) if received else len(response.content), backend=backend)
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        instrumentation.HTTP_RETRIES.inc(len(retries.history), backend=backend)
+    if response.status_code >= 400:
+        instrumentation.HTTP_ERRORS.inc(backend=backend, kind=str(response.status_code))
+
+
+def get(url, **kwargs):
+    """GET over the pooled session"""
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """POST over the pooled session"""
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    """PUT over the pooled session"""
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    """DELETE over the pooled session"""
+    return request("DELETE", url, **kwargs)
+
+
+def _json_dumps(payload):
+    return json.dumps(payload, separators=(",", ":"))
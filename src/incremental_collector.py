@@ -0,0 +1,374 @@
+import json
+import logging
+import os
+import datetime
+from elastic_paginator import iter_hits
+from query_zeek_logs import ERROR_CONN_STATES
+from query_metricbeat import relative_change
+from network_rates import counter_delta, host_capacity, CAPACITY_SLACK
+from latency_sketch import DurationSketch, merge_sketches
+
+# Incremental collection configuration
+STATE_FILE = "collector_state.json"  # Watermarks and running aggregates, reloaded on restart
+BUCKET_SECONDS = 60  # Granularity at which old data expires from the running aggregates
+COUNTER_MAX_GAP = BUCKET_SECONDS  # Seconds between counter samples beyond which no delta is taken
+# Seconds re-read behind each watermark: Zeek stamps a conn record with its start time but writes it when
+# the connection closes, and ingest lag delivers documents of either source out of order
+LATENESS_SECONDS = {"zeek": 300, "metricbeat": 60}
+
+ZEEK_SOURCE_FIELDS = [
+    "@timestamp", "conn.id.orig_h", "conn.id.resp_h", "conn.duration",
+    "conn.orig_bytes", "conn.resp_bytes", "conn.conn_state"
+]
+METRICBEAT_SOURCE_FIELDS = [
+    "@timestamp", "host.ip", "metricset.name", "system.cpu.total.norm.pct",
+    "system.memory.actual.used.pct", "system.network.name",
+    "system.network.in.bytes", "system.network.out.bytes"
+]
+
+
+def _parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _format_timestamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _get_path(source, path):
+    """Read a dotted field from a _source document (nested or flattened)"""
+    if path in source:
+        return source[path]
+    value = source
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+class IncrementalCollector:
+    """Keeps per-host, per-source watermarks and folds only new documents into windowed aggregates.
+
+    State per source and host is a watermark (latest @timestamp folded, plus
+    the _ids folded within LATENESS_SECONDS of it) and a dict of
+    BUCKET_SECONDS-wide partial aggregates. Each fetch re-reads from
+    LATENESS_SECONDS behind the watermark, so late-indexed documents and long
+    Zeek connections are still folded, and the remembered _ids keep anything
+    re-read from being counted twice. Buckets older than the window are
+    dropped each refresh, so the aggregates always describe the last
+    window_minutes without re-reading it.
+    """
+
+    def __init__(self, elastic_url, auth, zeek_window_minutes=10, host_window_minutes=10, state_file=STATE_FILE):
+        self.elastic_url = elastic_url
+        self.auth = auth
+        self.windows = {
+            "zeek": zeek_window_minutes * 60,
+            "metricbeat": host_window_minutes * 60
+        }
+        self.state_file = state_file
+        self.state = {"zeek": {}, "metricbeat": {}}
+        self.load()
+
+    def load(self):
+        """Restore watermarks and aggregates saved by a previous run"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                saved = json.load(f)
+            for source in self.state:
+                self.state[source] = saved.get(source, {})
+            logging.info("Loaded collector state for %d host(s) from %s",
+                         len(self.state["zeek"]), self.state_file)
+        except (OSError, ValueError) as err:
+            logging.warning("Ignoring unreadable collector state %s: %s", self.state_file, err)
+
+    def save(self):
+        """Persist state atomically so a crash never leaves a half-written file"""
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.state, f, separators=(",", ":"))
+        os.replace(tmp_file, self.state_file)
+
+    def refresh(self, host_ips, now=None):
+        """Fetch only documents newer than each host's watermark, fold them in and expire old buckets"""
+        now = now or datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+        # Hosts that left the service drop out of the state
+        host_set = set(host_ips)
+        for source in self.state:
+            for ip in list(self.state[source]):
+                if ip not in host_set:
+                    del self.state[source][ip]
+
+        fetched = {
+            "zeek": self._fetch("zeek", host_ips, now, self._fold_zeek),
+            "metricbeat": self._fetch("metricbeat", host_ips, now, self._fold_metricbeat)
+        }
+        for source, window in self.windows.items():
+            oldest_bucket = int((now - window) // BUCKET_SECONDS) * BUCKET_SECONDS
+            for host_state in self.state[source].values():
+                # Ids behind the re-read margin (or the window) cannot come back, so the seen set stays bounded
+                watermark = host_state["watermark"]
+                if watermark and "seen" in watermark:
+                    horizon = max(_parse_timestamp(watermark["timestamp"]) - LATENESS_SECONDS[source], now - window)
+                    seen = watermark["seen"]
+                    for doc_id in [doc_id for doc_id, epoch in seen.items() if epoch < horizon]:
+                        del seen[doc_id]
+                for bucket in [b for b in host_state["buckets"] if int(b) < oldest_bucket]:
+                    del host_state["buckets"][bucket]
+                # Counter samples older than the window cannot anchor a delta any more
+                interfaces = host_state.get("interfaces", {})
+                for interface in [name for name, sample in interfaces.items() if sample[0] < now - window]:
+                    del interfaces[interface]
+
+        self.save()
+        logging.info("Incremental fetch: %d new Zeek and %d new metricbeat document(s)",
+                     fetched["zeek"], fetched["metricbeat"])
+        return fetched
+
+    def _host_state(self, source, ip):
+        return self.state[source].setdefault(ip, {"watermark": None, "buckets": {}})
+
+    def _build_delta_query(self, source, host_ips, now):
+        """One query per source; hosts sharing a watermark share a clause"""
+        window_start = _format_timestamp(now - self.windows[source])
+        by_watermark = {}
+        for ip in host_ips:
+            watermark = self._host_state(source, ip)["watermark"]
+            since = window_start
+            # Re-read the lateness margin, but never further back than the window, even after a long outage
+            if watermark:
+                since_epoch = _parse_timestamp(watermark["timestamp"]) - LATENESS_SECONDS[source]
+                if since_epoch > now - self.windows[source]:
+                    since = _format_timestamp(since_epoch)
+            by_watermark.setdefault(since, []).append(ip)
+
+        clauses = []
+        for since, ips in by_watermark.items():
+            if source == "zeek":
+                host_filter = {"bool": {"should": [
+                    {"terms": {"conn.id.orig_h": ips}},
+                    {"terms": {"conn.id.resp_h": ips}}
+                ], "minimum_should_match": 1}}
+            else:
+                host_filter = {"terms": {"host.ip": ips}}
+            clauses.append({"bool": {"filter": [host_filter, {"range": {"@timestamp": {"gte": since}}}]}})
+
+        if source == "zeek":
+            source_filters = [{"term": {"log_type": "zeek"}}, {"term": {"filter_match_status": "conn"}}]
+            fields = ZEEK_SOURCE_FIELDS
+        else:
+            source_filters = [{"terms": {"metricset.name": ["cpu", "memory", "network"]}}]
+            fields = METRICBEAT_SOURCE_FIELDS
+
+        return {
+            "_source": fields,
+            "sort": [{"@timestamp": {"order": "asc"}}],
+            "query": {
+                "bool": {
+                    "filter": source_filters + [
+                        {"range": {"@timestamp": {"lte": _format_timestamp(now)}}},
+                        {"bool": {"should": clauses, "minimum_should_match": 1}}
+                    ]
+                }
+            }
+        }
+
+    def _fetch(self, source, host_ips, now, fold):
+        if not host_ips:
+            return 0
+        query = self._build_delta_query(source, host_ips, now)
+        host_set = set(host_ips)
+        count = 0
+        for hit in iter_hits(self.elastic_url, query, self.auth, template=f"incremental_{source}"):
+            doc = hit.get('_source', {})
+            timestamp = doc.get('@timestamp')
+            if not timestamp:
+                continue
+            epoch = _parse_timestamp(timestamp)
+            if source == "zeek":
+                ips = {_get_path(doc, "conn.id.orig_h"), _get_path(doc, "conn.id.resp_h")}
+            else:
+                host_ip = _get_path(doc, "host.ip")
+                ips = set(host_ip if isinstance(host_ip, list) else [host_ip])
+
+            for ip in ips & host_set:
+                if self._advance_watermark(source, ip, timestamp, epoch, hit.get('_id')):
+                    fold(ip, doc, epoch)
+                    count += 1
+        return count
+
+    def _advance_watermark(self, source, ip, timestamp, epoch, doc_id):
+        """Return True if the document is new for this host, moving the watermark forward"""
+        host_state = self._host_state(source, ip)
+        watermark = host_state["watermark"]
+        if watermark is None:
+            host_state["watermark"] = {"timestamp": timestamp, "seen": {doc_id: epoch}}
+            return True
+        watermark_epoch = _parse_timestamp(watermark["timestamp"])
+        # State saved before the lateness margin only knows the ids at the watermark itself
+        seen = watermark.setdefault("seen", {doc_id: watermark_epoch for doc_id in watermark.pop("ids", [])})
+        # Behind the margin the seen ids are pruned, so a re-read there (via another host's clause) is a repeat
+        if doc_id in seen or epoch < watermark_epoch - LATENESS_SECONDS[source]:
+            return False
+        seen[doc_id] = epoch
+        if epoch > watermark_epoch:
+            watermark["timestamp"] = timestamp
+        return True
+
+    def _bucket(self, source, ip, epoch, empty):
+        key = str(int(epoch // BUCKET_SECONDS) * BUCKET_SECONDS)
+        return self._host_state(source, ip)["buckets"].setdefault(key, empty())
+
+    def _fold_zeek(self, ip, doc, epoch):
+        bucket = self._bucket("zeek", ip, epoch, lambda: {
+            "count": 0, "duration_count": 0, "total_duration": 0, "min_duration": None, "max_duration": None,
+            "incoming_count": 0, "outgoing_count": 0, "orig_bytes_total": 0, "resp_bytes_total": 0,
+            "bytes_sent": 0, "bytes_received": 0, "error_count": 0
+        })
+        orig_bytes = _get_path(doc, "conn.orig_bytes") or 0
+        resp_bytes = _get_path(doc, "conn.resp_bytes") or 0
+        duration = _get_path(doc, "conn.duration")
+
+        bucket["count"] += 1
+        bucket["orig_bytes_total"] += orig_bytes
+        bucket["resp_bytes_total"] += resp_bytes
+        if _get_path(doc, "conn.conn_state") in ERROR_CONN_STATES:
+            bucket["error_count"] += 1
+
+        # Same host-perspective byte accounting as query_zeek_logs.parse_conn_aggregation
+        if _get_path(doc, "conn.id.resp_h") == ip:
+            bucket["incoming_count"] += 1
+            bucket["bytes_sent"] += resp_bytes
+            bucket["bytes_received"] += orig_bytes
+        else:
+            bucket["outgoing_count"] += 1
+            bucket["bytes_sent"] += orig_bytes
+            bucket["bytes_received"] += resp_bytes
+
+        if duration is not None:
+            bucket["duration_count"] += 1
+            bucket["total_duration"] += duration
+            if bucket["min_duration"] is None or duration < bucket["min_duration"]:
+                bucket["min_duration"] = duration
+            if bucket["max_duration"] is None or duration > bucket["max_duration"]:
+                bucket["max_duration"] = duration
+            # Per-bucket sketches are saved with the state and merged over the window in conn_table
+            DurationSketch(bucket.setdefault("durations", DurationSketch().state)).add(duration)
+
+    def _fold_metricbeat(self, ip, doc, epoch):
+        bucket = self._bucket("metricbeat", ip, epoch, lambda: {
+            "cpu_sum": 0, "cpu_count": 0, "cpu_max": None,
+            "ram_sum": 0, "ram_count": 0, "ram_max": None,
+            "net_in_bytes": 0, "net_out_bytes": 0
+        })
+        metricset = _get_path(doc, "metricset.name")
+
+        if metricset in ("cpu", "memory"):
+            name = "cpu" if metricset == "cpu" else "ram"
+            field = "system.cpu.total.norm.pct" if name == "cpu" else "system.memory.actual.used.pct"
+            value = _get_path(doc, field)
+            if value is not None:
+                bucket[f"{name}_sum"] += value
+                bucket[f"{name}_count"] += 1
+                if bucket[f"{name}_max"] is None or value > bucket[f"{name}_max"]:
+                    bucket[f"{name}_max"] = value
+
+        elif metricset == "network":
+            interface = _get_path(doc, "system.network.name")
+            bytes_in = _get_path(doc, "system.network.in.bytes")
+            bytes_out = _get_path(doc, "system.network.out.bytes")
+            if not interface or interface == "lo" or bytes_in is None or bytes_out is None:
+                return
+            # Counters are cumulative, so keep the previous sample per interface and add deltas
+            interfaces = self._host_state("metricbeat", ip).setdefault("interfaces", {})
+            previous = interfaces.get(interface)
+            # A sample more than a bucket old (restart, outage) would pour the whole gap into one bucket
+            if previous and 0 < epoch - previous[0] <= COUNTER_MAX_GAP:
+                # Wraps and resets are corrected; an interval faster than the link is an artifact
+                delta_in = counter_delta(previous[1], bytes_in)
+                delta_out = counter_delta(previous[2], bytes_out)
+                limit = host_capacity(ip) * CAPACITY_SLACK * (epoch - previous[0])
+                if delta_in <= limit and delta_out <= limit:
+                    bucket["net_in_bytes"] += delta_in
+                    bucket["net_out_bytes"] += delta_out
+            # A late sample older than the last one is already covered by the delta across it
+            if not previous or epoch > previous[0]:
+                interfaces[interface] = [epoch, bytes_in, bytes_out]
+
+    def conn_table(self):
+        """Windowed connection statistics per host, shaped like parse_conn_aggregation"""
+        table = {}
+        for ip, host_state in self.state["zeek"].items():
+            entry = {
+                "ip": ip, "count": 0, "duration_count": 0, "total_duration": 0,
+                "min_duration": None, "max_duration": None, "incoming_count": 0, "outgoing_count": 0,
+                "orig_bytes_total": 0, "resp_bytes_total": 0, "bytes_sent": 0, "bytes_received": 0,
+                "error_count": 0
+            }
+            sketches = []
+            for bucket in host_state["buckets"].values():
+                for key, value in bucket.items():
+                    if key == "durations":
+                        sketches.append(value)
+                    elif key == "min_duration":
+                        if value is not None and (entry[key] is None or value < entry[key]):
+                            entry[key] = value
+                    elif key == "max_duration":
+                        if value is not None and (entry[key] is None or value > entry[key]):
+                            entry[key] = value
+                    else:
+                        entry[key] += value
+            entry["avg_duration"] = entry["total_duration"] / entry["duration_count"] if entry["duration_count"] else 0
+            entry["error_ratio"] = entry["error_count"] / entry["count"] if entry["count"] else 0
+            if sketches:
+                entry["duration_sketch"] = merge_sketches(sketches)
+            table[ip] = entry
+        return table
+
+    def host_table(self, now=None):
+        """Windowed CPU/RAM/network figures per host, shaped like parse_fleet_metrics"""
+        now = now or datetime.datetime.now(datetime.timezone.utc).timestamp()
+        window = self.windows["metricbeat"]
+        midpoint = now - window / 2
+
+        table = {}
+        for ip, host_state in self.state["metricbeat"].items():
+            if not host_state["buckets"]:
+                continue
+            totals = {"early": {}, "late": {}}
+            metrics = {}
+            net_in = 0
+            net_out = 0
+            for key, bucket in host_state["buckets"].items():
+                half = totals["early"] if int(key) < midpoint else totals["late"]
+                for name in ("cpu", "ram"):
+                    half[f"{name}_sum"] = half.get(f"{name}_sum", 0) + bucket[f"{name}_sum"]
+                    half[f"{name}_count"] = half.get(f"{name}_count", 0) + bucket[f"{name}_count"]
+                    if bucket[f"{name}_max"] is not None:
+                        metrics[f"{name}_max"] = max(metrics.get(f"{name}_max", 0), bucket[f"{name}_max"] * 100)
+                net_in += bucket["net_in_bytes"]
+                net_out += bucket["net_out_bytes"]
+
+            trends = []
+            for name in ("cpu", "ram"):
+                count = totals["early"].get(f"{name}_count", 0) + totals["late"].get(f"{name}_count", 0)
+                if count:
+                    total = totals["early"].get(f"{name}_sum", 0) + totals["late"].get(f"{name}_sum", 0)
+                    metrics[f"{name}_utilization"] = total / count * 100
+                    averages = [half[f"{name}_sum"] / half[f"{name}_count"] if half.get(f"{name}_count") else None
+                                for half in (totals["early"], totals["late"])]
+                    trends.append(relative_change(*averages))
+
+            metrics["net_in_rate"] = net_in / window
+            metrics["net_out_rate"] = net_out / window
+            metrics["net_utilization"] = max(metrics["net_in_rate"], metrics["net_out_rate"]) / host_capacity(ip) * 100
+            if trends:
+                metrics["trend_coefficient"] = -sum(trends) / len(trends)
+            table[ip] = metrics
+        return table
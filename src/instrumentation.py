@@ -0,0 +1,248 @@
+import time
+import math
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instrumentation configuration
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+WEIGHT_CHANGE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base for labelled metrics; one child value per label combination"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def retain(self, label, keep):
+        """Drop children whose value for label is not in keep (e.g. departed instances)"""
+        position = self.label_names.index(label)
+        with self.lock:
+            for key in [key for key in self.values if key[position] not in keep]:
+                del self.values[key]
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self.sample_lines(key, value))
+        return lines
+
+    def sample_lines(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels))
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                state[0][position] += 1
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def sample_lines(self, key, state):
+        counts, total, value_sum = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', _format_value(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', '+Inf')])} {total}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(value_sum)}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {total}")
+        return lines
+
+
+class Registry:
+    """Holds metrics by name and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Cycle and phase timing
+CYCLE_SECONDS = REGISTRY.histogram("lb_cycle_duration_seconds", "Wall time of full balancing cycles")
+CYCLES = REGISTRY.counter("lb_cycles_total", "Balancing cycles by outcome", ("outcome",))
+PHASE_SECONDS = REGISTRY.histogram("lb_phase_duration_seconds", "Wall time of each cycle phase", ("phase",))
+
+# Outbound HTTP per backend service
+HTTP_REQUESTS = REGISTRY.counter("lb_http_requests_total", "HTTP requests by backend, method and status",
+                                 ("backend", "method", "status"))
+HTTP_SECONDS = REGISTRY.histogram("lb_http_request_duration_seconds", "HTTP request latency by backend", ("backend",))
+HTTP_BYTES_SENT = REGISTRY.counter("lb_http_sent_bytes_total", "Request body bytes sent by backend", ("backend",))
+HTTP_BYTES_RECEIVED = REGISTRY.counter("lb_http_received_bytes_total", "Response body bytes received by backend",
+                                       ("backend",))
+HTTP_RETRIES = REGISTRY.counter("lb_http_retries_total", "Connection retries by backend", ("backend",))
+HTTP_ERRORS = REGISTRY.counter("lb_http_errors_total", "Failed requests (exceptions and 4xx/5xx) by backend and kind",
+                               ("backend", "kind"))
+
+# Weights
+INSTANCE_WEIGHT = REGISTRY.gauge("lb_instance_weight", "Final weight last computed per instance", ("instance",))
+WEIGHT_CHANGES = REGISTRY.counter("lb_weight_changes_total", "Times an instance's final weight changed", ("instance",))
+WEIGHT_CHANGE_SIZE = REGISTRY.histogram("lb_weight_change_abs", "Absolute change of final weights between cycles",
+                                        buckets=WEIGHT_CHANGE_BUCKETS)
+
+
+def phase(name):
+    """Context manager timing one cycle phase"""
+    return PHASE_SECONDS.time(phase=name)
+
+
+def record_weights(previous, weights):
+    """Update weight gauges and change counters from {ip: weight data} before and after scoring"""
+    for ip_address, weight_data in weights.items():
+        final_weight = weight_data['final_weight']
+        INSTANCE_WEIGHT.set(final_weight, instance=ip_address)
+        before = previous.get(ip_address)
+        if before is not None:
+            change = abs(final_weight - before['final_weight'])
+            WEIGHT_CHANGE_SIZE.observe(change)
+            if change:
+                WEIGHT_CHANGES.inc(instance=ip_address)
+
+
+def forget_instances(keep):
+    """Drop per-instance series for instances no longer in the service"""
+    INSTANCE_WEIGHT.retain("instance", keep)
+    WEIGHT_CHANGES.retain("instance", keep)
+
+
+class MetricsServer:
+    """Serves REGISTRY on http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_ref.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
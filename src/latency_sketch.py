@@ -0,0 +1,151 @@
+import math
+
+# Latency sketch configuration
+RELATIVE_ACCURACY = 0.02  # Reported quantiles are within 2% of a true duration
+MAX_BINS = 1024  # Bins kept per sketch (1µs to hours at 2%); past this the lowest bins are collapsed, sparing the tail
+MIN_DURATION = 1e-6  # Seconds; shorter (and zero) durations share the zero bin
+QUANTILES = (50, 95, 99)  # Percentiles exposed to scoring as conn_duration_p<N>
+ZERO_KEY = -(2 ** 20)  # Histogram key the Elasticsearch bins script returns for the zero bin
+
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+# Painless twin of DurationSketch.add's bin index, so Elasticsearch can build sketch bins server-side
+BINS_SCRIPT = ("double v = doc['conn.duration'].value; "
+               "return v <= params.min ? params.zero : Math.ceil(Math.log(v) / params.log_gamma);")
+
+
+def empty_sketch():
+    """Serialized form of an empty sketch; plain JSON, so it can sit in state files and be merged later"""
+    return {"count": 0, "zero": 0, "sum": 0, "min": None, "max": None, "bins": {}}
+
+
+def bin_value(key):
+    """Representative duration of a bin: within RELATIVE_ACCURACY of every duration it holds"""
+    return 2 * GAMMA ** int(key) / (GAMMA + 1)
+
+
+class DurationSketch:
+    """DDSketch over connection durations, stored in its serialized dict form.
+
+    Durations fall into logarithmic bins (bin i holds GAMMA^(i-1) < d <= GAMMA^i),
+    so any quantile is within RELATIVE_ACCURACY of the truth and two sketches
+    merge by adding bin counts. Memory is bounded by MAX_BINS whatever the
+    connection count. The wrapped dict is updated in place, so a sketch kept
+    inside collector state needs no conversion before it is saved.
+    """
+
+    def __init__(self, state=None):
+        self.state = state if state is not None else empty_sketch()
+
+    def add(self, duration, count=1):
+        state = self.state
+        state["count"] += count
+        state["sum"] += duration * count
+        if state["min"] is None or duration < state["min"]:
+            state["min"] = duration
+        if state["max"] is None or duration > state["max"]:
+            state["max"] = duration
+        if duration <= MIN_DURATION:
+            state["zero"] += count
+        else:
+            self._add_bin(str(math.ceil(math.log(duration) / LOG_GAMMA)), count)
+        return self
+
+    def add_bins(self, buckets):
+        """Fold in histogram buckets from build_bins_agg (counts only; min/max/sum come from the stats agg)"""
+        for bucket in buckets:
+            count = bucket['doc_count']
+            if not count:
+                continue
+            self.state["count"] += count
+            if int(bucket['key']) == ZERO_KEY:
+                self.state["zero"] += count
+            else:
+                self._add_bin(str(int(bucket['key'])), count)
+        return self
+
+    def merge(self, other):
+        """Add another sketch (a DurationSketch or its serialized dict) into this one"""
+        other = other.state if isinstance(other, DurationSketch) else other
+        state = self.state
+        state["count"] += other["count"]
+        state["zero"] += other["zero"]
+        state["sum"] += other["sum"]
+        for bound, pick in (("min", min), ("max", max)):
+            if other[bound] is not None:
+                state[bound] = other[bound] if state[bound] is None else pick(state[bound], other[bound])
+        for key, count in other["bins"].items():
+            self._add_bin(key, count)
+        return self
+
+    def _add_bin(self, key, count):
+        bins = self.state["bins"]
+        if key in bins:
+            bins[key] += count
+            return
+        bins[key] = count
+        if len(bins) > MAX_BINS:
+            # Fold the lowest bins into the lowest one kept: short durations lose accuracy, the tail does not
+            keys = sorted(bins, key=int)
+            excess = len(keys) - MAX_BINS
+            for low_key in keys[:excess]:
+                bins[keys[excess]] += bins.pop(low_key)
+
+    def quantiles(self, percents=QUANTILES):
+        """{percent: duration in seconds} in one pass over the bins; None for an empty sketch"""
+        state = self.state
+        if not state["count"]:
+            return {percent: None for percent in percents}
+        ranks = sorted((percent / 100 * (state["count"] - 1), percent) for percent in percents)
+        result = {}
+        seen = state["zero"]
+        position = 0
+        while position < len(ranks) and ranks[position][0] < seen:
+            result[ranks[position][1]] = 0.0
+            position += 1
+        for key in sorted(state["bins"], key=int):
+            if position >= len(ranks):
+                break
+            seen += state["bins"][key]
+            while position < len(ranks) and ranks[position][0] < seen:
+                result[ranks[position][1]] = self._clamp(bin_value(key))
+                position += 1
+        for _, percent in ranks[position:]:
+            result[percent] = self._clamp(bin_value(max(state["bins"], key=int))) if state["bins"] else 0.0
+        return result
+
+    def _clamp(self, value):
+        if self.state["min"] is not None:
+            value = max(value, self.state["min"])
+        if self.state["max"] is not None:
+            value = min(value, self.state["max"])
+        return value
+
+
+def merge_sketches(states):
+    """One serialized sketch holding every given sketch, e.g. per-minute sketches merged over a window"""
+    merged = DurationSketch()
+    for state in states:
+        if state:
+            merged.merge(state)
+    return merged.state
+
+
+def build_bins_agg():
+    """Aggregation that returns a conn bucket's durations as DurationSketch bins"""
+    return {
+        "filter": {"exists": {"field": "conn.duration"}},
+        "aggs": {
+            "bins": {
+                "histogram": {
+                    "script": {
+                        "source": BINS_SCRIPT,
+                        "params": {"min": MIN_DURATION, "zero": ZERO_KEY, "log_gamma": LOG_GAMMA}
+                    },
+                    "interval": 1,
+                    "min_doc_count": 1
+                }
+            }
+        }
+    }
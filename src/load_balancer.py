@@ -7,6 +7,10 @@ import logging
 import numpy as np
 import sys
 import os
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
 from urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
@@ -16,12 +20,34 @@ import query_network_metrics
 import query_zeek_logs
 import query_consul
 import query_metricbeat
+import http_transport
+from elastic_batch import SearchBatch
+from incremental_collector import IncrementalCollector
+from metric_store import MetricStore
+from latency_sketch import DurationSketch
+from trend_estimator import TrendTracker
+from consul_watcher import ServiceWatcher
+from cycle_scheduler import AdaptiveScheduler
+from health_loop import HealthMonitor, HealthLoop
+from network_rates import build_counter_query, series_from_counter_aggregation, fleet_rate_table
+from network_rates import build_rate_query, server_rate_table, rate_interval
+import cycle_scheduler
+import consul_weights
+from scoring import ProfileRegistry, score_instances
+from history_store import HistoryStore
+from export_writer import ExportWriter, CycleSnapshot
+from log_setup import setup_logging, instance_detail
+import instrumentation
+import query_costs
+from consul_weights import ConsulWeightWriter
 
 # Then import the specific functions
 from query_network_metrics import query_network_metrics, calculate_network_rates
 from query_zeek_logs import query_zeek_conn_logs, analyze_connection_durations
+from query_zeek_logs import build_conn_aggregation_query, parse_conn_aggregation
 from query_consul import query_service_instances, update_service_weight
 from query_metricbeat import query_cpu_metrics, query_memory_metrics
+from query_metricbeat import query_fleet_metrics, build_fleet_metrics_query, parse_fleet_metrics
 
 # Configuration
 ELASTIC_URL = "https://10.100.0.7:9200"
@@ -31,88 +57,250 @@ CONSUL_HOST = "10.100.0.9"
 CONSUL_PORT = 8500
 SERVICE_NAME = "sdn-news"
 USE_HTTPS = False
-RUN_INTERVAL = 600  # 10 minutes in seconds
+RUN_INTERVAL = 600  # Longest wait between cycles, used while the fleet is stable
+MIN_RUN_INTERVAL = 60  # Shortest wait between cycles, used while scores are changing fast
+COLLECT_WORKERS = 16  # Parallel metric collectors (1 = sequential)
+INSTANCE_DEADLINE = 20  # Seconds allowed per instance, from when a worker picks it up, before it is marked stale
+COLLECT_DEADLINE = 60  # Seconds from cycle start after which no collector is waited for
+BATCH_QUERIES = True  # Send the fleet host and Zeek aggregations as one _msearch batch
+HOST_METRICS_WINDOW = 10  # Minutes of metricbeat data aggregated per cycle
+ZEEK_WINDOW = 10  # Minutes of Zeek conn logs aggregated per cycle
+INCREMENTAL_FETCH = False  # Fold raw hits past per-host watermarks instead of server-side aggregations (skips the batched, pooled and rate paths)
+COLLECTOR_STATE_FILE = "collector_state.json"  # Watermarks survive restarts here
+TREND_WINDOW = 3600  # Seconds over which the online trend projects its slope
+TREND_HALF_LIFE = 1800  # Seconds after which a cycle's sample counts half as much in the online trend
+WATCH_DISCOVERY = True  # Track membership with Consul blocking queries instead of polling
+WATCH_READY_TIMEOUT = 30  # Seconds to wait for the watcher's first catalog read
+METRICS_PORT = None  # Serve Prometheus metrics on this port (e.g. 9108); None disables the endpoint
+METRICS_HOST = "127.0.0.1"
+MIN_TREND_SAMPLES = 3  # Cycles seen before the online trend replaces the query trend
+SCORING_PROFILES_FILE = "scoring_profiles.json"  # Per-service scoring curves and weights, hot-reloaded
+HISTORY_DIR = "history"  # Per-cycle metrics, scores and weights (one SQLite partition per day)
+EXPORT_EXCEL = False  # Also write a workbook every cycle (history_store.py exports on demand)
+EXPORT_CLOSE_TIMEOUT = 30  # Seconds allowed at exit to write queued snapshots
+LOG_FILE = "load_balancer.log"  # Rotated by size (see log_setup)
+LOG_FORMAT = "json"  # "json" lines or the classic "text" format
+LOG_SAMPLE_RATE = 0.1  # Share of instances whose per-instance detail is logged each cycle
+NETWORK_RATE_MODE = "server"  # "server": Elasticsearch derives per-second rates; "counters": bucketed counters diffed here
+HEALTH_LOOP = True  # Run the fast loop that lowers weights on error/latency spikes and failing checks
+HEALTH_INTERVAL = 5  # Seconds between fast health checks
+PUBLISH_RETRY_BACKOFF = 10  # Seconds before the health loop retries a failed weight write; doubles per failure
+PUBLISH_RETRY_MAX = 300  # Cap on that backoff (full cycles always retry)
+QUERY_COST_LOG = None  # Append per-template Elasticsearch took/shards/hits here (query_costs.py reports on it)
+QUERY_PROFILE_RATE = 0.0  # Share of searches sent with "profile": true; breakdowns land in query_profiles/
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("load_balancer.log"),
-        logging.StreamHandler()
-    ]
-)
+setup_logging(LOG_FILE, LOG_FORMAT, sample_rate=LOG_SAMPLE_RATE)
 logger = logging.getLogger()
 
+def add_metrics(metrics, collected):
+    """metrics.update(collected), keeping every part's list of placeholder (defaulted) metrics"""
+    defaulted = metrics.get('defaulted_metrics', []) + collected.get('defaulted_metrics', [])
+    metrics.update(collected)
+    if defaulted:
+        metrics['defaulted_metrics'] = defaulted
+
 class DynamicLoadBalancer:
     def __init__(self):
         self.service_instances = []
         self.instance_metrics = {}
+        self.host_metrics = {}
         self.weights = {}
+        self.collector = None
+        self.store = MetricStore()
+        self.trends = TrendTracker(TREND_HALF_LIFE, TREND_WINDOW)
+        self.watcher = None
+        self.weight_writer = None
+        self.profiles = ProfileRegistry(SCORING_PROFILES_FILE)
+        self.history = HistoryStore(HISTORY_DIR)
+        self.exporter = None
+        self.scheduler = AdaptiveScheduler(MIN_RUN_INTERVAL, RUN_INTERVAL)
+        self.resume_phase = None
+        self.collected_at = None
+        self.health = None
+        self.health_loop = None
+        self.publish_lock = threading.Lock()
+        self.published = {}
+        self.publish_failures = {}  # ip -> (consecutive failed writes, monotonic time the health loop may retry)
+        
+        # Give the Elasticsearch pool one keep-alive connection per collector thread
+        http_transport.HOST_POOL_SIZES.setdefault(urlsplit(ELASTIC_URL).netloc, COLLECT_WORKERS)
+        http_transport.HOST_LABELS.setdefault(urlsplit(ELASTIC_URL).netloc, "elasticsearch")
+        http_transport.HOST_LABELS.setdefault(f"{CONSUL_HOST}:{CONSUL_PORT}", "consul")
+        query_costs.COST_LOG_FILE = QUERY_COST_LOG
+        query_costs.PROFILE_SAMPLE_RATE = QUERY_PROFILE_RATE
+        
+        self.metrics_server = None
+        if METRICS_PORT:
+            self.metrics_server = instrumentation.MetricsServer(METRICS_PORT, METRICS_HOST).start()
         
     def run(self):
         """Main execution loop"""
         logger.info("Starting Dynamic Load Balancer")
         
+        if HEALTH_LOOP:
+            self.start_health_loop()
+        
+        resume_from = None
+        previous_weights = {}
         while True:
             try:
                 start_time = time.time()
-                logger.info("=== Starting new balancing cycle ===")
-                
-                # Step 1: Discover service instances using our existing function
-                # Set global variables first since the function uses globals
-                query_consul.CONSUL_HOST = CONSUL_HOST
-                query_consul.CONSUL_PORT = CONSUL_PORT
-                query_consul.SERVICE_NAME = SERVICE_NAME
-                query_consul.USE_HTTPS = USE_HTTPS
-                
-                # Call the function without parameters as it reads from globals
-                instances = query_service_instances()
-                if not instances:
-                    logger.error("No service instances found, skipping cycle")
-                    time.sleep(RUN_INTERVAL)
-                    continue
-                
-                # Ensure consistent key naming in instances
-                normalized_instances = []
-                for instance in instances:
-                    # Map keys to expected format if needed
-                    normalized_instance = {
-                        'IP Address': instance.get('IP Address', instance.get('ServiceAddress', instance.get('Address'))),
-                        'Node': instance.get('Node', 'unknown'),
-                        'Service ID': instance.get('Service ID', instance.get('ServiceID')),
-                        'Port': instance.get('Port', instance.get('ServicePort')),
-                        'Tags': instance.get('Tags')
-                    }
-                    normalized_instances.append(normalized_instance)
-                    
-                self.service_instances = normalized_instances
-                
-                # Step 2: Collect metrics for each instance
-                self.collect_metrics()
-                
-                # Step 3: Calculate scores and weights
-                self.calculate_weights()
-                
-                # Step 4: Update weights in Consul
-                self.update_consul_weights()
-                
-                # Step 5: Export results
-                self.export_results()
+                if resume_from is None:
+                    previous_weights = dict(self.weights)
+                try:
+                    outcome = "ok" if self.run_cycle(resume_from) else "empty"
+                except Exception:
+                    instrumentation.CYCLES.inc(outcome="error")
+                    raise
+                instrumentation.CYCLES.inc(outcome=outcome)
                 
                 # Calculate time taken and wait for next cycle
                 execution_time = time.time() - start_time
+                instrumentation.CYCLE_SECONDS.observe(execution_time)
                 logger.info(f"Cycle completed in {execution_time:.2f} seconds")
                 
-                # Wait until next interval
-                sleep_time = max(0, RUN_INTERVAL - execution_time)
+                # Wait until next interval, shorter while scores are moving
+                interval = self.scheduler.cycle_succeeded(previous_weights, self.weights)
+                resume_from = None
+                sleep_time = max(0, interval - execution_time)
                 logger.info(f"Sleeping for {sleep_time:.2f} seconds until next cycle")
-                time.sleep(sleep_time)
+                self.wait_for_next_cycle(sleep_time)
                 
             except Exception as e:
                 logger.error(f"Error in main execution loop: {e}")
-                logger.error(f"Waiting {RUN_INTERVAL} seconds before retry")
-                time.sleep(RUN_INTERVAL)
+                resume_from = self.resumable_phase()
+                delay = self.scheduler.cycle_failed()
+                if resume_from:
+                    logger.error(f"Waiting {delay:.1f} seconds before resuming at {resume_from}")
+                else:
+                    logger.error(f"Waiting {delay:.1f} seconds before retry")
+                self.wait_for_next_cycle(delay)
+    
+    def run_cycle(self, resume_from=None):
+        """Run one balancing cycle (or its phases from resume_from on); returns False when no instances were found"""
+        if resume_from is None:
+            logger.info("=== Starting new balancing cycle ===")
+            
+            # Step 1: Discover service instances
+            with instrumentation.phase("discover"):
+                instances = self.scheduler.run_phase("discover", self.discover_instances)
+            if not instances:
+                logger.error("No service instances found, skipping cycle")
+                return False
+            
+            self.service_instances = self.normalize_instances(instances)
+        else:
+            logger.info(f"=== Resuming balancing cycle at {resume_from} ===")
+        
+        # Steps 2-5: collect metrics, score, update Consul, export; each may be retried in place
+        phases = [
+            ("collect", self.collect_metrics),
+            ("history", self.update_history),
+            ("score", self.calculate_weights),
+            ("consul_update", self.update_consul_weights),
+            ("export", self.export_results)
+        ]
+        names = [name for name, _ in phases]
+        for name, method in phases[names.index(resume_from) if resume_from else 0:]:
+            self.resume_phase = name
+            with instrumentation.phase(name):
+                self.scheduler.run_phase(name, method)
+            if name == "collect":
+                self.collected_at = time.time()
+        self.resume_phase = None
+        return True
+    
+    def resumable_phase(self):
+        """The phase a failed cycle can restart from, if its collected metrics are still fresh"""
+        if self.resume_phase in (None, "collect") or self.collected_at is None:
+            return None
+        if time.time() - self.collected_at > cycle_scheduler.RESUME_MAX_AGE:
+            return None
+        return self.resume_phase
+    
+    def discover_instances(self):
+        """Return the current service instances, from the watcher or a one-off catalog read"""
+        if WATCH_DISCOVERY:
+            if self.watcher is None:
+                protocol = "https" if USE_HTTPS else "http"
+                self.watcher = ServiceWatcher(f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}", SERVICE_NAME)
+                self.watcher.start()
+                if not self.watcher.wait_ready(WATCH_READY_TIMEOUT):
+                    logger.warning(f"Consul watcher not ready after {WATCH_READY_TIMEOUT}s")
+            
+            # A full cycle covers any membership change seen so far
+            self.watcher.take_changes()
+            return self.watcher.get_instances()
+        
+        # Set global variables first since the function uses globals
+        query_consul.CONSUL_HOST = CONSUL_HOST
+        query_consul.CONSUL_PORT = CONSUL_PORT
+        query_consul.SERVICE_NAME = SERVICE_NAME
+        query_consul.USE_HTTPS = USE_HTTPS
+        
+        # Call the function without parameters as it reads from globals
+        return query_service_instances(export=False)
+    
+    def normalize_instances(self, instances):
+        """Ensure consistent key naming in instances"""
+        normalized_instances = []
+        for instance in instances:
+            # Map keys to expected format if needed
+            normalized_instance = {
+                'IP Address': instance.get('IP Address', instance.get('ServiceAddress', instance.get('Address'))),
+                'Node': instance.get('Node', 'unknown'),
+                'Service ID': instance.get('Service ID', instance.get('ServiceID')),
+                'Port': instance.get('Port', instance.get('ServicePort')),
+                'Tags': instance.get('Tags')
+            }
+            normalized_instances.append(normalized_instance)
+        return normalized_instances
+    
+    def wait_for_next_cycle(self, seconds):
+        """Sleep until the next cycle, rebalancing immediately whenever membership changes"""
+        deadline = time.time() + seconds
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self.watcher is None:
+                time.sleep(remaining)
+                return
+            if self.watcher.changed.wait(remaining):
+                try:
+                    self.partial_rebalance()
+                except Exception as e:
+                    logger.error(f"Error in partial rebalance: {e}")
+    
+    def partial_rebalance(self):
+        """Score and publish weights only for instances that joined; forget the ones that left"""
+        added, removed = self.watcher.take_changes()
+        added = self.normalize_instances(added)
+        removed_ips = {instance['IP Address'] for instance in self.normalize_instances(removed)}
+        added_ips = [instance['IP Address'] for instance in added]
+        logger.info(f"Membership change: +{len(added)}/-{len(removed_ips)} instances, partial rebalance")
+        
+        for ip_address in removed_ips:
+            self.instance_metrics.pop(ip_address, None)
+            self.weights.pop(ip_address, None)
+            self.published.pop(ip_address, None)
+            self.publish_failures.pop(ip_address, None)
+        instrumentation.forget_instances(set(self.weights))
+        self.service_instances = [
+            instance for instance in self.service_instances
+            if instance['IP Address'] not in removed_ips and instance['IP Address'] not in added_ips
+        ] + added
+        
+        if not added:
+            return
+        
+        self.host_metrics.update(self.get_fleet_host_metrics(added))
+        for instance in added:
+            self.instance_metrics[instance['IP Address']] = self.collect_instance_metrics(instance, INSTANCE_DEADLINE)
+        
+        self.calculate_weights(added_ips)
+        self.update_consul_weights(added_ips)
     
     def collect_metrics(self):
         """Collect all metrics for each service instance"""
@@ -120,385 +308,558 @@ class DynamicLoadBalancer:
         
         self.instance_metrics = {}
         
-        # Process each instance
+        if INCREMENTAL_FETCH:
+            self.collect_metrics_incremental()
+            return
+        
+        if BATCH_QUERIES:
+            self.collect_metrics_batched()
+            return
+        
+        # One aggregation request covers CPU/RAM/network for the whole fleet
+        self.host_metrics = self.get_fleet_host_metrics()
+        
+        if COLLECT_WORKERS <= 1 or len(self.service_instances) <= 1:
+            # Sequential mode: process each instance in turn
+            for instance in self.service_instances:
+                self.instance_metrics[instance['IP Address']] = self.collect_instance_metrics(instance)
+            return
+        
+        # Concurrent mode: a bounded pool so one slow backend cannot hold up the others
+        workers = min(COLLECT_WORKERS, len(self.service_instances))
+        cycle_start = time.monotonic()
+        started = {}
+        
+        def collect(instance):
+            started[instance['IP Address']] = time.monotonic()
+            return self.collect_instance_metrics(instance, INSTANCE_DEADLINE)
+        
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="collect")
+        futures = {executor.submit(collect, instance): instance for instance in self.service_instances}
+        
+        # Each instance gets INSTANCE_DEADLINE from the moment a worker picks it up, and the whole
+        # collection COLLECT_DEADLINE from cycle start; instances past either are not waited for
+        done = set()
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            cycle_left = COLLECT_DEADLINE - (now - cycle_start)
+            running_left = [started[futures[future]['IP Address']] + INSTANCE_DEADLINE - now
+                            for future in pending if futures[future]['IP Address'] in started]
+            pending = {future for future in pending
+                       if future.done() or futures[future]['IP Address'] not in started
+                       or started[futures[future]['IP Address']] + INSTANCE_DEADLINE > now}
+            if not pending or cycle_left <= 0:
+                break
+            timeout = min([cycle_left] + [left for left in running_left if left > 0])
+            finished, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            done |= finished
+        executor.shutdown(wait=False, cancel_futures=True)
+        
+        for future, instance in futures.items():
+            ip_address = instance['IP Address']
+            if future in done and future.exception() is None:
+                self.instance_metrics[ip_address] = future.result()
+            else:
+                # Late or failed: leave only identity fields and mark the instance stale;
+                # calculate_weights falls back to its defaults
+                if future in done:
+                    reason = future.exception()
+                elif ip_address in started:
+                    reason = f"missed {INSTANCE_DEADLINE}s deadline"
+                else:
+                    reason = f"not started within {COLLECT_DEADLINE}s collection deadline"
+                logger.warning(f"Metrics for {ip_address} unavailable ({reason}), marking stale")
+                self.instance_metrics[ip_address] = {
+                    'node_name': instance['Node'],
+                    'service_id': instance['Service ID'],
+                    'stale': True
+                }
+        
+        logger.info(f"Collected metrics for {len(done)}/{len(futures)} instances with {workers} workers "
+                    f"in {time.monotonic() - cycle_start:.1f}s")
+    
+    def update_history(self):
+        """Record this cycle's metrics in the history store and update the online trends"""
+        now = time.time()
+        self.store.retain(set(self.instance_metrics))
+        self.trends.retain(set(self.instance_metrics))
+        
+        for ip_address, metrics in self.instance_metrics.items():
+            # Placeholders stand in for missing data when scoring; they are not samples
+            defaulted = set(metrics.get('defaulted_metrics', ()))
+            collected = {name: value for name, value in metrics.items() if name not in defaulted}
+            self.store.record(ip_address, collected, now)
+            self.trends.update(ip_address, 'cpu_utilization', now, collected.get('cpu_utilization'))
+            self.trends.update(ip_address, 'ram_utilization', now, collected.get('ram_utilization'))
+            
+            # Rising load scores worse, so a falling CPU/RAM slope yields a positive coefficient;
+            # each trend is shrunk toward 0 by its confidence so noise does not move the score
+            cpu_trend, cpu_confidence, samples = self.trends.get(ip_address, 'cpu_utilization')
+            if samples >= MIN_TREND_SAMPLES:
+                ram_trend, ram_confidence, _ = self.trends.get(ip_address, 'ram_utilization')
+                metrics['trend_coefficient'] = -(cpu_trend * cpu_confidence + ram_trend * ram_confidence) / 2
+        
+        logger.info(f"Metric history holds {self.store.memory_bytes() / 1024:.0f} KB for {len(self.store.series)} instances")
+    
+    def collect_metrics_incremental(self):
+        """Fold only new documents since the last cycle into the windowed aggregates"""
+        if self.collector is None:
+            self.collector = IncrementalCollector(
+                ELASTIC_URL,
+                (ELASTIC_USERNAME, ELASTIC_PASSWORD),
+                zeek_window_minutes=ZEEK_WINDOW,
+                host_window_minutes=HOST_METRICS_WINDOW,
+                state_file=COLLECTOR_STATE_FILE
+            )
+        
+        host_ips = [instance['IP Address'] for instance in self.service_instances]
+        try:
+            with instrumentation.phase("collect_incremental"):
+                self.collector.refresh(host_ips)
+        except Exception as e:
+            # Keep serving the aggregates we already have; the watermarks make the next cycle catch up
+            logger.error(f"Incremental fetch failed, using existing aggregates: {e}")
+        
+        self.host_metrics = self.collector.host_table()
+        conn_table = self.collector.conn_table()
+        
         for instance in self.service_instances:
             ip_address = instance['IP Address']
-            logger.info(f"Collecting metrics for {ip_address}")
-            
-            # Initialize metrics for this instance
-            self.instance_metrics[ip_address] = {
+            metrics = {
                 'node_name': instance['Node'],
                 'service_id': instance['Service ID']
             }
+            add_metrics(metrics, self.get_network_metrics(ip_address))
+            add_metrics(metrics, self.conn_metrics_from_aggregate(ip_address, conn_table.get(ip_address)))
             
-            # 1. Collect network metrics from Elasticsearch
-            network_metrics = self.get_network_metrics(ip_address)
-            
-            # 2. Collect connection-level metrics from Zeek logs
-            conn_metrics = self.get_zeek_connection_metrics(ip_address)
-            
-            # 3. Combine all metrics
-            self.instance_metrics[ip_address].update(network_metrics)
-            self.instance_metrics[ip_address].update(conn_metrics)
+            self.instance_metrics[ip_address] = metrics
+            logger.info("Metrics for %s", ip_address, extra=instance_detail(ip_address, metrics=metrics))
+    
+    def collect_metrics_batched(self):
+        """Collect host and connection metrics for every instance in one _msearch round trip"""
+        host_ips = [instance['IP Address'] for instance in self.service_instances]
+        
+        now = datetime.datetime.now(datetime.timezone.utc)
+        host_start = (now - datetime.timedelta(minutes=HOST_METRICS_WINDOW)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        end_time = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        conn_start, _ = self.get_zeek_time_window()
+        
+        batch = SearchBatch(
+            ELASTIC_URL,
+            (ELASTIC_USERNAME, ELASTIC_PASSWORD),
+            timeout=(http_transport.CONNECT_TIMEOUT, INSTANCE_DEADLINE)
+        )
+        batch.add("host", build_fleet_metrics_query(host_ips, host_start, end_time), template="fleet_metrics")
+        batch.add("conn", build_conn_aggregation_query(host_ips, conn_start, end_time), template="zeek_conn_aggregates")
+        # filter_path would apply to every search in the _msearch, so the rate search returns in full here
+        net_query, _ = self.network_rate_query(host_ips, host_start, end_time)
+        batch.add("net", net_query, template=f"network_{NETWORK_RATE_MODE}")
+        
+        logger.info(f"Aggregating host and Zeek metrics for {len(host_ips)} instances via _msearch")
+        try:
+            with instrumentation.phase("collect_msearch"):
+                responses = batch.execute()
+        except Exception as e:
+            logger.error(f"Batched metric query failed, using defaults: {e}")
+            responses = {}
+        
+        host_result = responses.get("host", {})
+        conn_result = responses.get("conn", {})
+        net_result = responses.get("net", {})
+        for source, result in (("host", host_result), ("conn", conn_result), ("net", net_result)):
+            if 'error' in result:
+                logger.error(f"Fleet {source} aggregation failed: {result['error']}")
+        
+        window_seconds = HOST_METRICS_WINDOW * 60
+        self.host_metrics = parse_fleet_metrics(host_result, window_seconds) if 'error' not in host_result else {}
+        conn_table = parse_conn_aggregation(conn_result) if 'error' not in conn_result else {}
+        if net_result and 'error' not in net_result:
+            self.merge_network_rates(self.network_rate_table(net_result, host_start, end_time))
+        
+        for instance in self.service_instances:
+            ip_address = instance['IP Address']
+            metrics = {
+                'node_name': instance['Node'],
+                'service_id': instance['Service ID']
+            }
+            add_metrics(metrics, self.get_network_metrics(ip_address))
+            add_metrics(metrics, self.conn_metrics_from_aggregate(ip_address, conn_table.get(ip_address)))
             
-            # Log the collected metrics
-            logger.info(f"Metrics for {ip_address}: {json.dumps(self.instance_metrics[ip_address], indent=2)}")
+            self.instance_metrics[ip_address] = metrics
+            logger.info("Metrics for %s", ip_address, extra=instance_detail(ip_address, metrics=metrics))
     
-    def get_network_metrics(self, ip_address):
-        """Get network and host metrics for a specific IP"""
-        logger.info(f"Getting network and host metrics for {ip_address}")
+    def collect_instance_metrics(self, instance, deadline=None):
+        """Collect network and connection metrics for a single service instance"""
+        ip_address = instance['IP Address']
+        logger.info("Collecting metrics for %s", ip_address, extra=instance_detail(ip_address))
         
-        # Initialize metrics
+        # Initialize metrics for this instance
         metrics = {
-            'cpu_utilization': 50,
-            'ram_utilization': 50,
-            'trend_coefficient': 0
+            'node_name': instance['Node'],
+            'service_id': instance['Service ID']
         }
         
-        # Add IP-based variation for testing
-        ip_sum = sum(int(octet) for octet in ip_address.split('.'))
-        metrics['cpu_utilization'] = max(5, min(95, 20 + (ip_sum % 60)))  # Range: 20-80%
-        metrics['ram_utilization'] = max(5, min(90, 30 + ((ip_sum * 31) % 40)))  # Range: 30-70%
-        metrics['trend_coefficient'] = ((ip_sum * 17) % 200 - 100) / 100  # Range: -1 to 1
+        # 1. Look up host metrics from the fleet aggregation
+        network_metrics = self.get_network_metrics(ip_address)
+        
+        # 2. Collect connection-level metrics from Zeek logs
+        conn_metrics = self.get_zeek_connection_metrics(ip_address, deadline)
         
-        logger.info(f"Created unique metrics for {ip_address}: CPU={metrics['cpu_utilization']}%, RAM={metrics['ram_utilization']}%, Trend={metrics['trend_coefficient']}")
+        # 3. Combine all metrics
+        add_metrics(metrics, network_metrics)
+        add_metrics(metrics, conn_metrics)
+        
+        # Log the collected metrics
+        logger.info("Metrics for %s", ip_address, extra=instance_detail(ip_address, metrics=metrics))
         
         return metrics
-
-    def get_zeek_connection_metrics(self, ip_address):
-        """Get connection metrics for a specific IP"""
-        logger.info(f"Getting Zeek connection metrics for {ip_address}")
+    
+    def get_fleet_host_metrics(self, instances=None):
+        """Fetch CPU, RAM and network figures for every instance with one aggregation request"""
+        query_metricbeat.ELASTIC_URL = ELASTIC_URL
+        query_metricbeat.USERNAME = ELASTIC_USERNAME
+        query_metricbeat.PASSWORD = ELASTIC_PASSWORD
         
-        # Initialize default metrics
+        now = datetime.datetime.now(datetime.timezone.utc)
+        past = now - datetime.timedelta(minutes=HOST_METRICS_WINDOW)
+        host_ips = [instance['IP Address'] for instance in (instances or self.service_instances)]
+        
+        try:
+            with instrumentation.phase("collect_host"):
+                table = query_fleet_metrics(
+                    host_ips,
+                    past.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                )
+        except Exception as e:
+            logger.error(f"Error fetching fleet host metrics: {e}")
+            table = None
+        
+        if table is None:
+            return {}
+        logger.info(f"Fleet aggregation returned host metrics for {len(table)}/{len(host_ips)} instances")
+        
+        try:
+            with instrumentation.phase("collect_network"):
+                rates = self.get_fleet_network_rates(host_ips, past, now)
+        except Exception as e:
+            logger.error(f"Error fetching network counters, keeping aggregate rates: {e}")
+            rates = {}
+        for ip_address, entry in rates.items():
+            table.setdefault(ip_address, {}).update(entry)
+        return table
+    
+    def get_fleet_network_rates(self, host_ips, start, end):
+        """Per-host network rates from interface counters (resets/wraps handled, capacity-limited)"""
+        start_time = start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        end_time = end.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        query, filter_path = self.network_rate_query(host_ips, start_time, end_time)
+        template = f"network_{NETWORK_RATE_MODE}"
+        response = http_transport.post(
+            f"{ELASTIC_URL}/_search",
+            params={"filter_path": filter_path} if filter_path else None,
+            json=query_costs.prepare(template, query),
+            compress=True,
+            auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD),
+            verify=False
+        )
+        response.raise_for_status()
+        result = response.json()
+        query_costs.record(template, result, response.elapsed.total_seconds())
+        return self.network_rate_entries(self.network_rate_table(result, start_time, end_time))
+    
+    def network_rate_query(self, host_ips, start_time, end_time):
+        """(query, filter_path) for NETWORK_RATE_MODE; filter_path is None when the whole response is needed"""
+        if NETWORK_RATE_MODE == "server":
+            return build_rate_query(host_ips, start_time, end_time)
+        return build_counter_query(host_ips, start_time, end_time), None
+    
+    def network_rate_table(self, result, start_time, end_time):
+        """Parse a network_rate_query response into the fleet rate table"""
+        if NETWORK_RATE_MODE == "server":
+            return server_rate_table(result, rate_interval(start_time, end_time))
+        return fleet_rate_table(series_from_counter_aggregation(result))
+    
+    def network_rate_entries(self, table):
+        """The fleet rate table fields that feed host metrics and scoring"""
+        return {
+            ip_address: {key: entry[key] for key in ('net_in_rate', 'net_out_rate', 'net_in_peak', 'net_out_peak',
+                                                      'net_utilization', 'counter_resets')}
+            for ip_address, entry in table.items() if entry['interfaces']
+        }
+    
+    def merge_network_rates(self, table):
+        """Overlay interface network rates on the host metrics from the fleet aggregation"""
+        for ip_address, entry in self.network_rate_entries(table).items():
+            self.host_metrics.setdefault(ip_address, {}).update(entry)
+    
+    def get_network_metrics(self, ip_address):
+        """Get network and host metrics for a specific IP from the fleet aggregation"""
+        # Neutral defaults for hosts the aggregation did not cover
         metrics = {
-            'avg_connection_duration': 150,  # Default in milliseconds
-            'bytes_sent': 12500,            # Default
-            'bytes_received': 45000,        # Default
-            'error_ratio': 0.02             # Default
+            'cpu_utilization': 50,
+            'ram_utilization': 50,
+            'trend_coefficient': 0
         }
         
+        host_metrics = self.host_metrics.get(ip_address)
+        if host_metrics:
+            metrics.update(host_metrics)
+            logger.info("Host metrics for %s", ip_address, extra=instance_detail(
+                ip_address, cpu=metrics['cpu_utilization'], ram=metrics['ram_utilization'], trend=metrics['trend_coefficient']))
+        else:
+            logger.warning(f"No metricbeat data for {ip_address}, using default host metrics")
+            metrics['defaulted_metrics'] = list(metrics)
+        
+        return metrics
+
+    def get_zeek_time_window(self):
+        """Return the (start, end) timestamps of the Zeek lookback window"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        past = now - datetime.timedelta(minutes=ZEEK_WINDOW)
+        return past.strftime('%Y-%m-%dT%H:%M:%S.000Z'), now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    
+    def get_zeek_connection_metrics(self, ip_address, deadline=None):
+        """Get connection metrics for a specific IP, giving up after deadline seconds"""
+        logger.info("Getting Zeek connection metrics for %s", ip_address, extra=instance_detail(ip_address))
+        
         try:
-            # DIRECT APPROACH: Instead of setting globals, construct the query directly
-            # Set time range
-            now = datetime.datetime.now(datetime.timezone.utc)
-            past = now - datetime.timedelta(minutes=10)
-            start_time = past.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-            end_time = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
-            
-            # Construct Elasticsearch query directly specifying the IP
-            query = {
-                "size": 1000,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {
-                                "bool": {
-                                    "should": [
-                                        {"term": {"conn.id.orig_h": ip_address}},
-                                        {"term": {"conn.id.resp_h": ip_address}}
-                                    ],
-                                    "minimum_should_match": 1
-                                }
-                            },
-                            {"term": {"log_type": "zeek"}},
-                            {"term": {"filter_match_status": "conn"}},
-                            {"range": {"@timestamp": {"gte": start_time, "lte": end_time}}}
-                        ]
-                    }
-                }
-            }
-            
-            # Execute the query directly
-            logger.info(f"Directly querying Zeek logs for IP: {ip_address}")
-            response = requests.post(
-                f"{ELASTIC_URL}/_search",
-                json=query,
-                auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD),
-                verify=False
-            )
+            start_time, end_time = self.get_zeek_time_window()
+            query = build_conn_aggregation_query([ip_address], start_time, end_time)
+            
+            # Connection statistics are aggregated server-side, no raw hits are transferred
+            with instrumentation.phase("collect_zeek"):
+                response = http_transport.post(
+                    f"{ELASTIC_URL}/_search",
+                    json=query_costs.prepare("zeek_conn_aggregates", query),
+                    compress=True,
+                    auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD),
+                    timeout=(http_transport.CONNECT_TIMEOUT, deadline or http_transport.READ_TIMEOUT),
+                    verify=False
+                )
             
-            if response.status_code == 200:
-                result = response.json()
-                hits = result.get('hits', {}).get('hits', [])
-                hit_count = len(hits)
-                
-                logger.info(f"Found {hit_count} Zeek logs for {ip_address}")
-                
-                if hit_count > 0:
-                    # Process hits exactly as before
-                    durations_ms = []
-                    bytes_sent = 0
-                    bytes_received = 0
-                    error_count = 0
-                    
-                    for hit in hits:
-                        source = hit.get('_source', {})
-                        conn = source.get('conn', {})
-                        
-                        # Same processing as before
-                        # ...
-                    
-                    # Add IP-based variation for testing (temporary)
-                    ip_sum = sum(int(octet) for octet in ip_address.split('.'))
-                    metrics['avg_connection_duration'] = 50 + (ip_sum % 300)  # 50-350ms range
-                    metrics['bytes_sent'] = 8000 + (ip_sum * 997) % 50000
-                    metrics['bytes_received'] = 20000 + (ip_sum * 571) % 100000
-                    metrics['error_ratio'] = max(0.001, min(0.05, (ip_sum % 50) / 1000))
-                    
-                    logger.info(f"Added variation for {ip_address}: duration={metrics['avg_connection_duration']}ms")
+            if response.status_code != 200:
+                logger.error(f"Zeek aggregation for {ip_address} returned {response.status_code}")
+                return self.conn_metrics_from_aggregate(ip_address, None)
             
-            return metrics
+            result = response.json()
+            query_costs.record("zeek_conn_aggregates", result, response.elapsed.total_seconds())
+            table = parse_conn_aggregation(result)
+            return self.conn_metrics_from_aggregate(ip_address, table.get(ip_address))
             
         except Exception as e:
             logger.error(f"Error getting Zeek metrics for {ip_address}: {e}")
             import traceback
             logger.error(traceback.format_exc())
+            return self.conn_metrics_from_aggregate(ip_address, None)
+    
+    def conn_metrics_from_aggregate(self, ip_address, aggregate):
+        """Map a Zeek connection aggregate onto the metrics used for scoring"""
+        # Initialize default metrics
+        metrics = {
+            'avg_connection_duration': 150,  # Default in milliseconds
+            'bytes_sent': 12500,            # Default
+            'bytes_received': 45000,        # Default
+            'error_ratio': 0.02             # Default
+        }
+        
+        if not aggregate or aggregate['count'] == 0:
+            logger.info(f"No Zeek connections for {ip_address}, using default connection metrics")
+            metrics['defaulted_metrics'] = list(metrics)
             return metrics
+        
+        # Zeek reports durations in seconds; scoring works in milliseconds
+        if aggregate['duration_count'] > 0:
+            metrics['avg_connection_duration'] = aggregate['avg_duration'] * 1000
+        else:
+            metrics['defaulted_metrics'] = ['avg_connection_duration']
+        if aggregate.get('duration_sketch'):
+            # The tail the mean hides: p50/p95/p99 from the window's latency sketch
+            for percent, duration in DurationSketch(aggregate['duration_sketch']).quantiles().items():
+                if duration is not None:
+                    metrics[f'conn_duration_p{percent}'] = duration * 1000
+        metrics['bytes_sent'] = aggregate['bytes_sent']
+        metrics['bytes_received'] = aggregate['bytes_received']
+        metrics['error_ratio'] = aggregate['error_ratio']
+        metrics['connection_count'] = aggregate['count']
+        
+        logger.info("Connection metrics for %s", ip_address, extra=instance_detail(
+            ip_address, connections=aggregate['count'], duration_ms=metrics['avg_connection_duration'],
+            p99_ms=metrics.get('conn_duration_p99'), error_ratio=metrics['error_ratio']))
+        
+        return metrics
     
-    def calculate_weights(self):
-        """Calculate normalized scores and weighted values for each instance"""
+    def calculate_weights(self, ip_addresses=None):
+        """Calculate normalized scores and weighted values for each instance (or only the given IPs)"""
         logger.info("Calculating normalized scores and weights")
         
-        # Define metric weights (importance of each metric)
-        metric_weights = {
-            'cpu_utilization': 0.15,      # 15%
-            'ram_utilization': 0.15,      # 15%
-            'trend_coefficient': 0.20,    # 20%
-            'avg_connection_duration': 0.20,  # 20%
-            'bytes_sent': 0.10,           # 10%
-            'bytes_received': 0.10,       # 10%
-            'error_ratio': 0.10           # 10%
-        }
+        previous = dict(self.weights)
+        if ip_addresses is None:
+            weights = {}
+            targets = list(self.instance_metrics)
+        else:
+            weights = dict(previous)
+            targets = [ip for ip in ip_addresses if ip in self.instance_metrics]
+        if not targets:
+            if ip_addresses is None:
+                with self.publish_lock:
+                    self.weights = weights
+            return
         
-        # Calculate normalized scores and weights for each instance
-        self.weights = {}
+        # Pick up profile edits made since the last cycle
+        self.profiles.reload()
+        profile = self.profiles.for_service(SERVICE_NAME)
         
-        for ip_address, metrics in self.instance_metrics.items():
-            # Initialize score components
-            scores = {}
-            
-            # 1. Normalize CPU utilization (lower is better, below 10% is optimal)
-            cpu = metrics.get('cpu_utilization', 50)
-            if cpu <= 10:
-                scores['cpu_utilization'] = 100
-            else:
-                # Inversely proportional to CPU usage
-                scores['cpu_utilization'] = max(0, 100 - cpu)
-            
-            # 2. Normalize RAM utilization (lower is better, below 10% is optimal)
-            ram = metrics.get('ram_utilization', 50)
-            if ram <= 10:
-                scores['ram_utilization'] = 100
-            else:
-                # Inversely proportional to RAM usage
-                scores['ram_utilization'] = max(0, 100 - ram)
-            
-            # 3. Normalize trend coefficient (higher is better, range -1 to 1)
-            trend = metrics.get('trend_coefficient', 0)
-            # Convert from -1...1 to 0...100
-            scores['trend_coefficient'] = (trend + 1) * 50
-            
-            # 4. Normalize avg connection duration (lower is better) - now using milliseconds
-            duration_ms = metrics.get('avg_connection_duration', 150)  # Default 150ms
-            # Ideal range is 100-200 milliseconds (was 0.1-0.2 seconds)
-            if duration_ms <= 200:
-                scores['avg_connection_duration'] = 100
-            else:
-                # Penalty of 20 points for each 100ms above ideal
-                penalty = ((duration_ms - 200) / 100) * 20
-                scores['avg_connection_duration'] = max(0, 100 - penalty)
-            
-            # 5. Normalize bytes sent (higher generally better, but moderate is best)
-            bytes_sent = metrics.get('bytes_sent', 10000)
-            # Score best between 10KB and 50KB per 10 min interval
-            if 10000 <= bytes_sent <= 50000:
-                scores['bytes_sent'] = 100
-            elif bytes_sent < 10000:
-                # Linearly reduce for lower values
-                scores['bytes_sent'] = (bytes_sent / 10000) * 100
-            else:
-                # Slightly penalize very high values (possible overuse)
-                scores['bytes_sent'] = max(50, 100 - ((bytes_sent - 50000) / 50000) * 10)
-            
-            # 6. Normalize bytes received (higher generally better, but moderate is best)
-            bytes_received = metrics.get('bytes_received', 30000)
-            # Score best between 20KB and 100KB per 10 min interval
-            if 20000 <= bytes_received <= 100000:
-                scores['bytes_received'] = 100
-            elif bytes_received < 20000:
-                # Linearly reduce for lower values
-                scores['bytes_received'] = (bytes_received / 20000) * 100
-            else:
-                # Slightly penalize very high values (possible overuse)
-                scores['bytes_received'] = max(50, 100 - ((bytes_received - 100000) / 100000) * 10)
-            
-            # 7. Normalize error ratio (lower is better)
-            error_ratio = metrics.get('error_ratio', 0.02)
-            if error_ratio <= 0.01:
-                scores['error_ratio'] = 100
-            else:
-                # Steep penalty for errors
-                scores['error_ratio'] = max(0, 100 - (error_ratio * 2000))
-            
-            # Calculate weighted score
-            weighted_score = 0
-            for metric, score in scores.items():
-                weighted_score += score * metric_weights.get(metric, 0)
-            
-            # Round to nearest integer for Fabio compatibility
-            final_weight = round(weighted_score)
+        # Score the whole fleet at once as metric columns
+        metrics_list = [self.instance_metrics[ip] for ip in targets]
+        scores, weighted, final = score_instances(metrics_list, profile)
+        score_rows = {metric: values.tolist() for metric, values in scores.items()}
+        weighted = weighted.tolist()
+        final = final.tolist()
+        
+        for i, ip_address in enumerate(targets):
+            metrics = metrics_list[i]
             
             # Store both the detailed scores and final weight
-            self.weights[ip_address] = {
-                'scores': scores,
-                'weighted_score': weighted_score,
-                'final_weight': final_weight,
+            weights[ip_address] = {
+                'scores': {metric: values[i] for metric, values in score_rows.items()},
+                'weighted_score': weighted[i],
+                'final_weight': final[i],
                 'node_name': metrics.get('node_name'),
                 'service_id': metrics.get('service_id')
             }
-            
-            logger.info(f"Weight calculation for {ip_address} ({metrics.get('node_name')}):")
-            logger.info(f"  Scores: {json.dumps(scores, indent=2)}")
-            logger.info(f"  Weighted score: {weighted_score:.2f}")
-            logger.info(f"  Final weight: {final_weight}")
+            logger.debug("Weight for %s", ip_address, extra=instance_detail(
+                ip_address, scores=weights[ip_address]['scores'], weighted_score=weighted[i], final_weight=final[i]))
+        
+        logger.info(f"Scored {len(targets)} instances with profile '{profile.name}': final weights "
+                    f"{min(final)}-{max(final)} (mean {sum(final) / len(final):.1f})")
+        
+        # Built aside and swapped in under the lock the health loop publishes with
+        with self.publish_lock:
+            self.weights = weights
+        
+        instrumentation.record_weights(previous, {ip: weights[ip] for ip in targets})
+        if ip_addresses is None:
+            instrumentation.forget_instances(set(self.weights))
+    
+    def effective_weight(self, ip_address, weight_data):
+        """The scored weight, lowered by the fast loop's health factor (never raised); 0 for a factor of 0"""
+        final_weight = weight_data['final_weight']
+        if self.health is None:
+            return final_weight
+        factor = self.health.factor(ip_address)
+        if factor <= 0:
+            # Known down (critical check or draining error ratio): no traffic at all
+            return 0
+        return min(final_weight, max(1, round(final_weight * factor)))
     
-    def update_consul_weights(self):
-        """Update the weights in Consul for each service instance"""
+    def update_consul_weights(self, ip_addresses=None):
+        """Update the weights in Consul for each service instance (or only the given IPs).
+        
+        Both loops publish through here; the lock keeps one writer at a time, so
+        a published weight always combines the latest score and health factor.
+        """
         logger.info("Updating weights in Consul")
         
-        for ip_address, weight_data in self.weights.items():
-            final_weight = weight_data['final_weight']
-            service_id = weight_data['service_id']
-            node_name = weight_data['node_name']
+        with self.publish_lock:
+            weights = {}
+            published = {}
+            for ip_address, weight_data in list(self.weights.items()):
+                if ip_addresses is not None and ip_address not in ip_addresses:
+                    continue
+                weight = self.effective_weight(ip_address, weight_data)
+                weights[weight_data['service_id']] = weight
+                published[weight_data['service_id']] = (ip_address, weight)
+                logger.info("Updating weight for %s", ip_address, extra=instance_detail(
+                    ip_address, node=weight_data['node_name'], weight=weight, scored_weight=weight_data['final_weight']))
             
-            logger.info(f"Updating weight for {node_name} ({ip_address}) to {final_weight}")
+            if not weights:
+                return {}
             
-            protocol = "https" if USE_HTTPS else "http"
+            if self.weight_writer is None:
+                protocol = "https" if USE_HTTPS else "http"
+                self.weight_writer = ConsulWeightWriter(f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}", SERVICE_NAME)
             
             try:
-                # Step 1: Find service details
-                agent_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/agent/service/{service_id}"
-                agent_response = requests.get(agent_url, verify=False)
-                
-                if agent_response.status_code != 200:
-                    logger.error(f"Error getting service details: {agent_response.status_code}")
-                    continue
-                    
-                service_details = agent_response.json()
-                
-                # Step 2: Update the weight in the tags
-                current_tags = service_details.get('Tags', [])
-                new_tags = []
-                weight_updated = False
-                
-                for tag in current_tags:
-                    if 'urlprefix-/api weight=' in tag:
-                        # Replace the weight value
-                        parts = tag.split('weight=')
-                        new_tag = f"{parts[0]}weight={final_weight}"
-                        new_tags.append(new_tag)
-                        weight_updated = True
-                        logger.info(f"Updating tag from '{tag}' to '{new_tag}'")
-                    else:
-                        new_tags.append(tag)
-                
-                # If no matching tag was found, add a new one
-                if not weight_updated:
-                    new_tag = f"urlprefix-/api weight={final_weight}"
-                    new_tags.append(new_tag)
-                    logger.info(f"Adding new tag: '{new_tag}'")
-                
-                # Step 3: Prepare the updated service registration payload
-                updated_service = {
-                    "ID": service_id,
-                    "Name": service_details.get('Service'),
-                    "Tags": new_tags,
-                    "Address": ip_address,  # Use the correct IP here!
-                    "Port": service_details.get('Port', 0)
-                }
-                
-                # Add Meta field only if it exists in original service
-                if 'Meta' in service_details:
-                    updated_service["Meta"] = service_details.get('Meta', {})
-                    
-                logger.info(f"Sending updated service registration: {json.dumps(updated_service, indent=2)}")
-                
-                # Step 4: Re-register the service with updated tags
-                register_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/agent/service/register"
-                register_response = requests.put(
-                    register_url,
-                    json=updated_service,
-                    verify=False
-                )
-                
-                if register_response.status_code == 200:
-                    logger.info(f"Successfully updated weight for {service_id}")
-                else:
-                    logger.error(f"Error updating service: {register_response.status_code}")
-                    logger.error(f"Response: {register_response.text}")
-                
+                # The watcher's catalog already carries the tags, EnableTagOverride and ModifyIndex values
+                catalog = self.watcher.get_catalog() if self.watcher is not None else None
+                results = self.weight_writer.write(weights, catalog or None)
             except Exception as e:
-                logger.error(f"Error updating weight for {ip_address}: {e}")
-                import traceback
-                logger.error(traceback.format_exc())
+                logger.error(f"Error updating weights in Consul: {e}")
+                for ip_address, _ in published.values():
+                    self.record_publish_failure(ip_address)
+                raise
+            
+            for service_id, result in results.items():
+                ip_address, weight = published[service_id]
+                if result in (consul_weights.UPDATED, consul_weights.UNCHANGED):
+                    self.published[ip_address] = weight
+                    self.publish_failures.pop(ip_address, None)
+                    logger.info("Weight for %s: %s", service_id, result, extra=instance_detail(ip_address))
+                else:
+                    retry_in = self.record_publish_failure(ip_address)
+                    logger.error(f"Weight for {service_id} not written: {result} (health loop retries in {retry_in}s)")
+            return results
+    
+    def record_publish_failure(self, ip_address):
+        """Back off the health loop's retries for an instance whose write failed; returns the delay in seconds"""
+        failures = self.publish_failures.get(ip_address, (0, 0))[0] + 1
+        retry_in = min(PUBLISH_RETRY_MAX, PUBLISH_RETRY_BACKOFF * 2 ** (failures - 1))
+        self.publish_failures[ip_address] = (failures, time.monotonic() + retry_in)
+        return retry_in
+    
+    def start_health_loop(self):
+        """Start the fast loop that checks error ratio, latency and Consul health every HEALTH_INTERVAL"""
+        protocol = "https" if USE_HTTPS else "http"
+        self.health = HealthMonitor(ELASTIC_URL, (ELASTIC_USERNAME, ELASTIC_PASSWORD),
+                                    f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}", SERVICE_NAME)
+        self.health_loop = HealthLoop(self.health_check, HEALTH_INTERVAL)
+        self.health_loop.start()
+    
+    def health_check(self):
+        """One fast-loop pass: refresh health factors and republish weights that moved"""
+        weights = dict(self.weights)
+        if not weights:
+            return
+        
+        instances = {ip_address: weight_data['service_id'] for ip_address, weight_data in weights.items()}
+        baselines = {ip_address: self.instance_metrics.get(ip_address, {}).get('avg_connection_duration')
+                     for ip_address in instances}
+        signals = self.health.read_signals(instances)
+        self.health.update(signals, baselines)
+        
+        # Publish only where the effective weight differs from what Consul last got, leaving instances
+        # whose last write failed to the next full cycle until their backoff runs out
+        now = time.monotonic()
+        stale = [ip_address for ip_address, weight_data in weights.items()
+                 if self.published.get(ip_address) != self.effective_weight(ip_address, weight_data)
+                 and self.publish_failures.get(ip_address, (0, 0))[1] <= now]
+        if stale:
+            logger.info(f"Health check republishing {len(stale)} weights")
+            self.update_consul_weights(stale)
     
     def export_results(self):
-        """Export weight calculation results to Excel and JSON"""
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Create a dataframe for Excel export
-        data = []
-        for ip_address, weight_data in self.weights.items():
-            row = {
-                'IP Address': ip_address,
-                'Node Name': weight_data['node_name'],
-                'Service ID': weight_data['service_id'],
-                'Final Weight': weight_data['final_weight'],
-                'Weighted Score': weight_data['weighted_score']
-            }
-            
-            # Add all scores
-            for metric, score in weight_data['scores'].items():
-                row[f"{metric} Score"] = score
-            
-            # Add all raw metrics
-            metrics = self.instance_metrics.get(ip_address, {})
-            for metric, value in metrics.items():
-                if metric not in ['node_name', 'service_id']:
-                    row[f"{metric} Raw"] = value
-            
-            data.append(row)
+        """Hand this cycle's metrics, scores and weights to the background export writer"""
+        if not self.weights:
+            return
         
-        # Create DataFrame and export to Excel
-        if data:
-            df = pd.DataFrame(data)
-            
-            # Export to Excel
-            excel_file = f"load_balancing_weights_{timestamp}.xlsx"
-            writer = pd.ExcelWriter(excel_file, engine='openpyxl')
-            df.to_excel(writer, index=False, sheet_name='Weights')
-            
-            # Auto-adjust columns width
-            for column in df:
-                column_length = max(df[column].astype(str).map(len).max(), len(column))
-                col_idx = df.columns.get_loc(column)
-                writer.sheets['Weights'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
-            
-            writer.close()
-            logger.info(f"Exported weights to {excel_file}")
-            
-            # Export to JSON
-            json_file = f"load_balancing_weights_{timestamp}.json"
-            with open(json_file, 'w') as f:
-                combined_data = {
-                    'timestamp': timestamp,
-                    'service_name': SERVICE_NAME,
-                    'instances': self.instance_metrics,
-                    'weights': self.weights
-                }
-                json.dump(combined_data, f, indent=2, default=str)
-            
-            logger.info(f"Exported JSON data to {json_file}")
+        if self.exporter is None:
+            self.exporter = ExportWriter(self.history, self.export_cycle_workbook if EXPORT_EXCEL else None)
+            self.exporter.start()
+            atexit.register(self.exporter.close, EXPORT_CLOSE_TIMEOUT)
+        
+        # Snapshot now; the writer persists it while the next cycle runs
+        outcome = self.exporter.submit(CycleSnapshot(SERVICE_NAME, self.weights, self.instance_metrics))
+        logger.info(f"Cycle snapshot {outcome} for export ({self.exporter.backlog()} pending)")
+    
+    def export_cycle_workbook(self, snapshot):
+        """Render one recorded cycle to Excel (runs on the export writer thread)"""
+        timestamp = datetime.datetime.fromtimestamp(snapshot.timestamp).strftime("%Y%m%d_%H%M%S")
+        excel_file = f"load_balancing_weights_{timestamp}.xlsx"
+        self.history.export_excel(excel_file, start=snapshot.timestamp, end=snapshot.timestamp,
+                                  service_name=snapshot.service_name)
+        logger.info(f"Exported weights to {excel_file}")
 
 if __name__ == "__main__":
     balancer = DynamicLoadBalancer()
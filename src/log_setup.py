@@ -0,0 +1,118 @@
+import json
+import zlib
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# Logging configuration
+LOG_FILE = "load_balancer.log"
+LOG_FORMAT = "json"  # "json" for one compact JSON object per line, "text" for the classic format
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Rotate the log file at this size
+LOG_BACKUP_COUNT = 5  # Rotated files kept
+INSTANCE_SAMPLE_RATE = 0.1  # Share of instances whose per-instance detail records are logged
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def instance_detail(key, **fields):
+    """extra= for a per-instance record: sampled by key, fields serialized only if emitted.
+
+    key is always the instance's IP address, so an instance is either in the
+    sample for every record or for none.
+
+    logger.info("Metrics for %s", ip, extra=instance_detail(ip, metrics=metrics))
+    """
+    return {"sample_key": key, "fields": fields}
+
+
+def fields(**values):
+    """extra= carrying structured fields, serialized only if the record is emitted"""
+    return {"fields": values}
+
+
+class InstanceSampler(logging.Filter):
+    """Keeps a stable subset of instances' detail records (same instances every cycle)"""
+
+    def __init__(self, rate=INSTANCE_SAMPLE_RATE):
+        super().__init__()
+        self.threshold = int(rate * 10000)
+
+    def filter(self, record):
+        key = getattr(record, "sample_key", None)
+        # Warnings and errors are always kept, sampled instance or not
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        return zlib.crc32(str(key).encode()) % 10000 < self.threshold
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that freezes structured fields as compact JSON before the record is queued.
+
+    This runs only for records that passed the level check and filters, and
+    snapshots the payload so later mutation by the caller cannot leak into
+    the log line written on the listener thread.
+    """
+
+    def prepare(self, record):
+        payload = getattr(record, "fields", None)
+        if payload:
+            record.fields_json = json.dumps(payload, separators=(",", ":"), default=str)
+        record.fields = None
+        return super().prepare(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any structured fields"""
+
+    def format(self, record):
+        line = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        if getattr(record, "sample_key", None) is not None:
+            line["key"] = record.sample_key
+        fields_json = getattr(record, "fields_json", None)
+        text = json.dumps(line, separators=(",", ":"), default=str)
+        if fields_json:
+            text = f'{text[:-1]},"fields":{fields_json}}}'
+        return text
+
+
+class TextFormatter(logging.Formatter):
+    """The classic text format, with structured fields appended as compact JSON"""
+
+    def format(self, record):
+        text = super().format(record)
+        fields_json = getattr(record, "fields_json", None)
+        return f"{text} {fields_json}" if fields_json else text
+
+
+def setup_logging(log_file=LOG_FILE, log_format=LOG_FORMAT, level=logging.INFO, sample_rate=INSTANCE_SAMPLE_RATE):
+    """Route the root logger through a queue to a rotating file and stdout; returns the listener.
+
+    Callers only enqueue records; formatting and I/O happen on the listener
+    thread, which is stopped (and drained) at exit.
+    """
+    formatter = JsonFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT)
+
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(InstanceSampler(sample_rate))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -27,25 +27,33 @@ def main():
     
     results = {}
 
+    valid_services = []
     for service in services:
         svc_name = service.get("ServiceName")
         svc_ip = service.get("ServiceAddress")
         if svc_name and svc_ip:
-            logging.info("Processing service '%s' with IP %s", svc_name, svc_ip)
-            cpu_ram_metrics = elastic_client.get_cpu_ram_metrics(svc_ip, start_time, end_time)
-            avg_conn_duration = elastic_client.get_zeek_avg_conn_duration(lb_ip, svc_ip, start_time, end_time)
-            
-            results[svc_name + "_" + svc_ip] = {
-                "cpu_average": cpu_ram_metrics['cpu_average'],
-                "ram_average": cpu_ram_metrics['ram_average'],
-                "cpu_trend": cpu_ram_metrics['cpu_trend'],
-                "ram_trend": cpu_ram_metrics['ram_trend'],
-                "avg_connection_duration": avg_conn_duration
-            }
-            logging.info("Updated results for '%s' with IP %s", svc_name, svc_ip)
+            valid_services.append((svc_name, svc_ip))
         else:
             logging.warning("Skipping service due to missing keys: %s", service)
 
+    # One batched _msearch pass covers every service instead of two searches each
+    service_ips = [svc_ip for _, svc_ip in valid_services]
+    logging.info("Fetching metrics for %d service(s) in one batch", len(service_ips))
+    batch_metrics = elastic_client.get_metrics_batch(lb_ip, service_ips, start_time, end_time)
+
+    for svc_name, svc_ip in valid_services:
+        logging.info("Processing service '%s' with IP %s", svc_name, svc_ip)
+        metrics = batch_metrics[svc_ip]
+
+        results[svc_name + "_" + svc_ip] = {
+            "cpu_average": metrics['cpu_average'],
+            "ram_average": metrics['ram_average'],
+            "cpu_trend": metrics['cpu_trend'],
+            "ram_trend": metrics['ram_trend'],
+            "avg_connection_duration": metrics['avg_connection_duration']
+        }
+        logging.info("Updated results for '%s' with IP %s", svc_name, svc_ip)
+
     with open('results.json', 'w') as json_file:
         json.dump(results, json_file, indent=4)
     logging.info("Results written to results.json")
@@ -0,0 +1,98 @@
+import time
+import threading
+import numpy as np
+
+# Time-series store configuration
+STORE_METRICS = (
+    "cpu_utilization",
+    "ram_utilization",
+    "net_in_rate",
+    "net_out_rate",
+    "avg_connection_duration",
+    "error_ratio"
+)
+RETENTION_SECONDS = 4 * 3600  # History kept per series
+SAMPLE_CAPACITY = 1440  # Fixed slots per series (one every 10 s over 4 h)
+
+
+class RingSeries:
+    """Fixed-size ring buffer of (timestamp, value) samples backed by NumPy arrays"""
+
+    def __init__(self, capacity=SAMPLE_CAPACITY):
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.capacity = capacity
+        self.head = 0  # Next slot to write
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def window(self, since=None):
+        """Return (timestamps, values) in time order, optionally only samples at or after since"""
+        if self.count < self.capacity:
+            timestamps = self.timestamps[:self.count]
+            values = self.values[:self.count]
+        else:
+            order = np.r_[self.head:self.capacity, 0:self.head]
+            timestamps = self.timestamps[order]
+            values = self.values[order]
+        if since is not None:
+            start = np.searchsorted(timestamps, since, side="left")
+            timestamps = timestamps[start:]
+            values = values[start:]
+        return timestamps, values
+
+
+class MetricStore:
+    """In-process history of per-backend metrics; memory is fixed per backend, not per document"""
+
+    def __init__(self, metrics=STORE_METRICS, capacity=SAMPLE_CAPACITY, retention=RETENTION_SECONDS):
+        self.metrics = tuple(metrics)
+        self.capacity = capacity
+        self.retention = retention
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def record(self, ip_address, metrics, timestamp=None):
+        """Append one sample of every tracked metric present in the metrics dict"""
+        timestamp = timestamp or time.time()
+        with self.lock:
+            host_series = self.series.setdefault(ip_address, {})
+            for name in self.metrics:
+                value = metrics.get(name)
+                if value is None:
+                    continue
+                series = host_series.get(name)
+                if series is None:
+                    series = host_series[name] = RingSeries(self.capacity)
+                series.append(timestamp, float(value))
+
+    def retain(self, ip_addresses):
+        """Drop history for backends no longer in the service"""
+        with self.lock:
+            for ip_address in list(self.series):
+                if ip_address not in ip_addresses:
+                    del self.series[ip_address]
+
+    def window(self, ip_address, metric, seconds=None, now=None):
+        """Return (timestamps, values) for the last seconds (default: the retention period)"""
+        now = now or time.time()
+        with self.lock:
+            series = self.series.get(ip_address, {}).get(metric)
+            if series is None:
+                return np.empty(0), np.empty(0)
+            timestamps, values = series.window(now - (seconds or self.retention))
+            return timestamps.copy(), values.copy()
+
+    def memory_bytes(self):
+        """Bytes held by the sample arrays (fixed per backend and metric)"""
+        with self.lock:
+            return sum(
+                series.timestamps.nbytes + series.values.nbytes
+                for host_series in self.series.values()
+                for series in host_series.values()
+            )
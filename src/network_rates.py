@@ -0,0 +1,426 @@
+import datetime
+import numpy as np
+
+# Rate engine configuration
+DEFAULT_CAPACITY = 125 * 1024 * 1024  # Bytes/s per direction for hosts not listed in HOST_CAPACITY
+HOST_CAPACITY = {}  # host IP -> link capacity in bytes/s per direction (e.g. {"10.0.0.5": 125 * 1024 * 1024})
+CAPACITY_SLACK = 1.1  # Intervals faster than capacity * slack are counter artifacts and dropped
+COUNTER_WRAP = 2 ** 32  # Interfaces with 32-bit counters wrap here
+WRAP_GUARD = 0.25  # A fall from the top quarter of 2**32 into the bottom quarter reads as a wrap
+COUNTER_INTERVAL = "30s"  # date_histogram bucket width of counter series (the narrowest rate bucket)
+MAX_RATE_BUCKETS = 240  # Buckets per interface a rate query may return; longer windows get wider buckets
+IGNORED_INTERFACES = ("lo",)
+COUNTER_FIELDS = ("in.bytes", "out.bytes")
+RATE_FIELDS = ("in.bytes", "out.bytes", "in.packets", "out.packets")
+
+
+def host_capacity(ip_address):
+    return HOST_CAPACITY.get(ip_address, DEFAULT_CAPACITY)
+
+
+def counter_delta(previous, current):
+    """Increase of a cumulative counter between two readings, allowing for a 32-bit wrap or a reset.
+
+    A wrap adds 2**32; any other fall is a reset (reboot, driver reload),
+    after which the counter restarted from zero, so the current value is
+    the traffic since the reset.
+    """
+    if current >= previous:
+        return current - previous
+    if previous >= (1 - WRAP_GUARD) * COUNTER_WRAP and previous < COUNTER_WRAP and current < WRAP_GUARD * COUNTER_WRAP:
+        return current + COUNTER_WRAP - previous
+    return current
+
+
+class RateResult:
+    """Per-interval rates of many counter series computed in one pass.
+
+    series, ends and seconds have one entry per interval; rates has one
+    column per counter (NaN where the interval was dropped). resets, wraps
+    and dropped count events per series.
+    """
+
+    def __init__(self, series, ends, seconds, rates, deltas, valid, resets, wraps, dropped):
+        self.series = series
+        self.ends = ends
+        self.seconds = seconds
+        self.rates = rates
+        self.deltas = deltas
+        self.valid = valid
+        self.resets = resets
+        self.wraps = wraps
+        self.dropped = dropped
+
+    def mean_rates(self, series_count):
+        """Counter increase over covered time per series (NaN for series without a valid interval)"""
+        seconds = np.bincount(self.series, weights=np.where(self.valid, self.seconds, 0), minlength=series_count)
+        means = np.full((series_count, self.rates.shape[1]), np.nan)
+        for column in range(self.rates.shape[1]):
+            total = np.bincount(self.series, weights=np.where(self.valid, self.deltas[:, column], 0),
+                                minlength=series_count)
+            np.divide(total, seconds, out=means[:, column], where=seconds > 0)
+        return means
+
+    def peak_rates(self, series_count):
+        peaks = np.full((series_count, self.rates.shape[1]), -np.inf)
+        for column in range(self.rates.shape[1]):
+            np.maximum.at(peaks[:, column], self.series[self.valid], self.rates[self.valid, column])
+        peaks[np.isinf(peaks)] = np.nan
+        return peaks
+
+
+def compute_rates(series, timestamps, counters, capacities=None):
+    """Turn cumulative counter readings of many series into per-interval rates with np.diff.
+
+    series: int array naming the series of each reading (any order)
+    timestamps: epoch seconds per reading
+    counters: (readings, k) array of cumulative counters
+    capacities: optional per-series limit (units/s); faster intervals are dropped
+    """
+    series = np.asarray(series, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    counters = np.asarray(counters, dtype=np.float64).reshape(len(series), -1)
+    series_count = int(series.max()) + 1 if len(series) else 0
+
+    order = np.lexsort((timestamps, series))
+    series, timestamps, counters = series[order], timestamps[order], counters[order]
+
+    previous, current = counters[:-1], counters[1:]
+    seconds = np.diff(timestamps)
+    same = (series[1:] == series[:-1]) & (seconds > 0)
+
+    deltas = current - previous
+    fell = deltas < 0
+    wrapped = fell & (previous >= (1 - WRAP_GUARD) * COUNTER_WRAP) & (previous < COUNTER_WRAP) & \
+        (current < WRAP_GUARD * COUNTER_WRAP)
+    reset = fell & ~wrapped
+    deltas = np.where(wrapped, deltas + COUNTER_WRAP, deltas)
+    deltas = np.where(reset, current, deltas)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = deltas / seconds[:, None]
+    valid = same.copy()
+    if capacities is not None:
+        limits = np.asarray(capacities, dtype=np.float64)[series[1:]] * CAPACITY_SLACK
+        too_fast = same & np.any(rates > limits[:, None], axis=1)
+        valid &= ~too_fast
+    else:
+        too_fast = np.zeros(len(seconds), dtype=bool)
+    rates[~valid] = np.nan
+
+    interval_series = series[1:]
+    return RateResult(
+        interval_series,
+        timestamps[1:],
+        seconds,
+        rates,
+        deltas,
+        valid,
+        np.bincount(interval_series, weights=same & np.any(reset, axis=1), minlength=series_count).astype(int),
+        np.bincount(interval_series, weights=same & np.any(wrapped, axis=1), minlength=series_count).astype(int),
+        np.bincount(interval_series, weights=too_fast, minlength=series_count).astype(int)
+    )
+
+
+class CounterSeries:
+    """Counter readings of many (host, interface) pairs gathered as flat arrays"""
+
+    def __init__(self):
+        self.keys = {}
+        self.series = []
+        self.timestamps = []
+        self.counters = []
+
+    def add(self, host_ip, interface, timestamp, values):
+        if interface in IGNORED_INTERFACES or any(value is None for value in values):
+            return
+        key = self.keys.setdefault((host_ip, interface), len(self.keys))
+        self.series.append(key)
+        self.timestamps.append(timestamp)
+        self.counters.append(values)
+
+    def __len__(self):
+        return len(self.series)
+
+    def rates(self):
+        """compute_rates over everything added, each series limited by its host's capacity"""
+        capacities = [host_capacity(host_ip) for host_ip, _ in self.keys]
+        return compute_rates(np.array(self.series, dtype=np.int64), np.array(self.timestamps, dtype=np.float64),
+                             np.array(self.counters, dtype=np.float64).reshape(len(self.series), len(COUNTER_FIELDS)),
+                             capacities)
+
+
+def _epoch(timestamp):
+    if isinstance(timestamp, (int, float)):
+        return timestamp / 1000 if timestamp > 1e11 else float(timestamp)
+    return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+def _counter_values(interface_data):
+    return [interface_data.get(field.split('.')[0], {}).get(field.split('.')[1]) for field in COUNTER_FIELDS]
+
+
+def series_from_hits(hits, host_ips=None):
+    """Collect CounterSeries from metricbeat network documents (flat or per-interface layout).
+
+    host.ip is often a list; the address counted is the one in host_ips, if given.
+    """
+    counters = CounterSeries()
+    wanted = set(host_ips or ())
+    for hit in hits:
+        source = hit.get('_source', {})
+        host_ip = source.get('host', {}).get('ip')
+        if isinstance(host_ip, list):
+            matches = [ip for ip in host_ip if ip in wanted] or host_ip
+            host_ip = matches[0] if matches else None
+        timestamp = source.get('@timestamp')
+        network_data = source.get('system', {}).get('network', {})
+        if not timestamp or not isinstance(network_data, dict):
+            continue
+        epoch = _epoch(timestamp)
+        if 'name' in network_data:
+            counters.add(host_ip, network_data['name'], epoch, _counter_values(network_data))
+        else:
+            for interface, interface_data in network_data.items():
+                if isinstance(interface_data, dict):
+                    counters.add(host_ip, interface, epoch, _counter_values(interface_data))
+    return counters
+
+
+def build_counter_query(host_ips, start_time, end_time, interval=COUNTER_INTERVAL):
+    """Size-0 query returning the highest counter reading per host, interface and time bucket"""
+    host_ips = list(host_ips)
+    return {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {"host.ip": host_ips}},
+                    {"term": {"metricset.name": "network"}},
+                    {"range": {"@timestamp": {"gte": start_time, "lte": end_time}}}
+                ]
+            }
+        },
+        "aggs": {
+            "hosts": {
+                "terms": {"field": "host.ip", "include": host_ips, "size": len(host_ips)},
+                "aggs": {
+                    "interfaces": {
+                        "terms": {"field": "system.network.name", "size": 16, "exclude": list(IGNORED_INTERFACES)},
+                        "aggs": {
+                            "buckets": {
+                                "date_histogram": {"field": "@timestamp", "fixed_interval": interval, "min_doc_count": 1},
+                                "aggs": {
+                                    _agg_name(field): {"max": {"field": f"system.network.{field}"}}
+                                    for field in COUNTER_FIELDS
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def series_from_counter_aggregation(result):
+    """Collect CounterSeries from a build_counter_query response"""
+    counters = CounterSeries()
+    for host_bucket in result.get('aggregations', {}).get('hosts', {}).get('buckets', []):
+        for interface_bucket in host_bucket.get('interfaces', {}).get('buckets', []):
+            for time_bucket in interface_bucket.get('buckets', {}).get('buckets', []):
+                counters.add(host_bucket['key'], interface_bucket['key'], time_bucket['key'] / 1000,
+                             [time_bucket.get(_agg_name(field), {}).get('value') for field in COUNTER_FIELDS])
+    return counters
+
+
+def _agg_name(field):
+    return field.replace('.', '_')
+
+
+def interval_seconds(interval):
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+    number = interval.rstrip("smhd")
+    return float(number) * units[interval[len(number):]]
+
+
+def rate_interval(start_time, end_time, minimum=COUNTER_INTERVAL, max_buckets=MAX_RATE_BUCKETS):
+    """Bucket width (e.g. "30s") keeping a window within max_buckets per interface"""
+    start = _epoch(start_time)
+    end = _epoch(end_time)
+    seconds = max(interval_seconds(minimum), (end - start) / max_buckets)
+    return f"{int(np.ceil(seconds))}s"
+
+
+def build_rate_query(host_ips, start_time, end_time, interval=None):
+    """Size-0 query computing per-second rates server-side; returns (query, filter_path).
+
+    Each host/interface gets date_histogram buckets holding the max of every
+    counter and a derivative of it normalized to 1s. Sending filter_path as
+    a URL parameter strips the max values from the response, so only keys
+    and rates come back, however long the window.
+    """
+    host_ips = list(host_ips)
+    interval = interval or rate_interval(start_time, end_time)
+    bucket_aggs = {}
+    for field in RATE_FIELDS:
+        name = _agg_name(field)
+        bucket_aggs[name] = {"max": {"field": f"system.network.{field}"}}
+        bucket_aggs[f"{name}_rate"] = {"derivative": {"buckets_path": name, "unit": "1s"}}
+
+    query = {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {"host.ip": host_ips}},
+                    {"term": {"metricset.name": "network"}},
+                    {"range": {"@timestamp": {"gte": start_time, "lte": end_time}}}
+                ]
+            }
+        },
+        "aggs": {
+            "hosts": {
+                "terms": {"field": "host.ip", "include": host_ips, "size": len(host_ips)},
+                "aggs": {
+                    "interfaces": {
+                        "terms": {"field": "system.network.name", "size": 16, "exclude": list(IGNORED_INTERFACES)},
+                        "aggs": {
+                            "rates": {
+                                "date_histogram": {"field": "@timestamp", "fixed_interval": interval, "min_doc_count": 0},
+                                "aggs": bucket_aggs
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    buckets = "aggregations.hosts.buckets.interfaces.buckets.rates.buckets"
+    filter_path = ",".join([
+        "took", "timed_out", "_shards", "hits.total",
+        "aggregations.hosts.buckets.key",
+        "aggregations.hosts.buckets.interfaces.buckets.key",
+        f"{buckets}.key",
+        f"{buckets}.*_rate.normalized_value"
+    ])
+    return query, filter_path
+
+
+class RateSeries:
+    """Server-computed rates of many (host, interface) pairs, gathered into a RateResult"""
+
+    def __init__(self, fields=RATE_FIELDS):
+        self.fields = fields
+        self.keys = {}
+        self.series = []
+        self.ends = []
+        self.rates = []
+
+    def add(self, host_ip, interface, end, rates):
+        if interface in IGNORED_INTERFACES:
+            return
+        key = self.keys.setdefault((host_ip, interface), len(self.keys))
+        self.series.append(key)
+        self.ends.append(end)
+        self.rates.append([np.nan if rate is None else rate for rate in rates])
+
+    def __len__(self):
+        return len(self.series)
+
+    def result(self, seconds):
+        """RateResult over buckets seconds wide; falls (counter resets) and over-capacity buckets are dropped.
+
+        Without the counter values a 32-bit wrap cannot be told from a
+        reset, so both count as resets here.
+        """
+        series = np.array(self.series, dtype=np.int64)
+        rates = np.array(self.rates, dtype=np.float64).reshape(len(self.series), len(self.fields))
+        series_count = len(self.keys)
+        byte_columns = [i for i, field in enumerate(self.fields) if field.endswith("bytes")]
+        limits = np.array([host_capacity(host_ip) for host_ip, _ in self.keys])[series] * CAPACITY_SLACK
+
+        present = ~np.isnan(rates[:, byte_columns]).any(axis=1)
+        fell = present & (rates < 0).any(axis=1)
+        too_fast = present & ~fell & (rates[:, byte_columns] > limits[:, None]).any(axis=1)
+        valid = present & ~fell & ~too_fast
+        rates[~valid] = np.nan
+        seconds = np.full(len(series), float(seconds))
+        return RateResult(
+            series,
+            np.array(self.ends, dtype=np.float64),
+            seconds,
+            rates,
+            np.where(valid[:, None], rates * seconds[:, None], 0),
+            valid,
+            np.bincount(series, weights=fell, minlength=series_count).astype(int),
+            np.zeros(series_count, dtype=int),
+            np.bincount(series, weights=too_fast, minlength=series_count).astype(int)
+        )
+
+
+def series_from_rate_aggregation(result):
+    """Collect RateSeries from a build_rate_query response (bucket end times in epoch seconds)"""
+    rates = RateSeries()
+    for host_bucket in result.get('aggregations', {}).get('hosts', {}).get('buckets', []):
+        for interface_bucket in host_bucket.get('interfaces', {}).get('buckets', []):
+            for time_bucket in interface_bucket.get('rates', {}).get('buckets', []):
+                values = [time_bucket.get(f"{_agg_name(field)}_rate", {}).get('normalized_value')
+                          for field in RATE_FIELDS]
+                # The first bucket has no derivative and empty buckets are skipped
+                if all(value is None for value in values):
+                    continue
+                rates.add(host_bucket['key'], interface_bucket['key'], time_bucket['key'] / 1000, values)
+    return rates
+
+
+def fleet_rate_table(counters):
+    """{host_ip: network rates} from CounterSeries, summed over each host's interfaces"""
+    if not len(counters):
+        return {}
+    return rate_table(counters.keys, counters.rates())
+
+
+def server_rate_table(result, interval):
+    """{host_ip: network rates} from a build_rate_query response with the given bucket width"""
+    rates = series_from_rate_aggregation(result)
+    if not len(rates):
+        return {}
+    return rate_table(rates.keys, rates.result(interval_seconds(interval)))
+
+
+def rate_table(keys, result):
+    """Sum per-interface results into {host_ip: rates}, ready to merge into host metrics.
+
+    net_in_rate/net_out_rate are mean bytes/s over the window, the peaks are
+    the busiest single interval, and net_utilization is the busier direction
+    as a percentage of the host's capacity. Packet rates are included when
+    the result carries them.
+    """
+    series_count = len(keys)
+    means = result.mean_rates(series_count)
+    peaks = result.peak_rates(series_count)
+
+    table = {}
+    for (host_ip, interface), index in keys.items():
+        entry = table.setdefault(host_ip, {
+            'net_in_rate': 0.0, 'net_out_rate': 0.0, 'net_in_peak': 0.0, 'net_out_peak': 0.0,
+            'interfaces': 0, 'counter_resets': 0, 'counter_wraps': 0, 'dropped_intervals': 0
+        })
+        if not np.isnan(means[index, 0]):
+            entry['net_in_rate'] += float(means[index, 0])
+            entry['net_out_rate'] += float(means[index, 1])
+            entry['net_in_peak'] += float(peaks[index, 0])
+            entry['net_out_peak'] += float(peaks[index, 1])
+            if means.shape[1] >= 4:
+                entry['net_in_packets'] = entry.get('net_in_packets', 0.0) + float(np.nan_to_num(means[index, 2]))
+                entry['net_out_packets'] = entry.get('net_out_packets', 0.0) + float(np.nan_to_num(means[index, 3]))
+            entry['interfaces'] += 1
+        entry['counter_resets'] += int(result.resets[index])
+        entry['counter_wraps'] += int(result.wraps[index])
+        entry['dropped_intervals'] += int(result.dropped[index])
+
+    for host_ip, entry in table.items():
+        busiest = max(entry['net_in_rate'], entry['net_out_rate'])
+        entry['net_utilization'] = busiest / host_capacity(host_ip) * 100
+    return table
@@ -1,4 +1,7 @@
 import requests
+import http_transport
+import consul_weights
+from consul_weights import ConsulWeightWriter
 import json
 import pandas as pd
 import datetime
@@ -11,8 +14,8 @@ CONSUL_PORT = 8500  # Default Consul HTTP API port
 SERVICE_NAME = "sdn-news"
 USE_HTTPS = False  # Set to True if Consul API is using HTTPS
 
-def query_service_instances():
-    """Query Consul for all instances of a specific service"""
+def query_service_instances(export=True):
+    """Query Consul for all instances of a specific service (export=False skips the Excel report)"""
     protocol = "https" if USE_HTTPS else "http"
     consul_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/catalog/service/{SERVICE_NAME}"
     
@@ -21,7 +24,7 @@ def query_service_instances():
     
     try:
         # Get service instances from Consul
-        response = requests.get(consul_url, verify=False)
+        response = http_transport.get(consul_url, verify=False)
         
         if response.status_code == 200:
             services = response.json()
@@ -37,54 +40,19 @@ def query_service_instances():
                 return
             
             # Extract and display service information
-            instance_data = []
-            for instance in services:
-                # Extract core data
-                node_name = instance.get('Node', 'N/A')
-                address = instance.get('Address', 'N/A')
-                service_id = instance.get('ServiceID', 'N/A')
-                service_address = instance.get('ServiceAddress', address)  # If ServiceAddress is empty, use Node Address
-                service_port = instance.get('ServicePort', 'N/A')
-                
-                # Extract health checks if available
-                health_status = "Unknown"
-                if 'Checks' in instance:
-                    checks = instance['Checks']
-                    statuses = [check.get('Status') for check in checks]
-                    if all(status == 'passing' for status in statuses):
-                        health_status = "Healthy"
-                    elif any(status == 'critical' for status in statuses):
-                        health_status = "Critical"
-                    elif any(status == 'warning' for status in statuses):
-                        health_status = "Warning"
-                
-                # Extract tags if available
-                tags = instance.get('ServiceTags', [])
-                tags_str = ", ".join(tags) if tags else "None"
-                
-                # Extract metadata if available
-                meta = instance.get('ServiceMeta', {})
-                
-                # Add to our collection
-                instance_data.append({
-                    'Node': node_name,
-                    'IP Address': service_address,
-                    'Port': service_port,
-                    'Service ID': service_id,
-                    'Health': health_status,
-                    'Tags': tags_str
-                })
-                
+            instance_data = extract_instance_data(services)
+            for instance in instance_data:
                 # Print summary to console
-                print(f"\nInstance: {node_name}")
-                print(f"  IP Address: {service_address}")
-                print(f"  Port: {service_port}")
-                print(f"  Service ID: {service_id}")
-                print(f"  Health: {health_status}")
-                print(f"  Tags: {tags_str}")
+                print(f"\nInstance: {instance['Node']}")
+                print(f"  IP Address: {instance['IP Address']}")
+                print(f"  Port: {instance['Port']}")
+                print(f"  Service ID: {instance['Service ID']}")
+                print(f"  Health: {instance['Health']}")
+                print(f"  Tags: {instance['Tags']}")
             
             # Create Excel report
-            export_to_excel(instance_data)
+            if export:
+                export_to_excel(instance_data)
             
             return instance_data
             
@@ -101,6 +69,44 @@ def query_service_instances():
         print(f"Error querying Consul: {e}")
         return None
 
+def extract_instance_data(services):
+    """Flatten raw catalog entries into the instance rows used by the balancer and reports"""
+    instance_data = []
+    for instance in services:
+        # Extract core data
+        node_name = instance.get('Node', 'N/A')
+        address = instance.get('Address', 'N/A')
+        service_id = instance.get('ServiceID', 'N/A')
+        service_address = instance.get('ServiceAddress', address)  # If ServiceAddress is empty, use Node Address
+        service_port = instance.get('ServicePort', 'N/A')
+        
+        # Extract health checks if available
+        health_status = "Unknown"
+        if 'Checks' in instance:
+            checks = instance['Checks']
+            statuses = [check.get('Status') for check in checks]
+            if all(status == 'passing' for status in statuses):
+                health_status = "Healthy"
+            elif any(status == 'critical' for status in statuses):
+                health_status = "Critical"
+            elif any(status == 'warning' for status in statuses):
+                health_status = "Warning"
+        
+        # Extract tags if available
+        tags = instance.get('ServiceTags', [])
+        tags_str = ", ".join(tags) if tags else "None"
+        
+        # Add to our collection
+        instance_data.append({
+            'Node': node_name,
+            'IP Address': service_address,
+            'Port': service_port,
+            'Service ID': service_id,
+            'Health': health_status,
+            'Tags': tags_str
+        })
+    return instance_data
+
 def export_to_excel(instance_data):
     """Export service instance data to Excel"""
     if not instance_data:
@@ -135,21 +141,12 @@ def update_service_weight(ip_address="10.0.0.5", new_weight=60):
     print(f"Updating weight for service instance with IP: {ip_address}")
     print(f"New weight will be: {new_weight}")
     
-    # Step 1: Find the service instance with the specified IP
-    consul_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/catalog/service/{SERVICE_NAME}"
+    writer = ConsulWeightWriter(f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}", SERVICE_NAME)
     
     try:
-        # Get all service instances
-        response = requests.get(consul_url, verify=False)
-        
-        if response.status_code != 200:
-            print(f"Error: Received status code {response.status_code}")
-            print(f"Response: {response.text}")
-            return False
-        
-        services = response.json()
+        # Step 1: Find the service instance with the specified IP
+        services = writer.fetch_catalog()
         
-        # Find the instance with the target IP
         target_instance = None
         for instance in services:
             service_address = instance.get('ServiceAddress') or instance.get('Address')
@@ -161,73 +158,17 @@ def update_service_weight(ip_address="10.0.0.5", new_weight=60):
             print(f"No service instance found with IP: {ip_address}")
             return False
         
-        # Extract service details
         service_id = target_instance.get('ServiceID')
         print(f"Found service instance: {service_id}")
         
-        # Step 2: Get detailed service information
-        agent_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/agent/service/{service_id}"
-        agent_response = requests.get(agent_url, verify=False)
-        
-        if agent_response.status_code != 200:
-            print(f"Error getting service details: {agent_response.status_code}")
-            print(f"Response: {agent_response.text}")
-            return False
-            
-        service_details = agent_response.json()
-        
-        # Step 3: Update the weight in the tags
-        current_tags = service_details.get('Tags', [])
-        new_tags = []
-        weight_updated = False
-        
-        for tag in current_tags:
-            if 'urlprefix-/api weight=' in tag:
-                # Replace the weight value
-                parts = tag.split('weight=')
-                new_tag = f"{parts[0]}weight={new_weight}"
-                new_tags.append(new_tag)
-                weight_updated = True
-                print(f"Updating tag from '{tag}' to '{new_tag}'")
-            else:
-                new_tags.append(tag)
-        
-        # If no matching tag was found, add a new one
-        if not weight_updated:
-            new_tag = f"urlprefix-/api weight={new_weight}"
-            new_tags.append(new_tag)
-            print(f"Adding new tag: '{new_tag}'")
-        
-        # Step 4: Prepare the updated service registration payload
-        # Using correct field names as expected by Consul API
-        updated_service = {
-            "ID": service_id,
-            "Name": service_details.get('Service'),  # Changed 'Service' to 'Name'
-            "Tags": new_tags,
-            "Address": service_details.get('Address', ip_address),
-            "Port": service_details.get('Port', 0)
-        }
-        
-        # Add Meta field only if it exists in original service
-        if 'Meta' in service_details:
-            updated_service["Meta"] = service_details.get('Meta', {})
-            
-        print(f"Sending updated service registration: {json.dumps(updated_service, indent=2)}")
-        
-        # Step 5: Re-register the service with updated tags
-        register_url = f"{protocol}://{CONSUL_HOST}:{CONSUL_PORT}/v1/agent/service/register"
-        register_response = requests.put(
-            register_url,
-            json=updated_service,
-            verify=False
-        )
+        # Step 2: Write the weight tag (agent registration, or catalog CAS when tag override is on)
+        result = writer.write({service_id: new_weight}, services)[service_id]
         
-        if register_response.status_code == 200:
-            print(f"Successfully updated weight for service {service_id} to {new_weight}")
+        if result in (consul_weights.UPDATED, consul_weights.UNCHANGED):
+            print(f"Successfully updated weight for service {service_id} to {new_weight} ({result})")
             return True
         else:
-            print(f"Error updating service: {register_response.status_code}")
-            print(f"Response: {register_response.text}")
+            print(f"Error updating service {service_id}: {result}")
             return False
             
     except Exception as e:
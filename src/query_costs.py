@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import instrumentation
+
+# Query cost configuration
+COST_LOG_FILE = None  # Append one JSON line per Elasticsearch response here (e.g. "query_costs.jsonl")
+PROFILE_SAMPLE_RATE = 0.0  # Share of searches sent with "profile": true (0 disables profiling)
+PROFILE_DIR = "query_profiles"  # Profile breakdowns of sampled searches are written here
+TOP_TEMPLATES = 15
+
+ES_TOOK_SECONDS = instrumentation.REGISTRY.histogram(
+    "lb_es_took_seconds", "Server-side search time reported by Elasticsearch per query template", ("template",))
+ES_SHARD_FAILURES = instrumentation.REGISTRY.counter(
+    "lb_es_shard_failures_total", "Failed shards reported by Elasticsearch per query template", ("template",))
+
+_stats = {}
+_lock = threading.Lock()
+_random = random.Random()
+
+
+def template_of(body):
+    """Fallback template name for unnamed searches: a hash of the query's structure without values"""
+    def shape(value):
+        if isinstance(value, dict):
+            return {key: shape(item) for key, item in sorted(value.items())}
+        if isinstance(value, list):
+            return [shape(value[0])] if value else []
+        return None
+
+    return "unnamed:" + hashlib.sha1(json.dumps(shape(body)).encode()).hexdigest()[:8]
+
+
+def empty_entry(template):
+    return {
+        "template": template, "count": 0, "took_ms_total": 0, "took_ms_max": 0, "client_ms_total": 0.0,
+        "shards_total": 0, "shards_failed": 0, "shards_skipped": 0, "hits_total": 0, "hits_returned": 0,
+        "errors": 0, "timed_out": 0, "profiled": 0
+    }
+
+
+def prepare(template, body):
+    """Return the body to send: a copy with "profile": true for sampled searches, else the body itself"""
+    if PROFILE_SAMPLE_RATE <= 0 or _random.random() >= PROFILE_SAMPLE_RATE:
+        return body
+    return dict(body, profile=True)
+
+
+def record(template, result, client_seconds=None):
+    """Account one search response to its template (and persist it when COST_LOG_FILE is set)"""
+    if not isinstance(result, dict):
+        return
+    template = template or "unnamed"
+    took_ms = result.get("took")
+    shards = result.get("_shards", {})
+    total_hits = result.get("hits", {}).get("total")
+    if isinstance(total_hits, dict):
+        total_hits = total_hits.get("value")
+    returned_hits = len(result.get("hits", {}).get("hits", []))
+    failed_shards = shards.get("failed", 0)
+
+    with _lock:
+        entry = _stats.get(template) or _stats.setdefault(template, empty_entry(template))
+        entry["count"] += 1
+        if took_ms is not None:
+            entry["took_ms_total"] += took_ms
+            entry["took_ms_max"] = max(entry["took_ms_max"], took_ms)
+        if client_seconds is not None:
+            entry["client_ms_total"] += client_seconds * 1000
+        entry["shards_total"] += shards.get("total", 0)
+        entry["shards_failed"] += failed_shards
+        entry["shards_skipped"] += shards.get("skipped", 0)
+        entry["hits_total"] += total_hits or 0
+        entry["hits_returned"] += returned_hits
+        entry["errors"] += 1 if "error" in result else 0
+        entry["timed_out"] += 1 if result.get("timed_out") else 0
+        entry["profiled"] += 1 if "profile" in result else 0
+
+    if took_ms is not None:
+        ES_TOOK_SECONDS.observe(took_ms / 1000, template=template)
+    if failed_shards:
+        ES_SHARD_FAILURES.inc(failed_shards, template=template)
+
+    line = {
+        "ts": time.time(), "template": template, "took_ms": took_ms,
+        "client_ms": round(client_seconds * 1000, 1) if client_seconds is not None else None,
+        "shards": shards.get("total"), "shards_failed": failed_shards, "shards_skipped": shards.get("skipped"),
+        "hits_total": total_hits, "hits_returned": returned_hits, "error": "error" in result,
+        "timed_out": bool(result.get("timed_out"))
+    }
+    if "profile" in result:
+        line["profile_file"] = save_profile(template, result["profile"])
+    if COST_LOG_FILE:
+        try:
+            with _lock, open(COST_LOG_FILE, "a") as f:
+                f.write(json.dumps(line, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logging.warning("Could not write query cost log: %s", e)
+
+
+def save_profile(template, profile):
+    """Write a profile breakdown to PROFILE_DIR and return its path"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in template)
+    path = os.path.join(PROFILE_DIR, f"{safe_name}_{time.strftime('%Y%m%d_%H%M%S')}_{_random.randrange(10**6):06d}.json")
+    with open(path, "w") as f:
+        json.dump(profile, f)
+    return path
+
+
+def snapshot():
+    """Per-template cost totals accumulated by this process"""
+    with _lock:
+        return {template: dict(entry) for template, entry in _stats.items()}
+
+
+def rank(entries, top=TOP_TEMPLATES):
+    """Templates ordered by total server time, with averages filled in"""
+    ranked = []
+    for entry in entries:
+        entry = dict(entry)
+        count = entry["count"] or 1
+        entry["took_ms_avg"] = entry["took_ms_total"] / count
+        entry["client_ms_avg"] = entry["client_ms_total"] / count
+        ranked.append(entry)
+    ranked.sort(key=lambda entry: entry["took_ms_total"], reverse=True)
+    return ranked[:top]
+
+
+def load_cost_log(path):
+    """Aggregate a cost log written with COST_LOG_FILE into per-template entries"""
+    totals = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            entry = totals.get(row["template"]) or totals.setdefault(row["template"], empty_entry(row["template"]))
+            entry["count"] += 1
+            entry["took_ms_total"] += row.get("took_ms") or 0
+            entry["took_ms_max"] = max(entry["took_ms_max"], row.get("took_ms") or 0)
+            entry["client_ms_total"] += row.get("client_ms") or 0
+            entry["shards_total"] += row.get("shards") or 0
+            entry["shards_failed"] += row.get("shards_failed") or 0
+            entry["shards_skipped"] += row.get("shards_skipped") or 0
+            entry["hits_total"] += row.get("hits_total") or 0
+            entry["hits_returned"] += row.get("hits_returned") or 0
+            entry["errors"] += 1 if row.get("error") else 0
+            entry["timed_out"] += 1 if row.get("timed_out") else 0
+            entry["profiled"] += 1 if row.get("profile_file") else 0
+    return list(totals.values())
+
+
+def format_report(entries, top=TOP_TEMPLATES):
+    lines = [f"{'template':<32} {'calls':>6} {'took ms':>9} {'avg ms':>8} {'max ms':>7} {'client avg':>10} "
+             f"{'shards':>7} {'failed':>6} {'hits':>10} {'profiled':>8}"]
+    for entry in rank(entries, top):
+        lines.append(
+            f"{entry['template']:<32} {entry['count']:>6} {entry['took_ms_total']:>9} {entry['took_ms_avg']:>8.1f} "
+            f"{entry['took_ms_max']:>7} {entry['client_ms_avg']:>10.1f} {entry['shards_total']:>7} "
+            f"{entry['shards_failed']:>6} {entry['hits_total']:>10} {entry['profiled']:>8}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python query_costs.py [cost log] -- rank templates by server-side time
+    path = sys.argv[1] if len(sys.argv) > 1 else (COST_LOG_FILE or "query_costs.jsonl")
+    print(format_report(load_cost_log(path)))
@@ -1,4 +1,7 @@
 import requests
+import http_transport
+import query_costs
+from elastic_paginator import iter_hits, HitsJsonWriter
 import json
 from urllib3.exceptions import InsecureRequestWarning
 import pandas as pd
@@ -28,46 +31,31 @@ def query_metricbeat():
         }
     }
     
-    # Send request to Elasticsearch
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
-    
-    # Print status code
-    print(f"Response status code: {response.status_code}")
+    # Stream every hit to the JSON file page by page instead of one truncated response
+    try:
+        with HitsJsonWriter("metricbeat_response.json") as writer:
+            for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_host_dump"):
+                if writer.count == 0:
+                    # Print first hit
+                    print("\nSample data from first hit:")
+                    source = hit.get('_source', {})
+                    host_ip = source.get('host', {}).get('ip', 'N/A')
+                    timestamp = source.get('@timestamp', 'N/A')
+                    metricset = source.get('metricset', {}).get('name', 'N/A')
+                    print(f"Host IP: {host_ip}")
+                    print(f"Timestamp: {timestamp}")
+                    print(f"Metricset: {metricset}")
+                writer.write(hit)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return
     
-    if response.status_code == 200:
-        # Save response to JSON file
-        result = response.json()
-        with open("metricbeat_response.json", "w") as f:
-            json.dump(result, f, indent=4)
-        print(f"Response saved to metricbeat_response.json")
-        
-        # Print hit count
-        hit_count = result.get('hits', {}).get('total', {}).get('value', 0)
-        print(f"Total hits: {hit_count}")
-        
-        # Print first hit if available
-        hits = result.get('hits', {}).get('hits', [])
-        if hits:
-            print("\nSample data from first hit:")
-            source = hits[0].get('_source', {})
-            host_ip = source.get('host', {}).get('ip', 'N/A')
-            timestamp = source.get('@timestamp', 'N/A')
-            metricset = source.get('metricset', {}).get('name', 'N/A')
-            print(f"Host IP: {host_ip}")
-            print(f"Timestamp: {timestamp}")
-            print(f"Metricset: {metricset}")
-    else:
-        print(f"Error: {response.text}")
+    print(f"Response saved to metricbeat_response.json")
+    print(f"Total hits: {writer.count}")
 
 # Query for CPU metrics
 def query_cpu_metrics():
     query = {
-        "size": 100,  # Get more results (default is usually 10)
         "query": {
             "bool": {
                 "must": [
@@ -81,55 +69,40 @@ def query_cpu_metrics():
     
     # Send request to Elasticsearch
     print("Sending request to Elasticsearch...")
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
-    
-    # Print status code
-    print(f"Response status code: {response.status_code}")
-    
-    if response.status_code == 200:
-        # Save response to JSON file
-        result = response.json()
-        with open("cpu_metrics.json", "w") as f:
-            json.dump(result, f, indent=4)
-        print(f"Response saved to cpu_metrics.json")
-        
-        # Print hit count
-        hit_count = result.get('hits', {}).get('total', {}).get('value', 0)
-        print(f"Total CPU metric hits: {hit_count}")
-        
-        # Print CPU utilization summary if available
-        hits = result.get('hits', {}).get('hits', [])
-        if hits:
-            print("\nCPU Utilization Summary:")
-            for i, hit in enumerate(hits[:5]):  # Show first 5 entries
-                source = hit.get('_source', {})
-                timestamp = source.get('@timestamp', 'N/A')
-                
-                # Get CPU metrics
-                cpu_data = source.get('system', {}).get('cpu', {})
-                total_pct = cpu_data.get('total', {}).get('pct', 'N/A')
-                user_pct = cpu_data.get('user', {}).get('pct', 'N/A')
-                system_pct = cpu_data.get('system', {}).get('pct', 'N/A')
+    try:
+        with HitsJsonWriter("cpu_metrics.json") as writer:
+            for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_cpu"):
+                writer.write(hit)
                 
-                print(f"\nTimestamp: {timestamp}")
-                print(f"  Total CPU: {total_pct}")
-                print(f"  User CPU: {user_pct}")
-                print(f"  System CPU: {system_pct}")
-            
-            if len(hits) > 5:
-                print(f"\n... and {len(hits) - 5} more entries")
-    else:
-        print(f"Error: {response.text}")
+                # Print CPU utilization summary for the first 5 entries
+                if writer.count == 1:
+                    print("\nCPU Utilization Summary:")
+                if writer.count <= 5:
+                    source = hit.get('_source', {})
+                    timestamp = source.get('@timestamp', 'N/A')
+                    
+                    # Get CPU metrics
+                    cpu_data = source.get('system', {}).get('cpu', {})
+                    total_pct = cpu_data.get('total', {}).get('pct', 'N/A')
+                    user_pct = cpu_data.get('user', {}).get('pct', 'N/A')
+                    system_pct = cpu_data.get('system', {}).get('pct', 'N/A')
+                    
+                    print(f"\nTimestamp: {timestamp}")
+                    print(f"  Total CPU: {total_pct}")
+                    print(f"  User CPU: {user_pct}")
+                    print(f"  System CPU: {system_pct}")
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return
+    
+    if writer.count > 5:
+        print(f"\n... and {writer.count - 5} more entries")
+    print(f"Response saved to cpu_metrics.json")
+    print(f"Total CPU metric hits: {writer.count}")
 
 def export_cpu_metrics_to_excel():
     print("Fetching CPU metrics for Excel export...")
     query = {
-        "size": 1000,  # Get more results for better data set
         "sort": [
             {"@timestamp": {"order": "asc"}}  # Sort by timestamp ascending
         ],
@@ -144,25 +117,10 @@ def export_cpu_metrics_to_excel():
         }
     }
     
-    # Send request to Elasticsearch
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
-    
-    if response.status_code == 200:
-        result = response.json()
-        hits = result.get('hits', {}).get('hits', [])
-        
-        if not hits:
-            print("No CPU metrics found.")
-            return
-        
-        # Extract data for Excel
+    try:
+        # Extract data for Excel, one page of hits at a time
         data = []
-        for hit in hits:
+        for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_cpu_export"):
             source = hit.get('_source', {})
             timestamp = source.get('@timestamp', 'N/A')
             
@@ -195,6 +153,10 @@ def export_cpu_metrics_to_excel():
                 'System CPU (%)': system_pct
             })
         
+        if not data:
+            print("No CPU metrics found.")
+            return
+        
         # Create DataFrame and save to Excel
         df = pd.DataFrame(data)
         
@@ -227,13 +189,13 @@ def export_cpu_metrics_to_excel():
         
         writer.close()
         
-        print(f"\nExported {len(hits)} CPU metrics to {excel_file}")
+        print(f"\nExported {len(data)} CPU metrics to {excel_file}")
         print(f"\nAverage CPU Utilization:")
         print(f"  Total CPU: {avg_total:.2f}%")
         print(f"  User CPU: {avg_user:.2f}%")
         print(f"  System CPU: {avg_system:.2f}%")
-    else:
-        print(f"Error: {response.text}")
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
 
 def export_ram_metrics_to_excel():
     print("Fetching RAM metrics for Excel export...")
@@ -241,7 +203,6 @@ def export_ram_metrics_to_excel():
     query_memory_metrics()
     
     query = {
-        "size": 1000,
         "sort": [
             {"@timestamp": {"order": "asc"}}
         ],
@@ -256,24 +217,12 @@ def export_ram_metrics_to_excel():
         }
     }
     
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
-    
-    if response.status_code == 200:
-        result = response.json()
-        hits = result.get('hits', {}).get('hits', [])
-        
-        if not hits:
-            print("No RAM metrics found.")
-            return
-        
-        # Extract data for Excel
+    try:
+        # Extract data for Excel, one page of hits at a time
+        hit_count = 0
         data = []
-        for hit in hits:
+        for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_memory_export"):
+            hit_count += 1
             try:
                 source = hit.get('_source', {})
                 timestamp = source.get('@timestamp', 'N/A')
@@ -346,6 +295,10 @@ def export_ram_metrics_to_excel():
                 # Optionally print the hit causing the error for debugging
                 # print(json.dumps(hit, indent=2))
         
+        if not hit_count:
+            print("No RAM metrics found.")
+            return
+        
         if not data:
             print("Could not extract any usable RAM metrics.")
             return
@@ -383,7 +336,7 @@ def export_ram_metrics_to_excel():
         
         writer.close()
         
-        print(f"\nExported {len(hits)} RAM metrics to {excel_file}")
+        print(f"\nExported {len(data)} RAM metrics to {excel_file}")
         print("\nAverage RAM Utilization:")
         if avg_ram_pct is not None:
             print(f"  RAM Used: {avg_ram_pct:.2f}%")
@@ -391,13 +344,12 @@ def export_ram_metrics_to_excel():
             print(f"  Used RAM: {avg_used_mb:.2f} MB")
         if avg_free_mb is not None:
             print(f"  Free RAM: {avg_free_mb:.2f} MB")
-    else:
-        print(f"Error: {response.text}")
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
 
 def query_memory_metrics():
     print("Fetching memory metrics to examine JSON structure...")
     query = {
-        "size": 100,
         "query": {
             "bool": {
                 "must": [
@@ -409,27 +361,151 @@ def query_memory_metrics():
         }
     }
     
-    # Send request to Elasticsearch
-    response = requests.post(
+    # Stream every hit to the JSON file page by page
+    try:
+        with HitsJsonWriter("memory_metrics.json") as writer:
+            for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_memory"):
+                writer.write(hit)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return
+    
+    print(f"Response saved to memory_metrics.json")
+    print(f"Total memory metric hits: {writer.count}")
+
+# Fields averaged / maxed per metricset in the fleet aggregation
+FLEET_METRIC_FIELDS = {
+    "cpu": "system.cpu.total.norm.pct",
+    "ram": "system.memory.actual.used.pct"
+}
+
+def build_fleet_metrics_query(host_ips, start_time, end_time):
+    """Build one size-0 aggregation covering CPU, RAM and network for every host"""
+    # Split the window in two halves so the trend comes from bucket averages, not raw samples
+    start_dt = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+    end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+    mid_time = (start_dt + (end_dt - start_dt) / 2).isoformat()
+
+    value_aggs = {}
+    for name, field in FLEET_METRIC_FIELDS.items():
+        value_aggs[f"{name}_avg"] = {"avg": {"field": field}}
+        value_aggs[f"{name}_max"] = {"max": {"field": field}}
+
+    return {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {"host.ip": list(host_ips)}},
+                    {"terms": {"metricset.name": ["cpu", "memory", "network"]}},
+                    {"range": {"@timestamp": {"gte": start_time, "lte": end_time}}}
+                ]
+            }
+        },
+        "aggs": {
+            "hosts": {
+                "terms": {"field": "host.ip", "include": list(host_ips), "size": len(host_ips)},
+                "aggs": {
+                    "metricsets": {
+                        "terms": {"field": "metricset.name", "size": 3},
+                        "aggs": {
+                            **value_aggs,
+                            "halves": {
+                                "date_range": {
+                                    "field": "@timestamp",
+                                    "ranges": [
+                                        {"key": "early", "from": start_time, "to": mid_time},
+                                        {"key": "late", "from": mid_time, "to": end_time}
+                                    ]
+                                },
+                                "aggs": {f"{name}_avg": value_aggs[f"{name}_avg"] for name in FLEET_METRIC_FIELDS}
+                            },
+                            "interfaces": {
+                                "terms": {"field": "system.network.name", "size": 16, "exclude": "lo"},
+                                "aggs": {
+                                    "in_min": {"min": {"field": "system.network.in.bytes"}},
+                                    "in_max": {"max": {"field": "system.network.in.bytes"}},
+                                    "out_min": {"min": {"field": "system.network.out.bytes"}},
+                                    "out_max": {"max": {"field": "system.network.out.bytes"}}
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+def relative_change(early, late):
+    """Relative change between two averages, clamped to -1..1"""
+    if early is None or late is None or early == 0:
+        return 0
+    return max(-1, min(1, (late - early) / early))
+
+def parse_fleet_metrics(result, window_seconds):
+    """Turn the fleet aggregation response into {host_ip: metrics} for calculate_weights"""
+    table = {}
+    for host_bucket in result.get('aggregations', {}).get('hosts', {}).get('buckets', []):
+        host_ip = host_bucket['key']
+        metrics = {}
+        trends = []
+
+        for metricset_bucket in host_bucket.get('metricsets', {}).get('buckets', []):
+            metricset = metricset_bucket['key']
+
+            if metricset in ("cpu", "memory"):
+                name = "cpu" if metricset == "cpu" else "ram"
+                avg_value = metricset_bucket.get(f"{name}_avg", {}).get('value')
+                max_value = metricset_bucket.get(f"{name}_max", {}).get('value')
+                if avg_value is not None:
+                    metrics[f"{name}_utilization"] = avg_value * 100
+                if max_value is not None:
+                    metrics[f"{name}_max"] = max_value * 100
+
+                halves = {b['key']: b.get(f"{name}_avg", {}).get('value')
+                          for b in metricset_bucket.get('halves', {}).get('buckets', [])}
+                trends.append(relative_change(halves.get('early'), halves.get('late')))
+
+            elif metricset == "network":
+                bytes_in = 0
+                bytes_out = 0
+                for interface in metricset_bucket.get('interfaces', {}).get('buckets', []):
+                    bytes_in += (interface['in_max']['value'] or 0) - (interface['in_min']['value'] or 0)
+                    bytes_out += (interface['out_max']['value'] or 0) - (interface['out_min']['value'] or 0)
+                if window_seconds > 0:
+                    metrics['net_in_rate'] = max(0, bytes_in) / window_seconds
+                    metrics['net_out_rate'] = max(0, bytes_out) / window_seconds
+
+        # Rising load scores worse, so a falling CPU/RAM average yields a positive coefficient
+        if trends:
+            metrics['trend_coefficient'] = -sum(trends) / len(trends)
+
+        table[host_ip] = metrics
+    return table
+
+def query_fleet_metrics(host_ips, start_time=START_TIME, end_time=END_TIME):
+    """Fetch CPU, RAM and network figures for every host in a single aggregation request"""
+    if not host_ips:
+        return {}
+
+    query = build_fleet_metrics_query(host_ips, start_time, end_time)
+    response = http_transport.post(
         f"{ELASTIC_URL}/_search",
-        json=query,
+        json=query_costs.prepare("fleet_metrics", query),
+        compress=True,
         auth=(USERNAME, PASSWORD),
         verify=False
     )
-    
-    print(f"Response status code: {response.status_code}")
-    
-    if response.status_code == 200:
-        result = response.json()
-        with open("memory_metrics.json", "w") as f:
-            json.dump(result, f, indent=4)
-        print(f"Response saved to memory_metrics.json")
-        
-        # Print hit count
-        hit_count = result.get('hits', {}).get('total', {}).get('value', 0)
-        print(f"Total memory metric hits: {hit_count}")
-    else:
+
+    if response.status_code != 200:
         print(f"Error: {response.text}")
+        return None
+
+    result = response.json()
+    query_costs.record("fleet_metrics", result, response.elapsed.total_seconds())
+    start_dt = datetime.datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+    end_dt = datetime.datetime.fromisoformat(end_time.replace('Z', '+00:00'))
+    return parse_fleet_metrics(result, (end_dt - start_dt).total_seconds())
 
 if __name__ == "__main__":
     print("Querying metricbeat logs...")
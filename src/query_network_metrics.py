@@ -1,8 +1,13 @@
 import requests
+import http_transport
+from elastic_paginator import iter_hits, HitsJsonWriter
 import json
 from urllib3.exceptions import InsecureRequestWarning
 import pandas as pd
 import datetime
+import query_costs
+from network_rates import series_from_hits, rate_table, build_rate_query, rate_interval, interval_seconds
+from network_rates import series_from_rate_aggregation
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 # Hardcoded properties
@@ -15,11 +20,14 @@ HOST_IP = "10.0.0.5"
 START_TIME = "2025-03-07T08:00:00+00:00"
 END_TIME = "2025-03-07T09:10:00+00:00"
 
+# "server": Elasticsearch returns bucketed per-second rates (date_histogram + derivative);
+# "raw": every network document is paged through and the counters are diffed here
+RATE_QUERY_MODE = "server"
+
 def query_network_metrics():
     """Query and save raw network metrics to a JSON file"""
     print("Fetching network metrics to examine JSON structure...")
     query = {
-        "size": 100,
         "query": {
             "bool": {
                 "must": [
@@ -31,37 +39,122 @@ def query_network_metrics():
         }
     }
     
-    # Send request to Elasticsearch
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
+    # Stream every hit to the JSON file page by page
+    try:
+        with HitsJsonWriter("network_metrics.json") as writer:
+            for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_network"):
+                if writer.count == 0:
+                    # Print sample data from first hit
+                    print("\nSample data from first network metric:")
+                    source = hit.get('_source', {})
+                    network_data = source.get('system', {}).get('network', {})
+                    print(json.dumps(network_data, indent=2))
+                writer.write(hit)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return None
     
-    print(f"Response status code: {response.status_code}")
+    print(f"Response saved to network_metrics.json")
+    print(f"Total network metric hits: {writer.count}")
     
-    if response.status_code == 200:
+    return writer.count
+
+def fetch_network_rates(host_ips):
+    """(series keys, RateResult) for the hosts' interfaces over START_TIME..END_TIME, per RATE_QUERY_MODE"""
+    if RATE_QUERY_MODE == "server":
+        interval = rate_interval(START_TIME, END_TIME)
+        query, filter_path = build_rate_query(host_ips, START_TIME, END_TIME, interval)
+        response = http_transport.post(
+            f"{ELASTIC_URL}/_search",
+            params={"filter_path": filter_path},
+            json=query_costs.prepare("metricbeat_network_rates", query),
+            compress=True,
+            auth=(USERNAME, PASSWORD),
+            verify=False
+        )
+        response.raise_for_status()
         result = response.json()
-        with open("network_metrics.json", "w") as f:
-            json.dump(result, f, indent=4)
-        print(f"Response saved to network_metrics.json")
-        
-        # Print hit count
-        hit_count = result.get('hits', {}).get('total', {}).get('value', 0)
-        print(f"Total network metric hits: {hit_count}")
-        
-        # Print sample data from first hit
-        hits = result.get('hits', {}).get('hits', [])
-        if hits:
-            print("\nSample data from first network metric:")
-            source = hits[0].get('_source', {})
-            network_data = source.get('system', {}).get('network', {})
-            print(json.dumps(network_data, indent=2))
-    else:
-        print(f"Error: {response.text}")
+        query_costs.record("metricbeat_network_rates", result, response.elapsed.total_seconds())
+        rates = series_from_rate_aggregation(result)
+        print(f"Received {len(rates)} rate buckets of {interval} across {len(rates.keys)} host interfaces")
+        return rates.keys, rates.result(interval_seconds(interval))
     
-    return result if response.status_code == 200 else None
+    query = {
+        "_source": ["@timestamp", "host.ip", "system.network"],
+        "sort": [
+            {"@timestamp": {"order": "asc"}}
+        ],
+        "query": {
+            "bool": {
+                "must": [
+                    {"terms": {"host.ip": host_ips}},
+                    {"term": {"metricset.name": "network"}},
+                    {"range": {"@timestamp": {"gte": START_TIME, "lte": END_TIME}}}
+                ]
+            }
+        }
+    }
+    hits = iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_network_counters")
+    counters = series_from_hits(hits, host_ips)
+    print(f"Found {len(counters)} counter readings across {len(counters.keys)} host interfaces")
+    if len(counters) < 2:
+        return counters.keys, None
+    return counters.keys, counters.rates()
+
+def export_network_rates_to_excel(host_ips):
+    """Export bucketed byte and packet rates per host interface to network_rate_buckets_<ip>.xlsx.
+
+    Its own file: the columns differ from the raw counter export in network_metrics_<ip>.xlsx.
+    """
+    try:
+        keys, result = fetch_network_rates(host_ips)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return
+    
+    if result is None or not result.valid.any():
+        print("No network rates found.")
+        return
+    
+    names = list(keys)
+    keep = result.valid
+    mb = 1024 * 1024
+    df = pd.DataFrame({
+        'Timestamp': list(pd.to_datetime(result.ends[keep], unit='s', utc=True).strftime('%Y-%m-%d %H:%M:%S')),
+        'Host': [names[index][0] for index in result.series[keep]],
+        'Interface': [names[index][1] for index in result.series[keep]],
+        'In (MB/s)': result.rates[keep, 0] / mb,
+        'Out (MB/s)': result.rates[keep, 1] / mb
+    })
+    if result.rates.shape[1] >= 4:
+        df['Packets In/s'] = result.rates[keep, 2]
+        df['Packets Out/s'] = result.rates[keep, 3]
+    
+    rate_columns = [column for column in df.columns if column not in ('Timestamp', 'Host', 'Interface')]
+    summary_df = pd.DataFrame([
+        dict({'Timestamp': 'AVERAGE', 'Host': '', 'Interface': ''}, **df[rate_columns].mean().to_dict()),
+        dict({'Timestamp': 'MAX', 'Host': '', 'Interface': ''}, **df[rate_columns].max().to_dict())
+    ])
+    df = pd.concat([df, summary_df])
+    
+    excel_file = f"network_rate_buckets_{host_ips[0].replace('.', '_')}.xlsx" if len(host_ips) == 1 else "network_rate_buckets.xlsx"
+    writer = pd.ExcelWriter(excel_file, engine='openpyxl')
+    df.to_excel(writer, index=False, sheet_name='Network Rates')
+    
+    # Auto-adjust columns width
+    for column in df:
+        column_length = max(df[column].astype(str).map(len).max(), len(column))
+        col_idx = df.columns.get_loc(column)
+        writer.sheets['Network Rates'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
+    
+    writer.close()
+    
+    print(f"\nExported {int(keep.sum())} network rate buckets to {excel_file}")
+    print("\nNetwork Traffic Summary:")
+    print(f"  Average In: {summary_df['In (MB/s)'][0]:.4f} MB/s")
+    print(f"  Average Out: {summary_df['Out (MB/s)'][0]:.4f} MB/s")
+    print(f"  Maximum In: {summary_df['In (MB/s)'][1]:.4f} MB/s")
+    print(f"  Maximum Out: {summary_df['Out (MB/s)'][1]:.4f} MB/s")
 
 def export_network_metrics_to_excel():
     """Process network metrics and export to Excel"""
@@ -71,7 +164,6 @@ def export_network_metrics_to_excel():
     query_network_metrics()
     
     query = {
-        "size": 1000,
         "sort": [
             {"@timestamp": {"order": "asc"}}
         ],
@@ -86,24 +178,14 @@ def export_network_metrics_to_excel():
         }
     }
     
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
-    
-    if response.status_code == 200:
-        result = response.json()
-        hits = result.get('hits', {}).get('hits', [])
+    try:
+        hits = iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="metricbeat_network_export")
+        hit_count = 0
         
-        if not hits:
-            print("No network metrics found.")
-            return
-        
-        # Extract data for Excel
+        # Extract data for Excel, one page of hits at a time
         data = []
         for hit in hits:
+            hit_count += 1
             try:
                 source = hit.get('_source', {})
                 timestamp = source.get('@timestamp', 'N/A')
@@ -184,6 +266,10 @@ def export_network_metrics_to_excel():
             except Exception as e:
                 print(f"Error processing hit: {e}")
         
+        if not hit_count:
+            print("No network metrics found.")
+            return
+        
         if not data:
             print("Could not extract any usable network metrics.")
             return
@@ -237,7 +323,7 @@ def export_network_metrics_to_excel():
         
         writer.close()
         
-        print(f"\nExported {len(hits)} network metrics to {excel_file}")
+        print(f"\nExported {len(data)} network metrics to {excel_file}")
         print("\nNetwork Traffic Summary:")
         if avg_bytes_in is not None:
             print(f"  Average Bytes In: {avg_bytes_in:.2f} MB")
@@ -247,187 +333,85 @@ def export_network_metrics_to_excel():
             print(f"  Total Bytes In: {total_bytes_in:.2f} MB")
         if total_bytes_out is not None:
             print(f"  Total Bytes Out: {total_bytes_out:.2f} MB")
-    else:
-        print(f"Error: {response.text}")
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
 
-def calculate_network_rates():
-    """Calculate network transfer rates (MB/s) between points focusing on eth0 interface"""
-    print("Calculating network transfer rates...")
+def calculate_network_rates(host_ips=None):
+    """Calculate per-interface transfer rates (MB/s) for each host and export them to Excel"""
+    host_ips = list(host_ips or [HOST_IP])
+    print(f"Calculating network transfer rates for {len(host_ips)} host(s)...")
     
-    query = {
-        "size": 1000,
-        "sort": [
-            {"@timestamp": {"order": "asc"}}
-        ],
-        "query": {
-            "bool": {
-                "must": [
-                    {"term": {"host.ip": HOST_IP}},
-                    {"term": {"metricset.name": "network"}},
-                    {"range": {"@timestamp": {"gte": START_TIME, "lte": END_TIME}}}
-                ]
-            }
-        }
-    }
+    try:
+        keys, result = fetch_network_rates(host_ips)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return None
     
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
+    if result is None:
+        print("Not enough data points to calculate rates.")
+        return None
     
-    if response.status_code == 200:
-        result = response.json()
-        hits = result.get('hits', {}).get('hits', [])
-        
-        if len(hits) < 2:
-            print("Not enough data points to calculate rates.")
-            return
-        
-        # Process data to calculate rates for eth0
-        timestamps = []
-        bytes_in_values = []
-        bytes_out_values = []
-        
-        # Debug - count different interface formats found
-        eth0_direct_count = 0
-        eth0_nested_count = 0
-        eth0_other_count = 0
-        
-        for hit in hits:
-            try:
-                source = hit.get('_source', {})
-                timestamp_str = source.get('@timestamp', None)
-                if not timestamp_str:
-                    continue
-                
-                # Parse timestamp
-                timestamp = datetime.datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                
-                # Get network data - specifically looking for system.network where name="eth0"
-                network_data = source.get('system', {}).get('network', {})
-                
-                # First check the format where eth0 is directly inside system.network
-                if isinstance(network_data, dict) and network_data.get('name') == 'eth0':
-                    # Found eth0 interface data with direct structure
-                    eth0_direct_count += 1
-                    bytes_in = network_data.get('in', {}).get('bytes')
-                    bytes_out = network_data.get('out', {}).get('bytes')
-                    
-                    if bytes_in is not None and bytes_out is not None:
-                        timestamps.append(timestamp)
-                        bytes_in_values.append(bytes_in)
-                        bytes_out_values.append(bytes_out)
-                
-                # If not found, try the format where eth0 is a sub-object of system.network
-                elif isinstance(network_data, dict) and 'eth0' in network_data:
-                    # Found eth0 in network_data dict keys
-                    eth0_nested_count += 1
-                    eth0_data = network_data.get('eth0', {})
-                    bytes_in = eth0_data.get('in', {}).get('bytes')
-                    bytes_out = eth0_data.get('out', {}).get('bytes')
-                    
-                    if bytes_in is not None and bytes_out is not None:
-                        timestamps.append(timestamp)
-                        bytes_in_values.append(bytes_in)
-                        bytes_out_values.append(bytes_out)
-            
-            except Exception as e:
-                print(f"Error processing hit for rate calculation: {e}")
-        
-        print(f"Found eth0 interfaces: {eth0_direct_count} direct format, {eth0_nested_count} nested format")
-        print(f"Found {len(timestamps)} data points with valid eth0 network values")
-        
-        if len(timestamps) < 2:
-            print("Not enough data points to calculate rates.")
-            return
-        
-        print(f"First timestamp: {timestamps[0]}")
-        print(f"Last timestamp: {timestamps[-1]}")
-        print(f"First bytes in/out: {bytes_in_values[0]}/{bytes_out_values[0]}")
-        print(f"Last bytes in/out: {bytes_in_values[-1]}/{bytes_out_values[-1]}")
-        
-        # Calculate rates between consecutive measurements
-        rates_data = []
-        for i in range(1, len(timestamps)):
-            time_diff = (timestamps[i] - timestamps[i-1]).total_seconds()
-            
-            if time_diff > 0:
-                # Calculate bytes/second - taking the difference between counter values
-                bytes_in_rate = (bytes_in_values[i] - bytes_in_values[i-1]) / time_diff
-                bytes_out_rate = (bytes_out_values[i] - bytes_out_values[i-1]) / time_diff
-                
-                # Check if rate is reasonable (counters might reset after reboot)
-                if bytes_in_rate < 0 or bytes_out_rate < 0:
-                    print(f"Skipping negative rate at {timestamps[i]} (likely counter reset)")
-                    continue
-                
-                # Convert to MB/s
-                mb_in_rate = bytes_in_rate / (1024 * 1024)
-                mb_out_rate = bytes_out_rate / (1024 * 1024)
-                
-                # Filter out implausible values (B2s VM has max ~125 MB/s)
-                if mb_in_rate > 125 or mb_out_rate > 125:
-                    print(f"Filtering implausible rate: IN={mb_in_rate:.2f} OUT={mb_out_rate:.2f} MB/s")
-                    continue
-                
-                rates_data.append({
-                    'Timestamp': timestamps[i].strftime('%Y-%m-%d %H:%M:%S'),
-                    'In Rate (MB/s)': mb_in_rate,
-                    'Out Rate (MB/s)': mb_out_rate,
-                    'Time Diff (s)': time_diff
-                })
-        
-        if rates_data:
-            # Create DataFrame
-            rates_df = pd.DataFrame(rates_data)
-            
-            # Calculate average and max rates
-            avg_in_rate = rates_df['In Rate (MB/s)'].mean()
-            avg_out_rate = rates_df['Out Rate (MB/s)'].mean()
-            max_in_rate = rates_df['In Rate (MB/s)'].max()
-            max_out_rate = rates_df['Out Rate (MB/s)'].max()
-            
-            # Add summary row
-            summary = pd.DataFrame([{
-                'Timestamp': 'AVERAGE',
-                'In Rate (MB/s)': avg_in_rate,
-                'Out Rate (MB/s)': avg_out_rate,
-                'Time Diff (s)': rates_df['Time Diff (s)'].mean()
-            }, {
-                'Timestamp': 'MAX',
-                'In Rate (MB/s)': max_in_rate,
-                'Out Rate (MB/s)': max_out_rate,
-                'Time Diff (s)': rates_df['Time Diff (s)'].max()
-            }])
-            
-            # Save to Excel
-            df_for_excel = pd.concat([rates_df, summary])
-            excel_file = f"network_rates_{HOST_IP.replace('.', '_')}_eth0.xlsx"
-            writer = pd.ExcelWriter(excel_file, engine='openpyxl')
-            df_for_excel.to_excel(writer, index=False, sheet_name='Network Rates')
+    # Every interval of every interface in one vectorized pass; resets (and, from raw
+    # counters, wraps) are handled and intervals above the host's link capacity are dropped
+    names = list(keys)
+    keep = result.valid
+    mb = 1024 * 1024
+    rates_df = pd.DataFrame({
+        'Host': [names[index][0] for index in result.series[keep]],
+        'Interface': [names[index][1] for index in result.series[keep]],
+        'Timestamp': list(pd.to_datetime(result.ends[keep], unit='s', utc=True).strftime('%Y-%m-%d %H:%M:%S')),
+        'In Rate (MB/s)': result.rates[keep, 0] / mb,
+        'Out Rate (MB/s)': result.rates[keep, 1] / mb,
+        'Time Diff (s)': result.seconds[keep]
+    })
+    
+    table = rate_table(keys, result)
+    summary = pd.DataFrame([{
+        'Host': host_ip,
+        'Average In (MB/s)': entry['net_in_rate'] / mb,
+        'Average Out (MB/s)': entry['net_out_rate'] / mb,
+        'Peak In (MB/s)': entry['net_in_peak'] / mb,
+        'Peak Out (MB/s)': entry['net_out_peak'] / mb,
+        'Utilization (%)': entry['net_utilization'],
+        'Interfaces': entry['interfaces'],
+        'Counter Resets': entry['counter_resets'],
+        'Counter Wraps': entry['counter_wraps'],
+        'Dropped Intervals': entry['dropped_intervals']
+    } for host_ip, entry in sorted(table.items())])
+    
+    if rates_df.empty:
+        print("Could not calculate any valid network rates.")
+        return table
+    
+    excel_file = "network_rates.xlsx" if len(host_ips) > 1 else f"network_rates_{host_ips[0].replace('.', '_')}.xlsx"
+    with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
+        for sheet_name, frame in (('Network Rates', rates_df), ('Host Summary', summary)):
+            frame.to_excel(writer, index=False, sheet_name=sheet_name)
             
             # Auto-adjust columns
-            for column in df_for_excel:
-                column_length = max(df_for_excel[column].astype(str).map(len).max(), len(column))
-                col_idx = df_for_excel.columns.get_loc(column)
-                writer.sheets['Network Rates'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
-            
-            writer.close()
-            
-            print(f"\nExported {len(rates_data)} network rate calculations to {excel_file}")
-            print("\nNetwork Rate Summary for eth0:")
-            print(f"  Average In Rate: {avg_in_rate:.4f} MB/s")
-            print(f"  Average Out Rate: {avg_out_rate:.4f} MB/s")
-            print(f"  Maximum In Rate: {max_in_rate:.4f} MB/s")
-            print(f"  Maximum Out Rate: {max_out_rate:.4f} MB/s")
-        else:
-            print("Could not calculate any valid network rates.")
-    else:
-        print(f"Error: {response.text}")
+            for column in frame:
+                column_length = max(frame[column].astype(str).map(len).max(), len(column))
+                col_idx = frame.columns.get_loc(column)
+                writer.sheets[sheet_name].column_dimensions[chr(65 + col_idx)].width = column_length + 2
+    
+    print(f"\nExported {len(rates_df)} network rate calculations to {excel_file}")
+    for host_ip, entry in sorted(table.items()):
+        print(f"\nNetwork Rate Summary for {host_ip} ({entry['interfaces']} interfaces):")
+        print(f"  Average In Rate: {entry['net_in_rate'] / mb:.4f} MB/s")
+        print(f"  Average Out Rate: {entry['net_out_rate'] / mb:.4f} MB/s")
+        print(f"  Maximum In Rate: {entry['net_in_peak'] / mb:.4f} MB/s")
+        print(f"  Maximum Out Rate: {entry['net_out_peak'] / mb:.4f} MB/s")
+        print(f"  Utilization: {entry['net_utilization']:.1f}% of capacity")
+        if entry['counter_resets'] or entry['counter_wraps'] or entry['dropped_intervals']:
+            print(f"  Counter resets/wraps: {entry['counter_resets']}/{entry['counter_wraps']}, "
+                  f"dropped intervals: {entry['dropped_intervals']}")
+    return table
 
 if __name__ == "__main__":
     print("Analyzing network traffic metrics...")
     export_network_metrics_to_excel()
+    if RATE_QUERY_MODE == "server":
+        # Only bucketed rates cross the wire for this one
+        export_network_rates_to_excel([HOST_IP])
+    calculate_network_rates()
     calculate_network_rates()
\ No newline at end of file
@@ -1,8 +1,12 @@
 import requests
+import http_transport
+import query_costs
+from elastic_paginator import iter_hits, HitsJsonWriter
 import json
 import datetime
 import pandas as pd
 from urllib3.exceptions import InsecureRequestWarning
+from latency_sketch import DurationSketch, build_bins_agg, merge_sketches
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 # Hardcoded properties
@@ -21,7 +25,6 @@ def query_zeek_conn_logs():
     
     # Updated query based on the sample data structure
     query = {
-        "size": 1000,
         "sort": [
             {"@timestamp": {"order": "desc"}}  # Most recent first
         ],
@@ -47,166 +50,268 @@ def query_zeek_conn_logs():
         }
     }
     
-    # Send request to Elasticsearch
+    # Stream every matching log to the JSON file page by page; a full day no longer truncates
     print(f"Searching for Zeek conn logs with host IP {HOST_IP} from {START_TIME} to {END_TIME}")
-    response = requests.post(
-        f"{ELASTIC_URL}/_search",
-        json=query,
-        auth=(USERNAME, PASSWORD),
-        verify=False
-    )
+    try:
+        with HitsJsonWriter("zeek_conn_logs.json") as writer:
+            for hit in iter_hits(ELASTIC_URL, query, (USERNAME, PASSWORD), template="zeek_conn_dump"):
+                if writer.count == 0:
+                    print_conn_log_sample(hit)
+                writer.write(hit)
+    except requests.HTTPError as err:
+        print(f"Error: {err.response.text}")
+        return None
     
-    print(f"Response status code: {response.status_code}")
+    print(f"Response saved to zeek_conn_logs.json")
+    print(f"Total Zeek connection log hits: {writer.count}")
     
-    if response.status_code == 200:
-        result = response.json()
-        with open("zeek_conn_logs.json", "w") as f:
-            json.dump(result, f, indent=4)
-        print(f"Response saved to zeek_conn_logs.json")
+    if writer.count == 0:
+        print("\nNo Zeek connection logs found. Possible reasons:")
+        print("1. Check if the date range includes active times")
+        print("2. Verify if the host IP has any logged connections")
+        print("3. Check for possible index pattern issues")
         
-        # Print hit count
-        hit_count = result.get('hits', {}).get('total', {}).get('value', 0)
-        print(f"Total Zeek connection log hits: {hit_count}")
+        # Print the query for debugging
+        print("\nQuery used:")
+        print(json.dumps(query, indent=2))
+    
+    return writer.count
+
+def print_conn_log_sample(hit):
+    """Print the key connection fields of a single Zeek conn log"""
+    print("\nSample data from first Zeek conn log:")
+    source = hit.get('_source', {})
+    
+    # Display key connection information from the conn field
+    conn = source.get('conn', {})
+    timestamp = source.get('@timestamp', 'N/A')
+    
+    if conn:
+        conn_id = conn.get('id', {})
+        orig_h = conn_id.get('orig_h', 'N/A')
+        orig_p = conn_id.get('orig_p', 'N/A')
+        resp_h = conn_id.get('resp_h', 'N/A')
+        resp_p = conn_id.get('resp_p', 'N/A')
+        proto = conn.get('proto', 'N/A')
+        duration = conn.get('duration', 'N/A')
+        orig_bytes = conn.get('orig_bytes', 'N/A')
+        resp_bytes = conn.get('resp_bytes', 'N/A')
+        conn_state = conn.get('conn_state', 'N/A')
         
-        # Print sample data from first hit if available
-        hits = result.get('hits', {}).get('hits', [])
-        if hits:
-            print("\nSample data from first Zeek conn log:")
-            source = hits[0].get('_source', {})
-            
-            # Display key connection information from the conn field
-            conn = source.get('conn', {})
-            timestamp = source.get('@timestamp', 'N/A')
-            
-            if conn:
-                conn_id = conn.get('id', {})
-                orig_h = conn_id.get('orig_h', 'N/A')
-                orig_p = conn_id.get('orig_p', 'N/A')
-                resp_h = conn_id.get('resp_h', 'N/A')
-                resp_p = conn_id.get('resp_p', 'N/A')
-                proto = conn.get('proto', 'N/A')
-                duration = conn.get('duration', 'N/A')
-                orig_bytes = conn.get('orig_bytes', 'N/A')
-                resp_bytes = conn.get('resp_bytes', 'N/A')
-                conn_state = conn.get('conn_state', 'N/A')
-                
-                print(f"Timestamp: {timestamp}")
-                print(f"Connection: {orig_h}:{orig_p} -> {resp_h}:{resp_p} ({proto})")
-                print(f"Duration: {duration} seconds")
-                print(f"Bytes: orig={orig_bytes}, resp={resp_bytes}")
-                print(f"State: {conn_state}")
-            else:
-                print("Warning: Conn field not found in the log")
-                print("Raw source data:")
-                print(json.dumps(source, indent=2))
-        else:
-            print("\nNo Zeek connection logs found. Possible reasons:")
-            print("1. Check if the date range includes active times")
-            print("2. Verify if the host IP has any logged connections")
-            print("3. Check for possible index pattern issues")
-            
-            # Print the query for debugging
-            print("\nQuery used:")
-            print(json.dumps(query, indent=2))
+        print(f"Timestamp: {timestamp}")
+        print(f"Connection: {orig_h}:{orig_p} -> {resp_h}:{resp_p} ({proto})")
+        print(f"Duration: {duration} seconds")
+        print(f"Bytes: orig={orig_bytes}, resp={resp_bytes}")
+        print(f"State: {conn_state}")
     else:
+        print("Warning: Conn field not found in the log")
+        print("Raw source data:")
+        print(json.dumps(source, indent=2))
+
+# Zeek conn_state values that count as a failed or aborted connection
+ERROR_CONN_STATES = ["S0", "REJ", "RSTO", "RSTR", "RSTOS0", "RSTRH", "SH", "SHR"]
+PEER_BUCKET_SIZE = 1000  # Max remote IPs returned when grouping by peer
+CONN_DURATION_BINS = True  # Also return durations as latency sketch bins (a script runs per conn document)
+
+# Statistics computed server-side for every bucket
+CONN_STATS_AGGS = {
+    "duration": {"stats": {"field": "conn.duration"}},
+    "orig_bytes": {"sum": {"field": "conn.orig_bytes"}},
+    "resp_bytes": {"sum": {"field": "conn.resp_bytes"}},
+    "errors": {"filter": {"terms": {"conn.conn_state": ERROR_CONN_STATES}}}
+}
+
+def build_conn_aggregation_query(host_ips, start_time, end_time, by_peer=False, duration_bins=CONN_DURATION_BINS):
+    """Build a size-0 Zeek conn aggregation for the given hosts.
+
+    With by_peer=False there is one bucket per host in host_ips; with
+    by_peer=True the buckets are the remote IPs those hosts talked to.
+    "incoming" buckets are connections where the host was the responder,
+    "outgoing" ones where it was the originator. duration_bins adds the
+    latency sketch bins parse_conn_aggregation turns into 'duration_sketch'.
+    """
+    host_ips = list(host_ips)
+    stats_aggs = dict(CONN_STATS_AGGS, duration_bins=build_bins_agg()) if duration_bins else CONN_STATS_AGGS
+    if by_peer:
+        directions = {
+            "incoming": {
+                "filter": {"terms": {"conn.id.resp_h": host_ips}},
+                "aggs": {"keys": {"terms": {"field": "conn.id.orig_h", "size": PEER_BUCKET_SIZE},
+                                  "aggs": stats_aggs}}
+            },
+            "outgoing": {
+                "filter": {"terms": {"conn.id.orig_h": host_ips}},
+                "aggs": {"keys": {"terms": {"field": "conn.id.resp_h", "size": PEER_BUCKET_SIZE},
+                                  "aggs": stats_aggs}}
+            }
+        }
+    else:
+        directions = {
+            "incoming": {
+                "filter": {"match_all": {}},
+                "aggs": {"keys": {"terms": {"field": "conn.id.resp_h", "include": host_ips, "size": len(host_ips)},
+                                  "aggs": stats_aggs}}
+            },
+            "outgoing": {
+                "filter": {"match_all": {}},
+                "aggs": {"keys": {"terms": {"field": "conn.id.orig_h", "include": host_ips, "size": len(host_ips)},
+                                  "aggs": stats_aggs}}
+            }
+        }
+
+    return {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {
+                        "bool": {
+                            "should": [
+                                {"terms": {"conn.id.orig_h": host_ips}},
+                                {"terms": {"conn.id.resp_h": host_ips}}
+                            ],
+                            "minimum_should_match": 1
+                        }
+                    },
+                    {"term": {"log_type": "zeek"}},
+                    {"term": {"filter_match_status": "conn"}},
+                    {"range": {"@timestamp": {"gte": start_time, "lte": end_time}}}
+                ]
+            }
+        },
+        "aggs": directions
+    }
+
+def parse_conn_aggregation(result):
+    """Merge incoming/outgoing buckets into {ip: connection statistics}"""
+    table = {}
+    aggregations = result.get('aggregations', {})
+
+    for direction in ("incoming", "outgoing"):
+        for bucket in aggregations.get(direction, {}).get('keys', {}).get('buckets', []):
+            ip = bucket['key']
+            entry = table.setdefault(ip, {
+                'ip': ip,
+                'count': 0,
+                'duration_count': 0,
+                'total_duration': 0,
+                'min_duration': None,
+                'max_duration': None,
+                'incoming_count': 0,
+                'outgoing_count': 0,
+                'orig_bytes_total': 0,
+                'resp_bytes_total': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'error_count': 0
+            })
+
+            duration = bucket.get('duration', {})
+            orig_bytes = bucket.get('orig_bytes', {}).get('value') or 0
+            resp_bytes = bucket.get('resp_bytes', {}).get('value') or 0
+
+            entry['count'] += bucket['doc_count']
+            entry[f"{direction}_count"] += bucket['doc_count']
+            entry['error_count'] += bucket.get('errors', {}).get('doc_count', 0)
+            entry['orig_bytes_total'] += orig_bytes
+            entry['resp_bytes_total'] += resp_bytes
+
+            # Bytes from the focal host's point of view: it sends the responder's
+            # bytes on incoming connections and the originator's bytes on outgoing ones
+            if direction == "incoming":
+                entry['bytes_sent'] += resp_bytes
+                entry['bytes_received'] += orig_bytes
+            else:
+                entry['bytes_sent'] += orig_bytes
+                entry['bytes_received'] += resp_bytes
+
+            bins = bucket.get('duration_bins', {}).get('bins', {}).get('buckets')
+            if bins:
+                # Incoming and outgoing bins merge exactly, unlike server-side percentiles
+                if 'duration_sketch' not in entry:
+                    entry['duration_sketch'] = DurationSketch().state
+                DurationSketch(entry['duration_sketch']).add_bins(bins)
+
+            if duration.get('count'):
+                entry['duration_count'] += duration['count']
+                entry['total_duration'] += duration['sum']
+                if entry['min_duration'] is None or duration['min'] < entry['min_duration']:
+                    entry['min_duration'] = duration['min']
+                if entry['max_duration'] is None or duration['max'] > entry['max_duration']:
+                    entry['max_duration'] = duration['max']
+
+    for entry in table.values():
+        entry['avg_duration'] = entry['total_duration'] / entry['duration_count'] if entry['duration_count'] else 0
+        entry['error_ratio'] = entry['error_count'] / entry['count'] if entry['count'] else 0
+        if 'duration_sketch' in entry:
+            # The bins carry counts only; exact bounds from the stats agg keep quantiles inside them
+            entry['duration_sketch'].update(sum=entry['total_duration'], min=entry['min_duration'],
+                                            max=entry['max_duration'])
+
+    return table
+
+def query_conn_aggregates(host_ips, start_time=START_TIME, end_time=END_TIME, by_peer=False):
+    """Compute per-host (or per-peer) connection statistics in a single aggregation request"""
+    if not host_ips:
+        return {}
+
+    query = build_conn_aggregation_query(host_ips, start_time, end_time, by_peer)
+    template = "zeek_conn_by_peer" if by_peer else "zeek_conn_aggregates"
+    response = http_transport.post(
+        f"{ELASTIC_URL}/_search",
+        json=query_costs.prepare(template, query),
+        compress=True,
+        auth=(USERNAME, PASSWORD),
+        verify=False
+    )
+
+    if response.status_code != 200:
         print(f"Error: {response.text}")
-    
-    return result if response.status_code == 200 else None
+        return None
+
+    result = response.json()
+    query_costs.record(template, result, response.elapsed.total_seconds())
+    return parse_conn_aggregation(result)
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
 
 def analyze_connection_durations():
     """Analyze connection durations from Zeek logs and export to Excel"""
     print("Analyzing connection durations...")
     
-    # First, get the Zeek connection logs
-    result = query_zeek_conn_logs()
+    # Per-remote-IP statistics are aggregated by Elasticsearch, so no hit cap applies
+    connection_data = query_conn_aggregates([HOST_IP], START_TIME, END_TIME, by_peer=True)
     
-    if not result:
+    if not connection_data:
         print("No connection logs to analyze.")
         return
     
-    # Create a dictionary to store connection data grouped by remote IP
-    connection_data = {}
-    
-    # Process each connection log
-    hits = result.get('hits', {}).get('hits', [])
-    for hit in hits:
-        source = hit.get('_source', {})
-        conn = source.get('conn', {})
-        
-        if conn:
-            # Get connection details
-            conn_id = conn.get('id', {})
-            orig_h = conn_id.get('orig_h')
-            resp_h = conn_id.get('resp_h')
-            duration = conn.get('duration')
-            
-            # Skip entries without duration information
-            if duration is None:
-                continue
-            
-            # Determine which IP is remote (not our host IP)
-            if orig_h == HOST_IP:
-                remote_ip = resp_h
-                direction = "outgoing"
-            elif resp_h == HOST_IP:
-                remote_ip = orig_h
-                direction = "incoming"
-            else:
-                # Should not happen with our query, but just in case
-                continue
-            
-            # Initialize entry for this remote IP if it doesn't exist
-            if remote_ip not in connection_data:
-                connection_data[remote_ip] = {
-                    'ip': remote_ip,
-                    'total_duration': 0,
-                    'count': 0,
-                    'min_duration': float('inf'),
-                    'max_duration': 0,
-                    'incoming_count': 0,
-                    'outgoing_count': 0,
-                    'orig_bytes_total': 0,
-                    'resp_bytes_total': 0
-                }
-            
-            # Update connection statistics
-            connection_data[remote_ip]['total_duration'] += duration
-            connection_data[remote_ip]['count'] += 1
-            connection_data[remote_ip]['min_duration'] = min(connection_data[remote_ip]['min_duration'], duration)
-            connection_data[remote_ip]['max_duration'] = max(connection_data[remote_ip]['max_duration'], duration)
-            
-            # Add bytes transferred when available
-            orig_bytes = conn.get('orig_bytes', 0) or 0
-            resp_bytes = conn.get('resp_bytes', 0) or 0
-            connection_data[remote_ip]['orig_bytes_total'] += orig_bytes
-            connection_data[remote_ip]['resp_bytes_total'] += resp_bytes
-            
-            # Update direction counts
-            if direction == "incoming":
-                connection_data[remote_ip]['incoming_count'] += 1
-            else:
-                connection_data[remote_ip]['outgoing_count'] += 1
-    
-    # Calculate averages and prepare data for Excel
+    # Prepare data for Excel
     excel_data = []
     for remote_ip, data in connection_data.items():
-        if data['count'] > 0:
-            avg_duration = data['total_duration'] / data['count']
+        if data['duration_count'] > 0:
             # Convert to milliseconds
-            avg_duration_ms = avg_duration * 1000
-            min_duration_ms = data['min_duration'] * 1000 if data['min_duration'] != float('inf') else 0
+            avg_duration_ms = data['avg_duration'] * 1000
+            min_duration_ms = data['min_duration'] * 1000
             max_duration_ms = data['max_duration'] * 1000
+            quantiles = DurationSketch(data.get('duration_sketch')).quantiles()
             
             excel_data.append({
                 'Remote IP': remote_ip,
-                'Connection Count': data['count'],
+                # Connections with a duration, as before; All Connections also counts those without
+                'Connection Count': data['duration_count'],
+                'All Connections': data['count'],
                 'Avg Duration (ms)': round(avg_duration_ms, 2),
                 'Min Duration (ms)': round(min_duration_ms, 2),
+                'P95 Duration (ms)': _milliseconds(quantiles[95]),
+                'P99 Duration (ms)': _milliseconds(quantiles[99]),
                 'Max Duration (ms)': round(max_duration_ms, 2),
                 'Incoming Connections': data['incoming_count'],
                 'Outgoing Connections': data['outgoing_count'],
                 'Bytes Sent': data['orig_bytes_total'],
-                'Bytes Received': data['resp_bytes_total']
+                'Bytes Received': data['resp_bytes_total'],
+                'Error Ratio': round(data['error_ratio'], 4)
             })
     
     # Sort by average duration (descending)
@@ -219,18 +324,24 @@ def analyze_connection_durations():
         # Calculate overall average across all connections
         overall_avg = df['Avg Duration (ms)'].mean()
         total_connections = df['Connection Count'].sum()
+        # Per-peer sketches merge into the host-wide tail, which averaging per-peer percentiles cannot give
+        overall = DurationSketch(merge_sketches(data.get('duration_sketch') for data in connection_data.values())).quantiles()
         
         # Create summary row
         summary = pd.DataFrame([{
             'Remote IP': 'AVERAGE/TOTAL',
             'Connection Count': total_connections,
+            'All Connections': df['All Connections'].sum(),
             'Avg Duration (ms)': round(overall_avg, 2),
             'Min Duration (ms)': df['Min Duration (ms)'].min(),
+            'P95 Duration (ms)': _milliseconds(overall[95]),
+            'P99 Duration (ms)': _milliseconds(overall[99]),
             'Max Duration (ms)': df['Max Duration (ms)'].max(),
             'Incoming Connections': df['Incoming Connections'].sum(),
             'Outgoing Connections': df['Outgoing Connections'].sum(),
             'Bytes Sent': df['Bytes Sent'].sum(),
-            'Bytes Received': df['Bytes Received'].sum()
+            'Bytes Received': df['Bytes Received'].sum(),
+            'Error Ratio': round((df['Error Ratio'] * df['All Connections']).sum() / df['All Connections'].sum(), 4) if total_connections else 0
         }])
         
         # Add summary to the dataframe
@@ -241,9 +352,9 @@ def analyze_connection_durations():
         writer = pd.ExcelWriter(excel_file, engine='openpyxl')
         df.to_excel(writer, index=False, sheet_name='Connection Durations')
         
-        # Auto-adjust columns width
+        # Auto-adjust columns width (percentiles are empty for peers without sketch bins)
         for column in df:
-            column_length = max(df[column].astype(str).map(len).max(), len(column))
+            column_length = max(df[column].map(lambda value: len(str(value))).max(), len(column))
             col_idx = df.columns.get_loc(column)
             writer.sheets['Connection Durations'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
         
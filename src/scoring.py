@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import threading
+import numpy as np
+import jsonschema
+
+# Scoring configuration
+PROFILES_FILE = "scoring_profiles.json"  # Re-read between cycles whenever it changes
+DEFAULT_PROFILE_NAME = "default"
+
+# Built-in profile, used when no profiles file exists (the original hard-coded curves).
+# Each metric has a default for missing values, a weight and an ordered list of
+# segments: the first segment whose bound ("lt": x < bound, "le": x <= bound)
+# holds is used, the last segment has no bound. A segment is either a constant
+# "value" or the line y0 + ((x - x0) / scale) * rate, clamped to "min"/"max".
+# A metric may name a "fallback" metric whose value stands in when it is
+# missing (the default applies only when both are missing).
+DEFAULT_PROFILE = {
+    "metrics": {
+        "cpu_utilization": {
+            "weight": 0.15, "default": 50,
+            "segments": [
+                {"le": 10, "value": 100},
+                {"y0": 100, "rate": -1, "min": 0}
+            ]
+        },
+        "ram_utilization": {
+            "weight": 0.15, "default": 50,
+            "segments": [
+                {"le": 10, "value": 100},
+                {"y0": 100, "rate": -1, "min": 0}
+            ]
+        },
+        "trend_coefficient": {
+            "weight": 0.20, "default": 0,
+            "segments": [
+                {"x0": -1, "rate": 50}
+            ]
+        },
+        "avg_connection_duration": {
+            "weight": 0.20, "default": 150,
+            "segments": [
+                {"le": 200, "value": 100},
+                {"y0": 100, "x0": 200, "scale": 100, "rate": -20, "min": 0}
+            ]
+        },
+        "bytes_sent": {
+            "weight": 0.10, "default": 10000,
+            "segments": [
+                {"lt": 10000, "scale": 10000, "rate": 100},
+                {"le": 50000, "value": 100},
+                {"y0": 100, "x0": 50000, "scale": 50000, "rate": -10, "min": 50}
+            ]
+        },
+        "bytes_received": {
+            "weight": 0.10, "default": 30000,
+            "segments": [
+                {"lt": 20000, "scale": 20000, "rate": 100},
+                {"le": 100000, "value": 100},
+                {"y0": 100, "x0": 100000, "scale": 100000, "rate": -10, "min": 50}
+            ]
+        },
+        "error_ratio": {
+            "weight": 0.10, "default": 0.02,
+            "segments": [
+                {"le": 0.01, "value": 100},
+                {"y0": 100, "rate": -2000, "min": 0}
+            ]
+        }
+    }
+}
+
+_SEGMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "lt": {"type": "number"},
+        "le": {"type": "number"},
+        "value": {"type": "number"},
+        "y0": {"type": "number"},
+        "x0": {"type": "number"},
+        "scale": {"type": "number", "not": {"const": 0}},
+        "rate": {"type": "number"},
+        "min": {"type": "number"},
+        "max": {"type": "number"}
+    },
+    "additionalProperties": False,
+    "not": {"required": ["lt", "le"]}
+}
+
+PROFILES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "default_profile": {"type": "string"},
+        "services": {
+            "type": "object",
+            "additionalProperties": {"type": "string"}
+        },
+        "profiles": {
+            "type": "object",
+            "minProperties": 1,
+            "additionalProperties": {
+                "type": "object",
+                "properties": {
+                    "metrics": {
+                        "type": "object",
+                        "minProperties": 1,
+                        "additionalProperties": {
+                            "type": "object",
+                            "properties": {
+                                "weight": {"type": "number"},
+                                "default": {"type": "number"},
+                                "fallback": {"type": "string"},
+                                "segments": {"type": "array", "minItems": 1, "items": _SEGMENT_SCHEMA}
+                            },
+                            "required": ["weight", "default", "segments"],
+                            "additionalProperties": False
+                        }
+                    }
+                },
+                "required": ["metrics"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["profiles"],
+    "additionalProperties": False
+}
+
+
+def _floor(values, floor):
+    """Elementwise max(floor, values) with Python's max() semantics (NaN yields the floor)"""
+    return np.where(values > floor, values, floor)
+
+
+def _ceiling(values, ceiling):
+    """Elementwise min(ceiling, values) with Python's min() semantics"""
+    return np.where(values < ceiling, values, ceiling)
+
+
+class Segment:
+    """One compiled piece of a curve"""
+
+    def __init__(self, spec):
+        self.bound = spec.get("lt", spec.get("le"))
+        self.inclusive = "le" in spec
+        self.value = spec.get("value")
+        self.y0 = float(spec.get("y0", 0))
+        self.x0 = float(spec.get("x0", 0))
+        self.scale = float(spec.get("scale", 1))
+        self.rate = float(spec.get("rate", 0))
+        self.min = spec.get("min")
+        self.max = spec.get("max")
+
+    def condition(self, x):
+        return x <= self.bound if self.inclusive else x < self.bound
+
+    def evaluate(self, x):
+        if self.value is not None:
+            return np.full(x.shape, float(self.value))
+        y = self.y0 + ((x - self.x0) / self.scale) * self.rate
+        if self.min is not None:
+            y = _floor(y, float(self.min))
+        if self.max is not None:
+            y = _ceiling(y, float(self.max))
+        return y
+
+
+class ScoringProfile:
+    """A validated profile compiled into per-metric curves and a weight vector"""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.metrics = list(spec["metrics"])
+        self.weights = {metric: float(curve["weight"]) for metric, curve in spec["metrics"].items()}
+        self.defaults = {metric: float(curve["default"]) for metric, curve in spec["metrics"].items()}
+        self.fallbacks = {metric: curve["fallback"] for metric, curve in spec["metrics"].items() if "fallback" in curve}
+        self.curves = {}
+        for metric, curve in spec["metrics"].items():
+            segments = [Segment(segment) for segment in curve["segments"]]
+            if segments[-1].bound is None:
+                self.curves[metric] = (segments[:-1], segments[-1])
+            else:
+                raise ValueError(f"profile {name}: last segment of {metric} must have no bound")
+            if any(segment.bound is None for segment in segments[:-1]):
+                raise ValueError(f"profile {name}: only the last segment of {metric} may omit its bound")
+
+    def columns(self, metrics_list):
+        """Turn a list of per-instance metric dicts into one float64 array per scored metric"""
+        columns = {}
+        for metric, default in self.defaults.items():
+            fallback = self.fallbacks.get(metric)
+            if fallback:
+                # The fallback's own default applies when the instance has neither value
+                default = self.defaults.get(fallback, default)
+                values = (metrics.get(metric, metrics.get(fallback, default)) for metrics in metrics_list)
+            else:
+                values = (metrics.get(metric, default) for metrics in metrics_list)
+            columns[metric] = np.fromiter(values, dtype=np.float64, count=len(metrics_list))
+        return columns
+
+    def score_columns(self, columns):
+        """Apply each metric's curve to its column; returns one 0-100 score array per metric"""
+        scores = {}
+        for metric, (bounded, last) in self.curves.items():
+            x = columns[metric]
+            if not bounded:
+                scores[metric] = last.evaluate(x)
+                continue
+            scores[metric] = np.select(
+                [segment.condition(x) for segment in bounded],
+                [segment.evaluate(x) for segment in bounded],
+                last.evaluate(x)
+            )
+        return scores
+
+    def weighted_score(self, scores):
+        """Weighted sum of score arrays, accumulated in metric order so results match a scalar loop"""
+        total = None
+        for metric, score in scores.items():
+            term = score * self.weights.get(metric, 0)
+            total = 0 + term if total is None else total + term
+        return total
+
+    def score(self, metrics_list):
+        """Score a fleet at once; returns (scores, weighted_scores, final_weights) as arrays"""
+        scores = self.score_columns(self.columns(metrics_list))
+        weighted = self.weighted_score(scores)
+        # np.round rounds half to even like round(), keeping Fabio weights unchanged
+        final = np.round(weighted).astype(np.int64)
+        return scores, weighted, final
+
+
+def compile_profiles(document):
+    """Validate a profiles document and compile every profile; raises on any error"""
+    jsonschema.validate(document, PROFILES_SCHEMA)
+    profiles = {name: ScoringProfile(name, spec) for name, spec in document["profiles"].items()}
+    default_name = document.get("default_profile", DEFAULT_PROFILE_NAME)
+    services = dict(document.get("services", {}))
+    for profile_name in [default_name] + list(services.values()):
+        if profile_name not in profiles:
+            raise ValueError(f"unknown scoring profile: {profile_name}")
+    return profiles, services, default_name
+
+
+class ProfileRegistry:
+    """Scoring profiles loaded from PROFILES_FILE, reloaded when the file changes.
+
+    A file that fails validation is logged and ignored; the previously loaded
+    profiles stay in effect.
+    """
+
+    def __init__(self, path=PROFILES_FILE):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.profiles, self.services, self.default_name = compile_profiles(
+            {"profiles": {DEFAULT_PROFILE_NAME: DEFAULT_PROFILE}}
+        )
+        self.reload()
+
+    def reload(self):
+        """Re-read the profiles file if its modification time changed; returns True when reloaded"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        try:
+            with open(self.path) as f:
+                compiled = compile_profiles(json.load(f))
+        except Exception as e:
+            # ValidationError's str() includes the whole schema; its message is enough
+            logging.error("Invalid scoring profiles in %s, keeping previous profiles: %s",
+                          self.path, getattr(e, "message", e))
+            return False
+
+        with self.lock:
+            self.profiles, self.services, self.default_name = compiled
+        logging.info("Loaded scoring profiles %s from %s", ", ".join(self.profiles), self.path)
+        return True
+
+    def for_service(self, service_name):
+        """Compiled profile used to score the given Consul service"""
+        with self.lock:
+            return self.profiles[self.services.get(service_name, self.default_name)]
+
+
+def score_instances(metrics_list, profile=None):
+    """Score a fleet with the given profile (default: the built-in one)"""
+    profile = profile or _builtin_profile
+    return profile.score(metrics_list)
+
+
+_builtin_profile = ScoringProfile(DEFAULT_PROFILE_NAME, DEFAULT_PROFILE)
@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http_transport
+
+# Stand-in configuration
+ELASTIC_UPSTREAM = "https://10.100.0.7:9200"  # Proxied in record mode
+CONSUL_UPSTREAM = "http://10.100.0.9:8500"
+ELASTIC_PORT = 19200
+CONSUL_PORT = 18500
+FIXTURES_FILE = "fixtures/session.jsonl.gz"
+CATALOG_SEED_DIR = "."  # Where <service>_instances.json catalog captures are looked up
+LATENCY_MS = 0  # Injected delay per replayed response
+JITTER_MS = 0  # Extra uniform random delay (seeded, so runs stay reproducible)
+RECORDED_LATENCY = False  # Replay each response after the upstream time captured with it instead
+SEED = 0
+MAX_BLOCKING_WAIT = 10  # Seconds a replayed blocking catalog query is held at most
+
+# Body keys that change on every run (time ranges, PIT ids, cursors) and are
+# ignored when matching a replayed request to a recorded one
+VOLATILE_KEYS = {"gte", "gt", "lte", "lt", "from", "to", "pit", "search_after", "keep_alive", "id", "index", "wait"}
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in sorted(value.items()) if key not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def request_signature(backend, method, path, body):
+    """Stable key for a request: backend, method, path and the body without volatile values"""
+    lines = []
+    for line in (body or b"").decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            lines.append(_normalize(json.loads(line)))
+        except ValueError:
+            lines.append(line)
+    digest = hashlib.sha1(json.dumps(lines, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{backend} {method} {path} {digest}"
+
+
+class FixtureStore:
+    """Recorded exchanges, kept as gzip-compressed JSON lines"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.by_signature = {}
+        self.by_route = {}
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        with gzip.open(self.path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    self.add(json.loads(line))
+        return len(self.entries)
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            self.by_signature.setdefault(entry["signature"], []).append(entry)
+            self.by_route.setdefault((entry["backend"], entry["method"], entry["path"]), []).append(entry)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock, gzip.open(self.path, "wt") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def match(self, signature, backend, method, path):
+        """Recorded response for a request: exact signature first, then any on the same route.
+
+        Repeated requests walk through the recorded responses in order and
+        wrap around, so a recorded sequence replays the same way every run.
+        """
+        with self.lock:
+            candidates = self.by_signature.get(signature) or self.by_route.get((backend, method, path))
+            if not candidates:
+                return None
+            key = signature if signature in self.by_signature else (backend, method, path)
+            position = self.cursors.get(key, 0)
+            self.cursors[key] = position + 1
+            return candidates[position % len(candidates)]
+
+    def latest(self, backend, method, path):
+        with self.lock:
+            entries = self.by_route.get((backend, method, path))
+            return entries[-1] if entries else None
+
+
+class ConsulEmulator:
+    """Stateful catalog for replay: blocking queries, agent reads, registration, CAS transactions and checks"""
+
+    def __init__(self):
+        self.services = {}  # service name -> {service id: catalog entry}
+        self.check_status = {}  # service id -> check status; unlisted instances pass
+        self.index = 1
+        self.condition = threading.Condition()
+
+    def seed(self, service_name, entries):
+        with self.condition:
+            self.services[service_name] = {entry["ServiceID"]: dict(entry) for entry in entries}
+            self.index = max([self.index] + [entry.get("ModifyIndex", 0) for entry in entries])
+
+    def catalog(self, service_name, index=0, wait=0):
+        """Entries of a service, holding the request while index is current (like Consul)"""
+        deadline = time.time() + min(wait, MAX_BLOCKING_WAIT)
+        with self.condition:
+            while index and index >= self.index and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return list(self.services.get(service_name, {}).values()), self.index
+
+    def health_checks(self, service_name):
+        """One service check per instance, shaped like /v1/health/checks/<service>"""
+        with self.condition:
+            return [{"CheckID": f"service:{service_id}", "ServiceID": service_id, "ServiceName": service_name,
+                     "Node": entry.get("Node"), "Status": self.check_status.get(service_id, "passing")}
+                    for service_id, entry in self.services.get(service_name, {}).items()]
+
+    def find(self, service_id):
+        for entries in self.services.values():
+            if service_id in entries:
+                return entries[service_id]
+        return None
+
+    def agent_service(self, service_id):
+        entry = self.find(service_id)
+        if entry is None:
+            return None
+        return {
+            "ID": entry["ServiceID"], "Service": entry.get("ServiceName"), "Tags": entry.get("ServiceTags", []),
+            "Address": entry.get("ServiceAddress"), "Port": entry.get("ServicePort"),
+            "Meta": entry.get("ServiceMeta", {}), "EnableTagOverride": entry.get("ServiceEnableTagOverride", False),
+            "ModifyIndex": entry.get("ModifyIndex")
+        }
+
+    def register(self, service):
+        """Apply a registration (creating the entry if needed) and bump the index"""
+        with self.condition:
+            entry = self.find(service["ID"])
+            name = service.get("Service") or service.get("Name") or (entry or {}).get("ServiceName")
+            entry = dict(entry or {"ServiceID": service["ID"], "ServiceName": name, "CreateIndex": self.index + 1})
+            entry.update({
+                "ServiceTags": service.get("Tags", []),
+                "ServiceAddress": service.get("Address", entry.get("ServiceAddress", "")),
+                "ServicePort": service.get("Port", entry.get("ServicePort", 0)),
+                "ServiceMeta": service.get("Meta", entry.get("ServiceMeta", {})),
+                "ServiceEnableTagOverride": service.get("EnableTagOverride", entry.get("ServiceEnableTagOverride", False))
+            })
+            self.index += 1
+            entry["ModifyIndex"] = self.index
+            self.services.setdefault(name, {})[service["ID"]] = entry
+            self.condition.notify_all()
+
+    def transaction(self, operations):
+        """Validate every cas operation first, then apply all of them (all-or-nothing)"""
+        with self.condition:
+            errors = []
+            for position, operation in enumerate(operations):
+                service = operation.get("Service", {}).get("Service", {})
+                entry = self.find(service.get("ID"))
+                if entry is None or entry.get("ModifyIndex") != service.get("ModifyIndex"):
+                    errors.append({"OpIndex": position,
+                                   "What": f"failed to set service {service.get('ID')!r}, index is stale"})
+            if errors:
+                return 409, {"Results": None, "Errors": errors}
+            results = []
+            for operation in operations:
+                service = dict(operation["Service"]["Service"])
+                if not self.find(service["ID"]).get("ServiceEnableTagOverride"):
+                    # The owning agent's anti-entropy sync puts its own tags straight back
+                    service["Tags"] = self.find(service["ID"]).get("ServiceTags", [])
+                self.register(service)
+                results.append({"Service": self.find(service["ID"])})
+            return 200, {"Results": results, "Errors": None}
+
+
+class StandIn:
+    """Local Elasticsearch and Consul endpoints in record or replay mode.
+
+    record: requests are forwarded to the real upstreams and every exchange is
+    captured into the fixtures file on stop().
+    replay: Elasticsearch requests are answered from the fixtures (matched on
+    path and body, ignoring time ranges and cursors; unmatched searches get a
+    well-formed empty response), Consul is emulated from the recorded or
+    captured catalog, and every response is delayed by the configured latency.
+    """
+
+    def __init__(self, mode="replay", fixtures_file=FIXTURES_FILE, latency_ms=LATENCY_MS, jitter_ms=JITTER_MS,
+                 seed=SEED, recorded_latency=RECORDED_LATENCY, elastic_upstream=ELASTIC_UPSTREAM,
+                 consul_upstream=CONSUL_UPSTREAM, search_responder=None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown mode: {mode}")
+        self.mode = mode
+        self.fixtures = FixtureStore(fixtures_file)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.recorded_latency = recorded_latency
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.upstreams = {"elastic": elastic_upstream, "consul": consul_upstream}
+        self.consul = ConsulEmulator()
+        self.servers = []
+        self.pit_counter = 0
+        # Called with (index, query) for searches no fixture matches; returns a response dict or None
+        self.search_responder = search_responder
+        self.stats = {"requests": 0, "matched": 0, "unmatched": 0, "elastic_requests": 0, "consul_requests": 0,
+                      "bytes_received": 0, "bytes_sent": 0}
+        self.stats_lock = threading.Lock()
+
+        if mode == "replay":
+            self.fixtures.load()
+
+    def seed_catalog(self, service_name, seed_dir=CATALOG_SEED_DIR):
+        """Seed the emulated catalog from the last recorded read, else from <service>_instances.json"""
+        recorded = self.fixtures.latest("consul", "GET", f"/v1/catalog/service/{service_name}")
+        if recorded is not None:
+            self.consul.seed(service_name, json.loads(recorded["body"]))
+            return True
+        path = os.path.join(seed_dir, f"{service_name}_instances.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.consul.seed(service_name, json.load(f))
+            return True
+        return False
+
+    def start(self, elastic_port=0, consul_port=0, host="127.0.0.1"):
+        """Start both endpoints; returns (elastic_url, consul_url)"""
+        urls = []
+        for backend, port in (("elastic", elastic_port), ("consul", consul_port)):
+            server = ThreadingHTTPServer((host, port), self.handler_class(backend))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f"standin-{backend}", daemon=True).start()
+            self.servers.append(server)
+            urls.append(f"http://{host}:{server.server_port}")
+        return tuple(urls)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.mode == "record":
+            self.fixtures.save()
+
+    def delay(self, entry=None):
+        with self.random_lock:
+            extra = self.random.uniform(0, self.jitter) if self.jitter else 0
+        base = self.latency
+        if self.recorded_latency and entry is not None:
+            base = entry.get("elapsed_ms", 0) / 1000
+        if base or extra:
+            time.sleep(base + extra)
+
+    def handler_class(self, backend):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug("standin %s: " + format, backend, *args)
+
+            def handle_any(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                standin.count("bytes_received", length)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                status, headers, payload = standin.dispatch(backend, self.command, self.path, body,
+                                                            self.headers.get("Authorization"))
+                data = payload.encode() if isinstance(payload, str) else payload
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                standin.count("bytes_sent", len(data))
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+        return Handler
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def dispatch(self, backend, method, raw_path, body, authorization=None):
+        self.count("requests")
+        self.count(f"{backend}_requests")
+        parts = urlsplit(raw_path)
+        path = parts.path
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        signature = request_signature(backend, method, path, body)
+
+        if self.mode == "record":
+            return self.forward(backend, method, raw_path, path, body, signature, authorization)
+
+        if backend == "consul":
+            self.delay()
+            return self.emulate_consul(method, path, query, body)
+
+        entry = self.fixtures.match(signature, backend, method, path)
+        self.delay(entry)
+        if entry is not None:
+            self.count("matched")
+            return entry["status"], {"Content-Type": "application/json"}, entry["body"]
+        self.count("unmatched")
+        return self.empty_elastic_response(path, body)
+
+    def forward(self, backend, method, raw_path, path, body, signature, authorization=None):
+        headers = {"Content-Type": "application/x-ndjson" if path.endswith("_msearch") else "application/json"}
+        if authorization:
+            headers["Authorization"] = authorization
+        response = http_transport.request(
+            method,
+            f"{self.upstreams[backend]}{raw_path}",
+            data=body or None,
+            headers=headers,
+            compress=backend == "elastic",
+            # Blocking catalog queries may be held for minutes
+            timeout=(http_transport.CONNECT_TIMEOUT, 600),
+            verify=False
+        )
+        reply_headers = {"Content-Type": response.headers.get("Content-Type", "application/json")}
+        if "X-Consul-Index" in response.headers:
+            reply_headers["X-Consul-Index"] = response.headers["X-Consul-Index"]
+        self.fixtures.add({
+            "signature": signature, "backend": backend, "method": method, "path": path,
+            "status": response.status_code, "headers": reply_headers, "body": response.text,
+            "elapsed_ms": round(response.elapsed.total_seconds() * 1000, 1)
+        })
+        return response.status_code, reply_headers, response.content
+
+    def emulate_consul(self, method, path, query, body):
+        json_headers = {"Content-Type": "application/json"}
+        if method == "GET" and path.startswith("/v1/catalog/service/"):
+            service_name = path.rsplit("/", 1)[-1]
+            if service_name not in self.consul.services:
+                self.seed_catalog(service_name)
+            wait = float(query.get("wait", "0s").rstrip("s") or 0)
+            entries, index = self.consul.catalog(service_name, int(query.get("index", 0)), wait)
+            return 200, dict(json_headers, **{"X-Consul-Index": str(index)}), json.dumps(entries)
+
+        if method == "GET" and path.startswith("/v1/health/checks/"):
+            return 200, json_headers, json.dumps(self.consul.health_checks(path.rsplit("/", 1)[-1]))
+
+        if method == "GET" and path.startswith("/v1/agent/service/"):
+            service = self.consul.agent_service(path.rsplit("/", 1)[-1])
+            if service is None:
+                return 404, {}, "unknown service ID"
+            return 200, json_headers, json.dumps(service)
+
+        if method == "PUT" and path == "/v1/agent/service/register":
+            self.consul.register(json.loads(body))
+            return 200, {}, ""
+
+        if method == "PUT" and path == "/v1/txn":
+            status, result = self.consul.transaction(json.loads(body))
+            return status, json_headers, json.dumps(result)
+
+        return 404, {}, f"stand-in does not implement {method} {path}"
+
+    def empty_elastic_response(self, path, body):
+        """Well-formed empty answers, so unrecorded queries fall back to defaults instead of failing"""
+        json_headers = {"Content-Type": "application/json"}
+        empty = {"took": 0, "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                 "hits": {"total": {"value": 0, "relation": "eq"}, "hits": []}}
+
+        if path.endswith("/_pit") and body:
+            return 200, json_headers, json.dumps({"succeeded": True, "num_freed": 1})
+        if path.endswith("/_pit"):
+            self.pit_counter += 1
+            return 200, json_headers, json.dumps({"id": f"standin-pit-{self.pit_counter}"})
+        if path.endswith("/_msearch"):
+            lines = [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+            responses = [
+                dict(self.search_response(header.get("index"), query) or empty, status=200)
+                for header, query in zip(lines[0::2], lines[1::2])
+            ]
+            return 200, json_headers, json.dumps({"took": 0, "responses": responses})
+        if path.endswith("/_search"):
+            index = path[1:-len("/_search")] or None
+            return 200, json_headers, json.dumps(self.search_response(index, json.loads(body or b"{}")) or empty)
+        return 404, json_headers, json.dumps({"error": f"stand-in does not implement {path}"})
+
+
+    def search_response(self, index, query):
+        if self.search_responder is None:
+            return None
+        return self.search_responder(index, query)
+
+
+def point_balancer_at(balancer_module, elastic_url, consul_url):
+    """Point the load_balancer module's configuration at stand-in (or any other) endpoints"""
+    consul = urlsplit(consul_url)
+    balancer_module.ELASTIC_URL = elastic_url.rstrip("/")
+    balancer_module.CONSUL_HOST = consul.hostname
+    balancer_module.CONSUL_PORT = consul.port
+    balancer_module.USE_HTTPS = consul.scheme == "https"
+
+
+if __name__ == "__main__":
+    # python standin_server.py record|replay|cycle [fixtures file]
+    #   record/replay serve on ELASTIC_PORT/CONSUL_PORT until interrupted;
+    #   cycle replays the fixtures through one full DynamicLoadBalancer cycle
+    mode = sys.argv[1] if len(sys.argv) > 1 else "replay"
+    fixtures_file = sys.argv[2] if len(sys.argv) > 2 else FIXTURES_FILE
+
+    if mode == "cycle":
+        import load_balancer
+        standin = StandIn("replay", fixtures_file)
+        point_balancer_at(load_balancer, *standin.start())
+        started = time.time()
+        load_balancer.DynamicLoadBalancer().run_cycle()
+        print(f"Replayed one cycle in {time.time() - started:.2f}s: {standin.stats}")
+        standin.stop()
+        sys.exit(0)
+
+    standin = StandIn(mode, fixtures_file)
+    elastic_url, consul_url = standin.start(ELASTIC_PORT, CONSUL_PORT)
+    print(f"Stand-in ({mode}) serving Elasticsearch at {elastic_url} and Consul at {consul_url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.stop()
+        print(f"Stopped after {standin.stats['requests']} requests")
@@ -0,0 +1,145 @@
+import math
+import threading
+
+# Trend estimator configuration
+TREND_HALF_LIFE = 1800  # Seconds after which a sample counts half as much in the slope and level
+TREND_HORIZON = 3600  # Normalized trend = relative change the slope predicts over this many seconds
+CONFIDENCE_SAMPLES = 5  # Effective sample count at which confidence reaches half the fit quality
+
+
+class OnlineTrend:
+    """Exponentially weighted least-squares slope and EWMA level of one series, in O(1) state.
+
+    Each update decays the running weighted sums by the time since the last
+    sample and re-centres them on the new sample's time, so the fit costs the
+    same per sample however long the series runs. half_life=None weighs every
+    sample equally (an ordinary least-squares fit).
+    """
+
+    __slots__ = ("half_life", "last_time", "level", "count", "sw", "sww", "swt", "swtt", "swy", "swty", "swyy")
+
+    def __init__(self, half_life=TREND_HALF_LIFE):
+        self.half_life = half_life
+        self.last_time = None
+        self.level = None
+        self.count = 0
+        self.sw = self.sww = self.swt = self.swtt = self.swy = self.swty = self.swyy = 0.0
+
+    def update(self, timestamp, value):
+        """Add one sample; samples older than the last one are ignored"""
+        value = float(value)
+        if self.last_time is None:
+            self.last_time = timestamp
+            self.level = value
+        elif timestamp < self.last_time:
+            return self
+        else:
+            dt = timestamp - self.last_time
+            decay = 0.5 ** (dt / self.half_life) if self.half_life else 1.0
+            # Move the time origin to the new sample, then decay every sum
+            self.swtt = (self.swtt - 2 * dt * self.swt + dt * dt * self.sw) * decay
+            self.swty = (self.swty - dt * self.swy) * decay
+            self.swt = (self.swt - dt * self.sw) * decay
+            self.sw *= decay
+            self.sww *= decay * decay
+            self.swy *= decay
+            self.swyy *= decay
+            # EWMA level on the same half-life; a running mean without decay
+            step = 1 - decay if self.half_life else 1 / (self.count + 1)
+            self.level += step * (value - self.level)
+            self.last_time = timestamp
+
+        # The new sample sits at t = 0 with weight 1
+        self.sw += 1
+        self.sww += 1
+        self.swy += value
+        self.swyy += value * value
+        self.count += 1
+        return self
+
+    def slope(self):
+        """Weighted least-squares slope in units per second (0 until two distinct times are seen)"""
+        denominator = self.sw * self.swtt - self.swt * self.swt
+        if self.count < 2 or denominator <= 1e-12 * max(1.0, self.sw * self.swtt):
+            return 0.0
+        return (self.sw * self.swty - self.swt * self.swy) / denominator
+
+    def trend(self, horizon=TREND_HORIZON):
+        """Relative change the slope predicts over horizon seconds, clamped to -1..1 (0 at a zero level)"""
+        if not self.level:
+            return 0.0
+        return max(-1.0, min(1.0, self.slope() * horizon / abs(self.level)))
+
+    def confidence(self):
+        """0..1: weighted fit quality (R²) scaled by the effective number of samples"""
+        if self.count < 2:
+            return 0.0
+        total = self.swyy - self.swy * self.swy / self.sw
+        if total <= 1e-12 * max(1.0, self.swyy):
+            fit = 1.0
+        else:
+            explained = self.slope() * (self.swty - self.swt * self.swy / self.sw)
+            fit = max(0.0, min(1.0, explained / total))
+        effective = self.sw * self.sw / self.sww
+        return fit * (effective - 1) / (effective - 1 + CONFIDENCE_SAMPLES)
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        estimator = cls(state.get("half_life", TREND_HALF_LIFE))
+        for name in cls.__slots__:
+            if name in state:
+                setattr(estimator, name, state[name])
+        return estimator
+
+
+def trend_of(values, timestamps=None, half_life=None, horizon=None):
+    """(trend, confidence) of a whole series; samples are one unit apart without timestamps.
+
+    The default horizon is the span of the series, so the trend reads as the
+    relative change across it.
+    """
+    if timestamps is None:
+        timestamps = range(len(values))
+    timestamps = list(timestamps)
+    if len(values) < 2:
+        return 0.0, 0.0
+    estimator = OnlineTrend(half_life)
+    for timestamp, value in zip(timestamps, values):
+        estimator.update(timestamp, value)
+    span = horizon if horizon is not None else timestamps[-1] - timestamps[0]
+    return estimator.trend(span), estimator.confidence()
+
+
+class TrendTracker:
+    """OnlineTrend per (instance, metric), kept across cycles"""
+
+    def __init__(self, half_life=TREND_HALF_LIFE, horizon=TREND_HORIZON):
+        self.half_life = half_life
+        self.horizon = horizon
+        self.estimators = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, metric, timestamp, value):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return
+        with self.lock:
+            estimator = self.estimators.setdefault(key, {}).get(metric)
+            if estimator is None:
+                estimator = self.estimators[key][metric] = OnlineTrend(self.half_life)
+            estimator.update(timestamp, value)
+
+    def get(self, key, metric):
+        """(trend, confidence, samples) for a series; zeros when it has not been seen"""
+        with self.lock:
+            estimator = self.estimators.get(key, {}).get(metric)
+            if estimator is None:
+                return 0.0, 0.0, 0
+            return estimator.trend(self.horizon), estimator.confidence(), estimator.count
+
+    def retain(self, keys):
+        with self.lock:
+            for key in [key for key in self.estimators if key not in keys]:
+                del self.estimators[key]
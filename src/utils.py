@@ -1,11 +1,12 @@
+from trend_estimator import trend_of
+
 def calculate_trend(data):
     if len(data) < 2:
         return 0  # Not enough data to determine a trend
 
-    initial_value = data[0]
-    final_value = data[-1]
-    trend = (final_value - initial_value) / initial_value * 100  # Percentage change
-    return trend
+    # Least-squares change across the series relative to its mean, as a percentage
+    trend, _ = trend_of(data)
+    return trend * 100
 
 def average(values):
     if not values: